@@ -0,0 +1,261 @@
+# encoding: utf-8
+'''
+Measure the extension's actions under increasing load.
+
+A stand-in for DataOntoSearch (see fake_dataontosearch.py) is started, and the
+given CKAN configuration is pointed at it. Datasets are created in the
+database and Solr index used by the configuration, then each scenario is run
+with an increasing number of concurrent clients:
+
+- search: dataontosearch_dataset_search, with a new query each time
+- search_repeated: dataontosearch_dataset_search, with the same query
+- tag_list_all: dataontosearch_tag_list_all
+- concept_list: dataontosearch_concept_list
+- concept_autocomplete: dataontosearch_concept_autocomplete, with a new
+  prefix each time
+- edit: what the concept editor does, that is dataontosearch_tag_list,
+  dataontosearch_concept_autocomplete and dataontosearch_tag_update
+
+For each scenario and level of concurrency, one line of JSON is written with
+the p50 and p99 latency, throughput and the number of requests made to
+DataOntoSearch.
+
+Only use this with a configuration for a test instance, like test.ini::
+
+    python bench/bench_load.py test.ini --latency 0.02
+'''
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_search_enrichment import load_ckan, create_datasets  # noqa
+from fake_dataontosearch import FakeDataOntoSearch  # noqa
+
+SCENARIOS = [
+    u'search',
+    u'search_repeated',
+    u'tag_list_all',
+    u'concept_list',
+    u'concept_autocomplete',
+    u'edit',
+]
+
+
+def percentile(timings, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(timings)
+    index = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(index, 0)]
+
+
+class Scenarios(object):
+    '''
+    One function per scenario, each doing what one client request does.
+    '''
+    def __init__(self, user, datasets, concepts):
+        import ckan.plugins.toolkit as toolkit
+
+        self.toolkit = toolkit
+        self.user = user
+        self.datasets = datasets
+        self.concepts = sorted(concepts)
+        self._queries = itertools.count()
+        self._lock = threading.Lock()
+
+    def _call(self, action, data_dict):
+        return self.toolkit.get_action(action)(
+            {u'user': self.user},
+            data_dict
+        )
+
+    def search(self):
+        with self._lock:
+            query = u'query {}'.format(next(self._queries))
+        self._call(u'dataontosearch_dataset_search', {u'q': query})
+
+    def search_repeated(self):
+        self._call(u'dataontosearch_dataset_search', {u'q': u'same query'})
+
+    def tag_list_all(self):
+        self._call(u'dataontosearch_tag_list_all', {})
+
+    def concept_list(self):
+        self._call(u'dataontosearch_concept_list', {})
+
+    def concept_autocomplete(self):
+        self._call(u'dataontosearch_concept_autocomplete', {
+            u'q': u'concept {}'.format(random.randint(0, 99)),
+        })
+
+    def edit(self):
+        dataset = random.choice(self.datasets)
+        self._call(u'dataontosearch_tag_list', {u'id': dataset[u'id']})
+        self._call(
+            u'dataontosearch_concept_autocomplete',
+            {u'q': u'concept'}
+        )
+        self._call(u'dataontosearch_tag_update', {
+            u'dataset': dataset[u'id'],
+            u'concepts': random.sample(self.concepts, 2),
+        })
+
+
+def run(f, concurrency, requests):
+    '''
+    Call f requests times, from concurrency threads at a time.
+
+    :return: the latency of each call, the number of calls that failed and the
+        total time spent
+    '''
+    import ckan.model as model
+
+    timings = []
+    errors = [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def client():
+        try:
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                started = time.time()
+                try:
+                    f()
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                duration = time.time() - started
+                with lock:
+                    timings.append(duration)
+        finally:
+            model.Session.remove()
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, errors[0], time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split(u'\n')[1])
+    parser.add_argument(u'config', help=u'CKAN configuration file to use')
+    parser.add_argument(
+        u'--scenarios',
+        default=u','.join(SCENARIOS),
+        help=u'comma-separated scenarios to run (default: all)'
+    )
+    parser.add_argument(
+        u'--concurrency',
+        default=u'1,4,16',
+        help=u'comma-separated numbers of concurrent clients'
+    )
+    parser.add_argument(
+        u'--requests',
+        type=int,
+        default=100,
+        help=u'number of requests for each scenario and concurrency'
+    )
+    parser.add_argument(u'--datasets', type=int, default=200)
+    parser.add_argument(u'--concepts', type=int, default=1000)
+    parser.add_argument(
+        u'--results',
+        type=int,
+        default=50,
+        help=u'number of results returned by DataOntoSearch for each search'
+    )
+    parser.add_argument(
+        u'--latency',
+        type=float,
+        default=0.,
+        help=u'seconds DataOntoSearch waits before answering'
+    )
+    parser.add_argument(
+        u'--jitter',
+        type=float,
+        default=0.,
+        help=u'up to this many seconds are added to the latency at random'
+    )
+    args = parser.parse_args()
+
+    load_ckan(args.config)
+    import ckan.plugins.toolkit as toolkit
+    from ckan.tests import factories
+    from ckanext.dcat.utils import dataset_uri
+    from ckanext.dataontosearch.cache import invalidate_caches
+
+    datasets = create_datasets(args.datasets)
+    user = factories.Sysadmin()
+
+    fake = FakeDataOntoSearch(
+        dataset_uris=[dataset_uri(d) for d in datasets],
+        concepts=args.concepts,
+        results=args.results,
+        latency=args.latency,
+        jitter=args.jitter,
+    ).start()
+    toolkit.config[u'ckan.dataontosearch.tagger_url'] = fake.url
+    toolkit.config[u'ckan.dataontosearch.search_url'] = fake.url
+    if not toolkit.config.get(u'ckan.dataontosearch.configuration'):
+        toolkit.config[u'ckan.dataontosearch.configuration'] = u'bench'
+
+    scenarios = Scenarios(user[u'name'], datasets, fake.concepts)
+    try:
+        for scenario in args.scenarios.split(u','):
+            for concurrency in [int(c) for c in args.concurrency.split(u',')]:
+                # Every measurement starts with empty caches
+                invalidate_caches()
+                calls_before = fake.get_calls()
+
+                timings, errors, elapsed = run(
+                    getattr(scenarios, scenario),
+                    concurrency,
+                    args.requests
+                )
+
+                calls = dict(
+                    (key, count - calls_before.get(key, 0))
+                    for key, count in fake.get_calls().items()
+                    if count - calls_before.get(key, 0)
+                )
+                json.dump(
+                    {
+                        u'scenario': scenario,
+                        u'concurrency': concurrency,
+                        u'requests': args.requests,
+                        u'errors': errors,
+                        u'p50_seconds': percentile(timings, .5)
+                        if timings else None,
+                        u'p99_seconds': percentile(timings, .99)
+                        if timings else None,
+                        u'throughput_per_second': len(timings) / elapsed
+                        if elapsed else None,
+                        u'upstream_calls': sum(calls.values()),
+                        u'upstream_calls_by_endpoint': calls,
+                        u'latency_seconds': args.latency,
+                    },
+                    sys.stdout,
+                    sort_keys=True
+                )
+                sys.stdout.write(u'\n')
+                sys.stdout.flush()
+    finally:
+        fake.stop()
+
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+'''
+Compare the time it takes to enrich semantic search results.
+
+The datasets found by DataOntoSearch used to be looked up with one package_show
+per result. Now they are looked up in bulk. This benchmark creates datasets in
+the database and Solr index used by the given CKAN configuration, and measures
+both approaches for an increasing number of results.
+
+Only use this with a configuration for a test instance, like test.ini::
+
+    python bench/bench_search_enrichment.py test.ini
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+
+def load_ckan(config_path):
+    from paste.deploy import appconfig
+    from ckan.config.environment import load_environment
+
+    conf = appconfig(u'config:' + os.path.abspath(config_path))
+    load_environment(conf.global_conf, conf.local_conf)
+
+
+def create_datasets(count):
+    from ckan.tests import factories
+
+    return [factories.Dataset() for _ in range(count)]
+
+
+def make_results(datasets):
+    # Mimic what DataOntoSearch returns for each dataset
+    return [
+        {
+            u'uri': u'http://ckan.example.com/dataset/{}'.format(d[u'id']),
+            u'score': 1. / (i + 1),
+            u'concepts': [],
+        }
+        for i, d in enumerate(datasets)
+    ]
+
+
+def enrich_one_by_one(results):
+    # The approach used before bulk lookups were introduced
+    import ckan.plugins.toolkit as toolkit
+
+    processed_results = []
+    for result in results:
+        dataset_id = result[u'uri'].split(u'/')[-1]
+        try:
+            dataset_info = toolkit.get_action(u'package_show')(None, {
+                u'id': dataset_id,
+            })
+        except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+            continue
+        dataset_info.update({
+            u'concepts': result[u'concepts'],
+            u'score': result[u'score'],
+        })
+        processed_results.append(dataset_info)
+    return processed_results
+
+
+def measure(f, results, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        f(results)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split(u'\n')[1])
+    parser.add_argument(u'config', help=u'CKAN configuration file to use')
+    parser.add_argument(
+        u'--counts',
+        default=u'10,50,100,250,500',
+        help=u'comma-separated numbers of results to measure with'
+    )
+    parser.add_argument(
+        u'--repeat',
+        type=int,
+        default=3,
+        help=u'how many times to repeat each measurement (best is reported)'
+    )
+    args = parser.parse_args()
+
+    load_ckan(args.config)
+    from ckanext.dataontosearch.logic import _enrich_search_results
+
+    counts = [int(c) for c in args.counts.split(u',')]
+    datasets = create_datasets(max(counts))
+
+    for count in counts:
+        results = make_results(datasets[:count])
+        before = measure(enrich_one_by_one, results, args.repeat)
+        after = measure(
+            lambda r: _enrich_search_results({}, r),
+            results,
+            args.repeat
+        )
+        json.dump(
+            {
+                u'results': count,
+                u'one_by_one_seconds': before,
+                u'bulk_seconds': after,
+            },
+            sys.stdout
+        )
+        sys.stdout.write(u'\n')
+
+
+if __name__ == u'__main__':
+    main()
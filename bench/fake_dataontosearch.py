@@ -0,0 +1,272 @@
+# encoding: utf-8
+'''
+Stand-in for the DataOntoSearch tagger and search, for benchmarking.
+
+It answers the requests made by ckanext-dataontosearch with made-up data,
+after waiting a configurable time, and counts the requests per endpoint. The
+same server acts as both tagger and search, so point both
+ckan.dataontosearch.tagger_url and ckan.dataontosearch.search_url at it.
+
+It can be run on its own::
+
+    python bench/fake_dataontosearch.py --port 8010 --latency 0.05
+
+or started from another benchmark using FakeDataOntoSearch.
+'''
+import re
+import json
+import time
+import random
+import argparse
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDataOntoSearch(object):
+    '''
+    The state of the stand-in server, and the server itself.
+
+    :param dataset_uris: RDF URIs of the datasets search results are made from
+    :param concepts: number of concepts in the ontology
+    :param results: number of results returned by each search
+    :param latency: seconds to wait before answering each request
+    :param jitter: up to this many seconds are added to the latency at random
+    '''
+    def __init__(self, dataset_uris=(), concepts=100, results=50,
+                 latency=0., jitter=0., host=u'127.0.0.1', port=0):
+        self.dataset_uris = list(dataset_uris)
+        self.concepts = dict(
+            (u'http://example.com/ontology#Concept{}'.format(i),
+             u'Concept {}'.format(i))
+            for i in range(concepts)
+        )
+        self.results = results
+        self.latency = latency
+        self.jitter = jitter
+        # Concepts associated with each dataset URI
+        self.tags = dict()
+        self.calls = dict()
+        self._lock = threading.Lock()
+
+        handler = type(
+            str(u'Handler'),
+            (_Handler,),
+            {u'fake': self}
+        )
+        self.server = _ThreadingHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return u'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_calls(self):
+        '''
+        :rtype: dict where 'METHOD /endpoint' is mapped to its number of calls
+        '''
+        with self._lock:
+            return dict(self.calls)
+
+    def count(self, method, endpoint):
+        key = u'{} {}'.format(method, endpoint)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def wait(self):
+        delay = self.latency + random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+
+    # Endpoints
+
+    def get_concept(self, params, body):
+        return self.concepts
+
+    def get_tag(self, params, body):
+        with self._lock:
+            if u'dataset_id' in params:
+                concepts = self.tags.get(params[u'dataset_id'])
+                if concepts is None:
+                    return None
+                return {u'concepts': self._describe(concepts)}
+            return dict(
+                (uri, {u'title': uri, u'concepts': self._describe(concepts)})
+                for uri, concepts in self.tags.items()
+            )
+
+    def post_tag(self, params, body):
+        uri = _dataset_uri_of(body)
+        concept = self._find_concept(body[u'concept'])
+        if uri is None or concept is None:
+            return {u'success': False, u'message': u'Not found'}
+        with self._lock:
+            self.tags.setdefault(uri, set()).add(concept)
+        return {u'success': True, u'id': u'{}#{}'.format(uri, concept)}
+
+    def delete_tag(self, params, body):
+        concept = self._find_concept(body[u'concept'])
+        with self._lock:
+            concepts = self.tags.get(body[u'dataset_id'], set())
+            success = concept in concepts
+            concepts.discard(concept)
+        return {u'success': success}
+
+    def delete_dataset(self, params, body):
+        with self._lock:
+            success = self.tags.pop(body[u'dataset_id'], None) is not None
+        return {u'success': success}
+
+    def get_search(self, params, body):
+        # The same query always gives the same results
+        rng = random.Random(params.get(u'q', u''))
+        count = min(self.results, len(self.dataset_uris))
+        uris = rng.sample(self.dataset_uris, count)
+        concepts = rng.sample(sorted(self.concepts), min(3, len(self.concepts)))
+        return {
+            u'concepts': [
+                {
+                    u'uri': uri,
+                    u'label': self.concepts[uri],
+                    u'similarity': rng.random(),
+                }
+                for uri in concepts
+            ],
+            u'results': [
+                {
+                    u'uri': uri,
+                    u'score': 1. / (rank + 1),
+                    u'concepts': self._describe(concepts[:1]),
+                }
+                for rank, uri in enumerate(uris)
+            ],
+        }
+
+    def _describe(self, concepts):
+        return [
+            {u'uri': uri, u'label': self.concepts[uri]}
+            for uri in sorted(concepts)
+        ]
+
+    def _find_concept(self, uri_or_label):
+        if uri_or_label in self.concepts:
+            return uri_or_label
+        for uri, label in self.concepts.items():
+            if label == uri_or_label:
+                return uri
+        return None
+
+
+def _dataset_uri_of(body):
+    # The dataset is given either by the URL of its RDF, or the RDF itself
+    if u'dataset_url' in body:
+        return re.sub(r'\.rdf$', u'', body[u'dataset_url'])
+    match = re.search(r'rdf:about="([^"]*/dataset/[^"]*)"', body[u'dataset_rdf'])
+    return match.group(1) if match else None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+
+    def do_GET(self):
+        self._handle(u'GET')
+
+    def do_POST(self):
+        self._handle(u'POST')
+
+    def do_DELETE(self):
+        self._handle(u'DELETE')
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        endpoint = u'/' + url.path.rstrip(u'/').rsplit(u'/', 1)[-1]
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get(u'Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        self.fake.count(method, endpoint)
+        handler = getattr(
+            self.fake,
+            u'{}_{}'.format(method.lower(), endpoint.strip(u'/')),
+            None
+        )
+        if handler is None:
+            self.send_error(404)
+            return
+
+        self.fake.wait()
+        data = json.dumps(handler(params, body)).encode(u'utf-8')
+        self.send_response(200)
+        self.send_header(u'Content-Type', u'application/json')
+        self.send_header(u'Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output clean
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split(u'\n')[1])
+    parser.add_argument(u'--host', default=u'127.0.0.1')
+    parser.add_argument(u'--port', type=int, default=8010)
+    parser.add_argument(
+        u'--datasets',
+        type=int,
+        default=1000,
+        help=u'number of made-up datasets to return from searches'
+    )
+    parser.add_argument(
+        u'--dataset-base',
+        default=u'http://localhost:5000/dataset/',
+        help=u'URI prefix of the made-up datasets'
+    )
+    parser.add_argument(u'--concepts', type=int, default=100)
+    parser.add_argument(u'--results', type=int, default=50)
+    parser.add_argument(u'--latency', type=float, default=0.)
+    parser.add_argument(u'--jitter', type=float, default=0.)
+    args = parser.parse_args()
+
+    fake = FakeDataOntoSearch(
+        dataset_uris=[
+            u'{}{}'.format(args.dataset_base, i) for i in range(args.datasets)
+        ],
+        concepts=args.concepts,
+        results=args.results,
+        latency=args.latency,
+        jitter=args.jitter,
+        host=args.host,
+        port=args.port,
+    )
+    print(u'Serving at {}'.format(fake.url))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == u'__main__':
+    main()
@@ -1,6 +1,8 @@
 # encoding: utf-8
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.dataontosearch import memo
+
 
 @toolkit.auth_allow_anonymous_access
 def dataontosearch_concept_list(context, data_dict):
@@ -10,6 +12,42 @@ def dataontosearch_concept_list(context, data_dict):
     }
 
 
+@toolkit.auth_allow_anonymous_access
+def dataontosearch_concept_autocomplete(context, data_dict):
+    # Allow everyone
+    return {
+        u'success': True
+    }
+
+
+def dataontosearch_cache_clear(context, data_dict):
+    # Only sysadmins, who are not subject to this check
+    return {
+        u'success': False
+    }
+
+
+def dataontosearch_outbox_status(context, data_dict):
+    # Only sysadmins, who are not subject to this check
+    return {
+        u'success': False
+    }
+
+
+def dataontosearch_mirror_sync(context, data_dict):
+    # Only sysadmins, who are not subject to this check
+    return {
+        u'success': False
+    }
+
+
+def dataontosearch_metrics(context, data_dict):
+    # Only sysadmins, who are not subject to this check
+    return {
+        u'success': False
+    }
+
+
 @toolkit.auth_allow_anonymous_access
 def dataontosearch_tag_list_all(context, data_dict):
     # Allow everyone
@@ -29,7 +67,7 @@ def dataontosearch_tag_list(context, data_dict):
 def dataontosearch_tag_create(context, data_dict):
     dataset_id_or_name = toolkit.get_or_bust(data_dict, u'dataset')
     try:
-        toolkit.check_access(u'package_update', None, {u'id': dataset_id_or_name})
+        memo.check_access(u'package_update', dataset_id_or_name)
         # User can edit the dataset, so let them edit the taggings
         return {
             u'success': True
@@ -47,6 +85,11 @@ def dataontosearch_tag_delete(context, data_dict):
     return dataontosearch_tag_create(context, data_dict)
 
 
+def dataontosearch_tag_update(context, data_dict):
+    # Use same permissions as for creating the tagging
+    return dataontosearch_tag_create(context, data_dict)
+
+
 def dataontosearch_dataset_delete(context, data_dict):
     # This is not as destructive as deleting a dataset, so use same permissions
     # as for removing taggings individually.
@@ -61,11 +104,7 @@ def dataontosearch_dataset_delete(context, data_dict):
         # a dataset. Normally this should not be a problem, but CKAN may have
         # been configured so permissions for removing datasets are relaxed.
         try:
-            toolkit.check_access(
-                u'package_delete',
-                None,
-                {u'id': dataset_id_or_name}
-            )
+            memo.check_access(u'package_delete', dataset_id_or_name)
             # Ok, user has permission to delete the dataset
             return {u'success': True}
         except toolkit.NotAuthorized:
@@ -79,3 +118,9 @@ def dataontosearch_dataset_search(context, data_dict):
     return {
         u'success': True
     }
+
+
+@toolkit.auth_allow_anonymous_access
+def dataontosearch_hybrid_search(context, data_dict):
+    # Use same permissions as for the semantic search
+    return dataontosearch_dataset_search(context, data_dict)
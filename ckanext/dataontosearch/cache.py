@@ -0,0 +1,248 @@
+# encoding: utf-8
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.redis import connect_to_redis
+
+
+logger = logging.getLogger(__name__)
+
+# All caches created by get_cache(), by name
+_caches = dict()
+_caches_lock = threading.Lock()
+
+# Fallback for when the generations cannot be shared through Redis
+_local_generations = dict()
+
+
+class CacheEntry(object):
+    '''
+    A value stored in a TTLCache, along with when it expires.
+
+    The etag is the validator DataOntoSearch gave us for the value, if any, so
+    that a stale entry can be revalidated instead of downloaded again.
+    '''
+    __slots__ = (u'value', u'etag', u'expires', u'weight')
+
+    def __init__(self, value, etag, expires, weight=1):
+        self.value = value
+        self.etag = etag
+        self.expires = expires
+        self.weight = weight
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+
+class TTLCache(object):
+    '''
+    Thread-safe cache whose entries expire after ttl seconds.
+
+    At most max_size entries are kept, the least recently used entry being
+    evicted when there is no more room. If weigh is given, it is called with
+    each value to find its weight (like its size), and entries are also
+    evicted when their total weight exceeds max_weight. The cache is local to
+    this process.
+    '''
+    def __init__(self, ttl, max_size, weigh=None, max_weight=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self._weight = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key, count=False):
+        '''
+        Find the entry for key, even if it has expired.
+
+        Use this when a stale entry is still useful, like for revalidation.
+        If count is True, the lookup is counted as a hit when the entry is
+        fresh, and as a miss otherwise.
+
+        :rtype: CacheEntry, or None if there is no entry for key
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Mark as most recently used
+                self._entries[key] = entry
+            if count:
+                if entry is not None and entry.fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            return entry
+
+    def get(self, key, default=None):
+        '''
+        Get the value stored for key, or default if it is missing or expired.
+        '''
+        entry = self.lookup(key, count=True)
+        if entry is not None and entry.fresh:
+            return entry.value
+        return default
+
+    def set(self, key, value, etag=None):
+        if self.ttl <= 0 or self.max_size <= 0:
+            # Caching is disabled
+            return
+        weight = self.weigh(value) if self.weigh is not None else 1
+        if self.max_weight is not None and weight > self.max_weight:
+            # Would push out everything else, so don't bother
+            return
+
+        entry = CacheEntry(value, etag, time.time() + self.ttl, weight)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._weight += weight
+            while len(self._entries) > self.max_size or (
+                self.max_weight is not None and self._weight > self.max_weight
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._weight -= evicted.weight
+
+    def touch(self, key):
+        '''
+        Let the entry for key live for another ttl seconds.
+
+        Use this when a stale entry has been revalidated.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires = time.time() + self.ttl
+
+    def invalidate(self, key=None):
+        '''
+        Remove the entry for key, or all entries if no key is given.
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._weight = 0
+            else:
+                self._remove(key)
+
+    def _remove(self, key):
+        # Must be called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._weight -= entry.weight
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_cache(name, ttl, max_size, **kwargs):
+    '''
+    Get the cache with the given name, creating it if it does not exist.
+
+    The ttl, max_size and other keyword arguments to TTLCache are only used
+    when creating the cache.
+    '''
+    cache = _caches.get(name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                cache = TTLCache(ttl, max_size, **kwargs)
+                _caches[name] = cache
+    return cache
+
+
+def get_cache_stats():
+    '''
+    Report how well each cache created by get_cache() is doing.
+
+    :rtype: dict where the name of each cache is mapped to a dict with its
+        number of 'hits', 'misses' and current 'entries'
+    '''
+    with _caches_lock:
+        caches = dict(_caches)
+    return dict(
+        (name, {
+            u'hits': cache.hits,
+            u'misses': cache.misses,
+            u'entries': len(cache),
+        })
+        for name, cache in caches.items()
+    )
+
+
+def invalidate_caches(name=None):
+    '''
+    Empty the cache with the given name, or all caches if no name is given.
+
+    :return: names of the caches that were emptied
+    :rtype: list of strings
+    '''
+    if name is None:
+        names = list(_caches.keys())
+    elif name in _caches:
+        names = [name]
+    else:
+        names = []
+
+    for cache_name in names:
+        logger.debug(u'Invalidating cache %s', cache_name)
+        _caches[cache_name].invalidate()
+    return names
+
+
+def get_generation(name):
+    '''
+    Get the current generation of the cache with the given name.
+
+    Include the generation in the cache keys, and call bump_generation() when
+    the cached data changes. The generation is shared by all CKAN processes
+    through Redis, so that changes made through one process are seen by all.
+    If Redis is unavailable, only this process' own changes are seen.
+
+    The generation should only be used as part of cache keys, it is not
+    necessarily a number.
+    '''
+    try:
+        generation = connect_to_redis().get(_get_generation_key(name))
+        return int(generation or 0), _local_generations.get(name, 0)
+    except Exception:
+        logger.warning(
+            u'Could not get generation of cache %s from Redis',
+            name,
+            exc_info=True
+        )
+        return None, _local_generations.get(name, 0)
+
+
+def bump_generation(name):
+    '''
+    Make entries in the named cache that use get_generation() in their keys
+    obsolete, in all CKAN processes.
+    '''
+    _local_generations[name] = _local_generations.get(name, 0) + 1
+    invalidate_caches(name)
+    try:
+        connect_to_redis().incr(_get_generation_key(name))
+    except Exception:
+        logger.warning(
+            u'Could not bump generation of cache %s in Redis, other processes '
+            u'may use outdated data until it expires',
+            name,
+            exc_info=True
+        )
+
+
+def _get_generation_key(name):
+    return u'ckanext-dataontosearch:{site_id}:generation:{name}'.format(
+        site_id=toolkit.config.get(u'ckan.site_id'),
+        name=name,
+    )
@@ -0,0 +1,122 @@
+# encoding: utf-8
+import sys
+import json
+
+from ckan.lib.cli import CkanCommand
+
+
+class DataOntoSearchCommand(CkanCommand):
+    '''
+    Manage the integration with DataOntoSearch.
+
+    Usage:
+
+        dataontosearch outbox [status]
+            Show how many changes are waiting to be sent to DataOntoSearch.
+
+        dataontosearch outbox drain
+            Send the changes that are due to DataOntoSearch. Run this
+            periodically (for example using cron) to retry failed changes.
+
+        dataontosearch mirror sync
+            Update the local copy of concepts associated with datasets. Run
+            this periodically (for example using cron) to pick up changes made
+            outside of CKAN.
+
+        dataontosearch reconcile [--resume] [--dry-run] [--workers=N]
+                                 [--rate=N] [--chunk-size=N]
+                                 [--checkpoint=PATH]
+            Remove datasets from DataOntoSearch which are no longer in CKAN,
+            and add concepts from the local copy which DataOntoSearch lacks.
+            Use --resume to continue an interrupted run.
+    '''
+    summary = __doc__.split(u'\n')[1]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(DataOntoSearchCommand, self).__init__(name)
+        self.parser.add_option(
+            u'--resume', action=u'store_true', default=False,
+            help=u'continue from the checkpoint of an interrupted run'
+        )
+        self.parser.add_option(
+            u'--dry-run', action=u'store_true', default=False,
+            help=u'only report what would be changed'
+        )
+        self.parser.add_option(
+            u'--workers', type=u'int', default=4,
+            help=u'number of requests to send at a time (default: 4)'
+        )
+        self.parser.add_option(
+            u'--rate', type=u'float', default=10.,
+            help=u'maximum number of requests per second, 0 for no limit '
+                 u'(default: 10)'
+        )
+        self.parser.add_option(
+            u'--chunk-size', type=u'int', default=500,
+            help=u'number of datasets to handle at a time (default: 500)'
+        )
+        self.parser.add_option(
+            u'--checkpoint', default=u'dataontosearch-reconcile.json',
+            help=u'file to save progress to (default: '
+                 u'dataontosearch-reconcile.json)'
+        )
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == u'outbox':
+            self.outbox()
+        elif cmd == u'mirror':
+            self.mirror()
+        elif cmd == u'reconcile':
+            self.reconcile()
+        else:
+            print(u'Command {} not recognized'.format(cmd))
+            sys.exit(1)
+
+    def outbox(self):
+        from ckanext.dataontosearch import outbox
+
+        subcommand = self.args[1] if len(self.args) > 1 else u'status'
+        if subcommand == u'status':
+            print(json.dumps(outbox.get_status(), indent=2))
+        elif subcommand == u'drain':
+            sent, failed = outbox.drain()
+            print(u'Sent {} changes, {} failed'.format(sent, failed))
+        else:
+            print(u'Command outbox {} not recognized'.format(subcommand))
+            sys.exit(1)
+
+    def mirror(self):
+        import ckan.plugins.toolkit as toolkit
+
+        subcommand = self.args[1] if len(self.args) > 1 else None
+        if subcommand == u'sync':
+            result = toolkit.get_action(u'dataontosearch_mirror_sync')(
+                {u'ignore_auth': True},
+                {}
+            )
+            print(u'{} datasets changed'.format(result[u'changed']))
+        else:
+            print(u'Command mirror {} not recognized'.format(subcommand))
+            sys.exit(1)
+
+    def reconcile(self):
+        from ckanext.dataontosearch.reconcile import Reconciler
+
+        def out(line):
+            print(line)
+
+        reconciler = Reconciler(
+            self.options.checkpoint,
+            workers=self.options.workers,
+            rate=self.options.rate,
+            chunk_size=self.options.chunk_size,
+            dry_run=self.options.dry_run,
+            out=out
+        )
+        reconciler.run(resume=self.options.resume)
@@ -0,0 +1,121 @@
+# encoding: utf-8
+'''
+Index of concept labels, for finding concepts as the user types.
+
+The index is built once for each list of concepts from DataOntoSearch, so that
+looking up matches does not need to go through every concept.
+'''
+import bisect
+import threading
+
+
+class ConceptIndex(object):
+    '''
+    Find concepts whose label matches some text, ignoring case.
+
+    Labels starting with the text come first, then labels with a word starting
+    with the text, and finally labels containing the text anywhere. Within
+    each group, concepts are sorted by label.
+
+    :param concepts: dict mapping the URI of each concept to its label
+    '''
+    def __init__(self, concepts):
+        # Sorted by label, the position in this list identifies the concept
+        self.concepts = sorted(
+            concepts.items(),
+            key=lambda item: (_fold(item[1]), item[0])
+        )
+        self._labels = [_fold(label) for _, label in self.concepts]
+        # Each word of each label, along with the position of the concept
+        self._words = sorted(
+            (word, position)
+            for position, label in enumerate(self._labels)
+            for word in set(label.split()[1:])
+        )
+
+    def search(self, text, limit=10):
+        '''
+        :rtype: list of at most limit (URI, label) pairs, best matches first
+        '''
+        text = _fold(text).strip()
+        if not text:
+            return self.concepts[:limit]
+
+        found = []
+        seen = set()
+
+        def add(positions):
+            for position in positions:
+                if len(found) >= limit:
+                    return
+                if position not in seen:
+                    seen.add(position)
+                    found.append(position)
+
+        # Labels starting with the text are next to each other
+        start = bisect.bisect_left(self._labels, text)
+        end = start
+        while end < len(self._labels) and self._labels[end].startswith(text):
+            end += 1
+        add(range(start, end))
+
+        # So are words starting with the text
+        if len(found) < limit:
+            end = start = bisect.bisect_left(self._words, (text,))
+            while end < len(self._words) and \
+                    self._words[end][0].startswith(text):
+                end += 1
+            add(sorted(position for _, position in self._words[start:end]))
+
+        # Anything else has to be looked for
+        if len(found) < limit:
+            add(
+                position
+                for position, label in enumerate(self._labels)
+                if text in label
+            )
+
+        return [self.concepts[position] for position in found]
+
+    def find_by_label(self, label):
+        '''
+        Find the concepts with exactly this label, ignoring case and
+        surrounding whitespace.
+
+        :rtype: list of (URI, label) pairs
+        '''
+        label = _fold(label).strip()
+        start = bisect.bisect_left(self._labels, label)
+        end = bisect.bisect_right(self._labels, label)
+        return self.concepts[start:end]
+
+    def __len__(self):
+        return len(self.concepts)
+
+
+def _fold(text):
+    return text.lower()
+
+
+# The index for the most recently seen list of concepts
+_index = None
+_index_concepts = None
+_index_lock = threading.Lock()
+
+
+def get_index(concepts):
+    '''
+    Get the index for the concepts, building it only if they have changed.
+
+    The concepts are compared by identity, so pass the same cached dict each
+    time.
+
+    :param concepts: dict mapping the URI of each concept to its label
+    :rtype: ConceptIndex
+    '''
+    global _index, _index_concepts
+    with _index_lock:
+        if _index is None or _index_concepts is not concepts:
+            _index = ConceptIndex(concepts)
+            _index_concepts = concepts
+        return _index
@@ -0,0 +1,70 @@
+/* Suggest concepts matching what the user types into a concept field.
+ *
+ * The suggestions are fetched from dataontosearch_concept_autocomplete and put
+ * in the datalist the field is connected to, so the browser shows them below
+ * the field.
+ *
+ * delay - milliseconds to wait after the user stops typing (default: 200)
+ * limit - the most suggestions to show (default: 20)
+ *
+ * Example
+ *
+ *   <datalist id="concepts"></datalist>
+ *   <input name="concept" list="concepts"
+ *          data-module="dataontosearch-concept-picker" />
+ */
+this.ckan.module('dataontosearch-concept-picker', function ($) {
+  return {
+    options: {
+      delay: 200,
+      limit: 20
+    },
+
+    initialize: function () {
+      $.proxyAll(this, /_on/);
+
+      this.datalist = $('#' + this.el.attr('list'));
+      this.timeout = null;
+      this.request = null;
+      this.lastQuery = null;
+
+      this.el.on('input focus', this._onInput);
+    },
+
+    teardown: function () {
+      this.el.off('input focus', this._onInput);
+    },
+
+    _onInput: function () {
+      clearTimeout(this.timeout);
+      this.timeout = setTimeout(this._onTimeout, this.options.delay);
+    },
+
+    _onTimeout: function () {
+      var query = $.trim(this.el.val());
+      // The same fields share one datalist, so fetch again when the user
+      // moves to another field, but not when nothing has changed
+      if (query === this.lastQuery && this.datalist.data('query') === query) {
+        return;
+      }
+      this.lastQuery = query;
+
+      if (this.request) {
+        this.request.abort();
+      }
+      this.request = $.getJSON(
+        this.sandbox.client.url('/api/3/action/dataontosearch_concept_autocomplete'),
+        {q: query, limit: this.options.limit}
+      ).done(this._onSuccess);
+    },
+
+    _onSuccess: function (data) {
+      var datalist = this.datalist.empty();
+      $.each(data.result, function (i, concept) {
+        $('<option>').attr('value', concept.label).appendTo(datalist);
+      });
+      datalist.data('query', this.lastQuery);
+      this.request = null;
+    }
+  };
+});
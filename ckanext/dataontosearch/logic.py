@@ -1,21 +1,51 @@
 # encoding: utf-8
+import time
 import logging
+import itertools
+import threading
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import has_request_context, copy_current_request_context
+from sqlalchemy import or_
+import ckan.authz as authz
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
+from ckan.lib.plugins import get_permission_labels
 try:
-    from ckanext.dcat.utils import dataset_uri
+    from ckanext.dcat.processors import RDFSerializer
 except ImportError:
     raise RuntimeError(
         u'ckanext-dataontosearch is dependent on ckanext-dcat, but could not '
         u'find the latter'
     )
 
+from ckanext.dataontosearch import outbox, mirror, memo, metrics, timing
+from ckanext.dataontosearch.concept_index import get_index
+from ckanext.dataontosearch.cache import (
+    get_cache, invalidate_caches, get_generation, bump_generation
+)
 from ckanext.dataontosearch.utils import (
     make_tagger_get_request, make_tagger_delete_request,
-    make_tagger_post_request, make_search_get_request, get_use_autotag
+    make_tagger_post_request, make_search_get_request, get_use_autotag,
+    make_tagger_url, get_concept_cache_ttl, get_concept_cache_size,
+    get_search_cache_ttl, get_search_cache_size, get_configuration,
+    get_rows_max, get_search_cache_max_results, response_json,
+    get_use_outbox, get_send_rdf, get_use_mirror, get_parallel_requests,
+    get_search_enrichment, get_enrichment_timeout, diff_concepts,
+    get_rdf_cache_ttl, get_rdf_cache_size
 )
 
 logger = logging.getLogger(__name__)
 
+# Search results from DataOntoSearch which were left out, by reason
+_skip_stats_lock = threading.Lock()
+_skip_stats = {
+    u'not_found': 0,
+    u'not_authorized': 0,
+    u'timed_out': 0,
+}
+
 
 @toolkit.side_effect_free
 def dataontosearch_concept_list(context, data_dict):
@@ -26,72 +56,396 @@ def dataontosearch_concept_list(context, data_dict):
         human-readable label is stored under 'label'.
     '''
     toolkit.check_access(u'dataontosearch_concept_list', context, data_dict)
-    r = make_tagger_get_request(u'/concept')
-    r.raise_for_status()
 
-    data = r.json()
+    data = _get_concepts()
 
     return {
         uri: {u'label': label} for uri, label in data.items()
     }
 
 
+# The most concepts dataontosearch_concept_autocomplete returns
+_AUTOCOMPLETE_MAX = 100
+
+
+@toolkit.side_effect_free
+def dataontosearch_concept_autocomplete(context, data_dict):
+    '''
+    Find concepts whose label matches some text, for suggesting concepts as the
+    user types.
+
+    Labels starting with the text come first, then labels with a word starting
+    with the text, and finally labels containing the text anywhere.
+
+    :param q: the text the user has typed so far
+    :type q: string
+    :param limit: the maximum number of concepts to return (optional, default:
+        10, at most 100)
+    :type limit: int
+    :rtype: list of dicts with the 'uri' and 'label' of each concept
+    '''
+    toolkit.check_access(
+        u'dataontosearch_concept_autocomplete',
+        context,
+        data_dict
+    )
+
+    text = data_dict.get(u'q') or u''
+    limit = min(_get_int_param(data_dict, u'limit', 10), _AUTOCOMPLETE_MAX)
+
+    index = get_index(_get_concepts())
+    return [
+        {u'uri': uri, u'label': label}
+        for uri, label in index.search(text, limit)
+    ]
+
+
+def resolve_concepts(texts, chosen_concepts=()):
+    '''
+    Find the concepts the user meant, given by their URI or label.
+
+    Labels are matched exactly, ignoring case. A label may belong to more than
+    one concept, in which case it is ambiguous and no concept is chosen,
+    unless one of them was chosen already.
+
+    :param texts: URIs or labels of concepts
+    :param chosen_concepts: the concepts associated with the dataset now,
+        each a dict with 'uri' and 'label'
+    :return: the URI of each concept found, without duplicates, the texts
+        which matched no concept, and the texts which matched more than one
+    :rtype: tuple of three lists
+    '''
+    concepts = _get_concepts()
+    index = get_index(concepts)
+    chosen = dict((c[u'label'], c[u'uri']) for c in chosen_concepts)
+
+    uris = OrderedDict()
+    unknown = []
+    ambiguous = []
+    for text in texts:
+        if text in concepts:
+            uris[text] = None
+            continue
+        if text in chosen:
+            uris[chosen[text]] = None
+            continue
+        found = index.find_by_label(text)
+        if len(found) == 1:
+            uris[found[0][0]] = None
+        elif found:
+            ambiguous.append(text)
+        else:
+            unknown.append(text)
+    return list(uris), unknown, ambiguous
+
+
+def _get_concepts():
+    '''
+    Get the concepts from DataOntoSearch, mapping their URIs to their labels.
+
+    The concepts rarely change, so they are cached. When the cached concepts
+    expire, we ask DataOntoSearch whether they have changed (using ETag) before
+    downloading them again.
+    '''
+    cache = get_cache(
+        u'concepts',
+        ttl=get_concept_cache_ttl(),
+        max_size=get_concept_cache_size()
+    )
+    # Different configurations may have different concepts
+    key = make_tagger_url(u'/concept')
+
+    entry = cache.lookup(key, count=True)
+    if entry is not None and entry.fresh:
+        return entry.value
+
+    headers = None
+    if entry is not None and entry.etag:
+        headers = {u'If-None-Match': entry.etag}
+
+    r = make_tagger_get_request(u'/concept', headers=headers)
+    if r.status_code == 304 and entry is not None:
+        logger.debug(u'Cached concepts are still valid')
+        cache.touch(key)
+        return entry.value
+    r.raise_for_status()
+
+    data = response_json(r)
+    cache.set(key, data, etag=r.headers.get(u'ETag'))
+    return data
+
+
+def dataontosearch_outbox_status(context, data_dict):
+    '''
+    Describe the changes waiting to be sent to DataOntoSearch in the background.
+
+    :rtype: dict with the number of 'pending' changes, how many of them are
+        'due' to be sent now, how many have 'failed' at least once, when the
+        'oldest' change was made (or None), and the number of changes that
+        were 'given_up' on
+    '''
+    toolkit.check_access(u'dataontosearch_outbox_status', context, data_dict)
+    return outbox.get_status()
+
+
+def dataontosearch_cache_clear(context, data_dict):
+    '''
+    Empty the caches this extension keeps of data from DataOntoSearch.
+
+    Only the caches of the CKAN process handling this request are emptied.
+
+    :param cache: name of the cache to empty (optional, default: all caches)
+    :type cache: string
+    :return: names of the caches that were emptied
+    :rtype: list of strings
+    '''
+    toolkit.check_access(u'dataontosearch_cache_clear', context, data_dict)
+    return invalidate_caches(data_dict.get(u'cache'))
+
+
 @toolkit.side_effect_free
 def dataontosearch_tag_list_all(context, data_dict):
     '''
     List existing DataOntoSearch tags for all datasets.
 
+    The datasets can be retrieved one page at a time, by using limit and
+    offset.
+
+    :param limit: maximum number of datasets to include (optional, default:
+        all datasets)
+    :type limit: int
+    :param offset: number of datasets to skip before the first included dataset
+        (optional, default: 0)
+    :type offset: int
     :rtype: dictionary where key is ID of a dataset, and value is a list of
         concepts. Each concept is a dict, with 'label' being human-readable
-        label and 'uri' being the URI identifying this concept.
+        label and 'uri' being the URI identifying this concept. Only datasets
+        with concepts are included, ordered by ID.
     '''
     toolkit.check_access(u'dataontosearch_tag_list_all', context, data_dict)
+    limit = _get_int_param(data_dict, u'limit', None)
+    offset = _get_int_param(data_dict, u'offset', 0)
+
+    if get_use_mirror() and mirror.is_complete():
+        return mirror.get_all_tags(limit, offset)
+
     r = make_tagger_get_request(u'/tag')
     r.raise_for_status()
 
-    data = r.json()
+    data = response_json(r)
+
+    # Give the same answer as the mirror. Every dataset must be looked up to
+    # know the IDs to order by.
+    tagged_datasets = (
+        (package_id, concepts)
+        for package_id, concepts
+        in _get_tagged_datasets(context[u'model'], data).items()
+        if concepts
+    )
+    if limit is None:
+        page = itertools.islice(tagged_datasets, offset, None)
+    else:
+        page = itertools.islice(tagged_datasets, offset, offset + limit)
 
+    return OrderedDict(page)
+
+
+def _get_tagged_datasets(model, data):
+    '''
+    Collect the tags from DataOntoSearch for datasets found in this CKAN.
+
+    A dataset may be known to DataOntoSearch by both its name and its ID, in
+    which case its concepts are combined.
+
+    :param model: the CKAN model
+    :param data: tags returned from DataOntoSearch's /tag endpoint
+    :return: the dataset's ID in CKAN mapped to its list of concepts, ordered
+        by ID, with the concepts ordered by label like in the mirror
+    :rtype: OrderedDict
+    '''
     tags = dict()
+    for _, package_id, concepts in _iter_tagged_datasets(model, data):
+        combined = tags.setdefault(package_id, dict())
+        for concept in concepts:
+            combined.setdefault(concept[u'uri'], concept)
 
-    for uri, details in data.iteritems():
-        # Try to extract the ID of this dataset
-        dataset_id = uri.split(u'/')[-1]
+    return OrderedDict(
+        (
+            package_id,
+            sorted(tags[package_id].values(), key=lambda c: c[u'label'])
+        )
+        for package_id in sorted(tags)
+    )
 
-        # Was this actually a URI for this CKAN?
-        model = context[u'model']
 
-        result = model.Package.get(dataset_id)
-        if result:
-            tags[dataset_id] = details[u'concepts']
+def _iter_tagged_datasets(model, data):
+    '''
+    Go through the tags from DataOntoSearch, for datasets found in this CKAN.
 
-    return tags
+    The datasets are looked up in chunks, to keep each query small.
+
+    :param model: the CKAN model
+    :param data: tags returned from DataOntoSearch's /tag endpoint
+    :return: generator of (dataset ID as found in the URI, the dataset's ID in
+        CKAN, list of concepts), in the order of the dataset URIs
+    '''
+    uris = sorted(data.keys())
+
+    for offset in range(0, len(uris), _DB_CHUNK_SIZE):
+        chunk = uris[offset:offset + _DB_CHUNK_SIZE]
+
+        # Try to extract the ID of each dataset
+        dataset_ids = [uri.split(u'/')[-1] for uri in chunk]
+
+        # Were these actually URIs for this CKAN?
+        found = dict()
+        query = model.Session.query(model.Package.id, model.Package.name)\
+            .filter(or_(
+                model.Package.id.in_(dataset_ids),
+                model.Package.name.in_(dataset_ids),
+            ))
+        for package_id, package_name in query:
+            found[package_id] = package_id
+            found[package_name] = package_id
+
+        for uri, dataset_id in zip(chunk, dataset_ids):
+            if dataset_id in found:
+                yield dataset_id, found[dataset_id], data[uri][u'concepts']
+
+
+def dataontosearch_mirror_sync(context, data_dict):
+    '''
+    Update the local copy of concepts associated with datasets.
+
+    All concepts associated with datasets in DataOntoSearch are fetched, and
+    the local copy is updated for datasets whose concepts have changed.
+
+    :return: the number of datasets that were 'changed'
+    :rtype: dictionary
+    '''
+    toolkit.check_access(u'dataontosearch_mirror_sync', context, data_dict)
+
+    r = make_tagger_get_request(u'/tag')
+    r.raise_for_status()
+
+    data = response_json(r)
+
+    changed = mirror.sync_all(
+        _get_tagged_datasets(context[u'model'], data).items()
+    )
+    return {u'changed': changed}
 
 
 @toolkit.side_effect_free
 def dataontosearch_tag_list(context, data_dict):
     '''
-    List concepts associated with the specified dataset.
+    List concepts associated with the specified dataset or datasets.
+
+    Either id or ids must be given.
 
     :param id: id or name of the dataset to fetch tags for
     :type id: string
+    :param ids: ids or names of many datasets to fetch tags for
+    :type ids: list of strings
     :rtype: list of concepts. Each concept is a dict, with 'label' being
-        human-readable label and 'uri' being the URI identifying this concept
+        human-readable label and 'uri' being the URI identifying this concept.
+        If ids was given, a dict where each id or name that was found is mapped
+        to its list of concepts. Datasets whose concepts could not be fetched
+        from DataOntoSearch are left out, unless all of them failed, in which
+        case the error is raised.
     '''
     toolkit.check_access(u'dataontosearch_tag_list', context, data_dict)
 
+    if u'ids' in data_dict:
+        return _get_tags_for_many(context.get(u'user'), data_dict[u'ids'])
+
     # What dataset is specified?
     dataset_id_or_name = toolkit.get_or_bust(data_dict, u'id')
-    dataset = toolkit.get_action(u'package_show')(None, {u'id': dataset_id_or_name})
+    dataset = memo.show_dataset(dataset_id_or_name)
+
+    if not get_use_mirror():
+        return _get_tags(dataset)
+
+    concepts = mirror.get_tags(dataset[u'id'])
+    if concepts is None:
+        # Not copied yet
+        concepts = _get_tags(dataset)
+        mirror.set_tags(dataset[u'id'], concepts)
+    return concepts
+
 
+def _get_tags_for_many(user, dataset_ids_or_names):
+    if not isinstance(dataset_ids_or_names, list):
+        dataset_ids_or_names = [dataset_ids_or_names]
+
+    # Only the datasets the user can see are found
+    datasets = _get_datasets_by_id(user, dataset_ids_or_names)
+    found = [
+        i for i in OrderedDict.fromkeys(dataset_ids_or_names) if i in datasets
+    ]
+
+    tags = dict()
+    if get_use_mirror():
+        mirrored = mirror.get_tags_for([datasets[i][u'id'] for i in found])
+        for dataset_id_or_name in found:
+            concepts = mirrored.get(datasets[dataset_id_or_name][u'id'])
+            if concepts is not None:
+                tags[dataset_id_or_name] = concepts
+
+    # Ask DataOntoSearch about the rest, a few at a time
+    remaining = [i for i in found if i not in tags]
+    if remaining:
+        def fetch(dataset_id_or_name):
+            try:
+                return _get_tags(datasets[dataset_id_or_name]), None
+            except Exception as e:
+                # Leave it out, rather than failing for all the others
+                logger.warning(
+                    u'Could not fetch concepts for %s, leaving it out',
+                    dataset_id_or_name,
+                    exc_info=True
+                )
+                return None, e
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=get_parallel_requests()) as pool:
+            fetched = pool.map(timing.bind(fetch), remaining)
+            for dataset_id_or_name, (concepts, error) in zip(remaining,
+                                                             fetched):
+                if error is not None:
+                    errors.append(error)
+                    continue
+                tags[dataset_id_or_name] = concepts
+                if get_use_mirror():
+                    mirror.set_tags(
+                        datasets[dataset_id_or_name][u'id'],
+                        concepts
+                    )
+
+        if len(errors) == len(remaining) and not tags:
+            # DataOntoSearch is probably down, which should not look like
+            # none of the datasets were found
+            raise errors[0]
+
+    return tags
+
+
+def _get_tags(dataset, coalesce=True):
     # Generate the RDF URI for this dataset, using the very same code used by
     # ckanext-dcat. We need this to be consistent with what DataOntoSearch found
     # when it retrieved the dataset RDF, thus this use of the internal DCAT API.
-    dataset_rdf_uri = dataset_uri(dataset)
+    dataset_rdf_uri = memo.get_dataset_uri(dataset)
 
-    r = make_tagger_get_request(u'/tag', {u'dataset_id': dataset_rdf_uri})
+    # Pass coalesce=False right after changing the tags, so we do not share
+    # the response of a request sent before the change
+    r = make_tagger_get_request(
+        u'/tag',
+        {u'dataset_id': dataset_rdf_uri},
+        coalesce=coalesce
+    )
     r.raise_for_status()
 
-    data = r.json()
+    data = response_json(r)
 
     if data is None:
         return []
@@ -108,7 +462,11 @@ def dataontosearch_tag_create(context, data_dict):
     :param concept: RDF URI or human-readable label for the concept to associate
         with the dataset
     :type dataset: string
-    :return: The dataset, concept and id for the newly created tag
+    :param defer: whether to send the change to DataOntoSearch in the
+        background (optional, default: False)
+    :type defer: bool
+    :return: The dataset, concept and id for the newly created tag. The id is
+        None if deferred.
     :rtype: dictionary
     '''
     toolkit.check_access(u'dataontosearch_tag_create', context, data_dict)
@@ -119,28 +477,33 @@ def dataontosearch_tag_create(context, data_dict):
 
     # We must provide DataOntoSearch with a URL of where to download metadata,
     # so generate this URL. First, what dataset was specified?
-    dataset = toolkit.get_action(u'package_show')(
-        None,
-        {u'id': dataset_id_or_name}
-    )
+    dataset = memo.show_dataset(dataset_id_or_name)
 
-    # We assume the RDF is available at the usual dataset URL, but with a
-    # .rdf suffix
-    dataset_id = dataset.get(u'id')
-    dataset_url = toolkit.url_for(
-        u'dataset_read',
-        id=dataset_id,
-        qualified=True
-    )
-    rdf_url = u'{}.rdf'.format(dataset_url)
+    if toolkit.asbool(data_dict.get(u'defer', False)):
+        outbox.add(
+            context,
+            u'tag_create',
+            dataset[u'id'],
+            make_tag_create_payload(dataset, concept_url_or_label),
+            concept=concept_url_or_label
+        )
+        tag_id = None
+    else:
+        # Now we are equipped to actually create the tag
+        tag_id = _create_tag(dataset, concept_url_or_label)
+        _tags_changed(dataset)
 
-    # Now we are equipped to actually create the tag
+    return {
+        u'dataset': dataset[u'id'],
+        u'concept': concept_url_or_label,
+        u'id': tag_id,
+    }
+
+
+def _create_tag(dataset, concept_url_or_label):
     r = make_tagger_post_request(
         u'/tag',
-        {
-            u'dataset_url': rdf_url,
-            u'concept': concept_url_or_label,
-        }
+        make_tag_create_payload(dataset, concept_url_or_label)
     )
     r.raise_for_status()
 
@@ -150,13 +513,54 @@ def dataontosearch_tag_create(context, data_dict):
     if not data[u'success']:
         raise RuntimeError(data[u'message'])
 
+    return data[u'id']
+
+
+def make_tag_create_payload(dataset, concept_url_or_label):
+    if get_send_rdf():
+        # Give DataOntoSearch the metadata directly, so that it need not ask
+        # CKAN for it while we wait for its response
+        return {
+            u'dataset_rdf': _serialize_dataset(dataset),
+            u'concept': concept_url_or_label,
+        }
+
+    # We assume the RDF is available at the usual dataset URL, but with a
+    # .rdf suffix
+    dataset_url = toolkit.url_for(
+        u'dataset_read',
+        id=dataset[u'id'],
+        qualified=True
+    )
+    rdf_url = u'{}.rdf'.format(dataset_url)
+
     return {
-        u'dataset': dataset_id,
+        u'dataset_url': rdf_url,
         u'concept': concept_url_or_label,
-        u'id': data[u'id'],
     }
 
 
+def _serialize_dataset(dataset):
+    '''
+    Serialize the dataset to RDF/XML, the same way ckanext-dcat does at the
+    dataset's .rdf URL.
+
+    The result is cached until the dataset is modified.
+    '''
+    cache = get_cache(
+        u'rdf',
+        ttl=get_rdf_cache_ttl(),
+        max_size=get_rdf_cache_size()
+    )
+    key = (dataset[u'id'], dataset.get(u'metadata_modified'))
+
+    rdf = cache.get(key)
+    if rdf is None:
+        rdf = RDFSerializer().serialize_dataset(dataset, _format=u'xml')
+        cache.set(key, rdf)
+    return rdf
+
+
 def dataontosearch_tag_delete(context, data_dict):
     '''
     Remove an existing association between the specified dataset and concept.
@@ -166,6 +570,9 @@ def dataontosearch_tag_delete(context, data_dict):
     :param concept: RDF URI or human-readable label for the concept to no longer
         associate with the dataset
     :type dataset: string
+    :param defer: whether to send the change to DataOntoSearch in the
+        background (optional, default: False)
+    :type defer: bool
     :return: True
     :rtype: bool
     '''
@@ -176,22 +583,174 @@ def dataontosearch_tag_delete(context, data_dict):
     concept_url_or_label = toolkit.get_or_bust(data_dict, u'concept')
 
     # What dataset is specified?
-    dataset = toolkit.get_action(u'package_show')(None, {
-        u'id': dataset_id_or_name,
-    })
-    dataset_rdf_uri = dataset_uri(dataset)
+    dataset = memo.show_dataset(dataset_id_or_name)
+
+    if toolkit.asbool(data_dict.get(u'defer', False)):
+        outbox.add(
+            context,
+            u'tag_delete',
+            dataset[u'id'],
+            make_tag_delete_payload(dataset, concept_url_or_label),
+            concept=concept_url_or_label
+        )
+        return True
 
+    success = _delete_tag(dataset, concept_url_or_label)
+
+    if success:
+        _tags_changed(dataset)
+
+    return success
+
+
+def _delete_tag(dataset, concept_url_or_label):
     # Make the request
-    r = make_tagger_delete_request(u'/tag', {
-        u'dataset_id': dataset_rdf_uri,
-        u'concept': concept_url_or_label,
-    })
+    r = make_tagger_delete_request(
+        u'/tag',
+        make_tag_delete_payload(dataset, concept_url_or_label)
+    )
     r.raise_for_status()
     data = r.json()
 
     return data[u'success']
 
 
+def make_tag_delete_payload(dataset, concept_url_or_label):
+    return {
+        u'dataset_id': memo.get_dataset_uri(dataset),
+        u'concept': concept_url_or_label,
+    }
+
+
+def dataontosearch_tag_update(context, data_dict):
+    '''
+    Make the specified concepts the only ones associated with the dataset.
+
+    Concepts are added before they are removed, since that is less destructive
+    in case of error. DataOntoSearch cannot apply all the changes atomically,
+    so if one of them fails, the changes already made are reverted before the
+    error is raised.
+
+    :param dataset: Name or ID of the dataset whose concepts should be changed
+    :type dataset: string
+    :param concepts: RDF URIs or human-readable labels for all the concepts
+        that should be associated with the dataset
+    :type concepts: list of strings
+    :param defer: whether to send the changes to DataOntoSearch in the
+        background (optional, default: False)
+    :type defer: bool
+    :return: The dataset, and the concepts that were 'added' and 'removed'.
+        If deferred, what to change is only worked out when the changes are
+        sent, so 'added' and 'removed' are None.
+    :rtype: dictionary
+    '''
+    toolkit.check_access(u'dataontosearch_tag_update', context, data_dict)
+
+    # Extract parameters from data_dict
+    dataset_id_or_name = toolkit.get_or_bust(data_dict, u'dataset')
+    concepts = toolkit.get_or_bust(data_dict, u'concepts')
+    if not isinstance(concepts, list):
+        concepts = [concepts]
+
+    # What dataset is specified?
+    dataset = memo.show_dataset(dataset_id_or_name)
+
+    if toolkit.asbool(data_dict.get(u'defer', False)):
+        # Queue all the concepts as one change, which replaces the changes to
+        # them still waiting to be sent. It is compared with what
+        # DataOntoSearch has when it is sent, so there is no need to ask now.
+        create_payload = make_tag_create_payload(dataset, None)
+        del create_payload[u'concept']
+        outbox.add(
+            context,
+            u'tag_update',
+            dataset[u'id'],
+            {
+                u'dataset_id': memo.get_dataset_uri(dataset),
+                u'concepts': list(OrderedDict.fromkeys(concepts)),
+                u'create': create_payload,
+            }
+        )
+        return {
+            u'dataset': dataset[u'id'],
+            u'added': None,
+            u'removed': None,
+        }
+
+    # What must be changed?
+    existing_concepts = _get_tags(dataset, coalesce=False)
+    added, removed = diff_concepts(existing_concepts, concepts)
+
+    result = {
+        u'dataset': dataset[u'id'],
+        u'added': added,
+        u'removed': removed,
+    }
+
+    # Apply the changes, remembering how to undo them
+    undo = []
+    try:
+        for concept in added:
+            _create_tag(dataset, concept)
+            undo.append((_delete_tag, concept))
+
+        for concept in removed:
+            if not _delete_tag(dataset, concept):
+                raise RuntimeError(
+                    u'Concept {} could not be removed'.format(concept)
+                )
+            undo.append((_create_tag, concept))
+    except Exception:
+        logger.exception(
+            u'Failed to update concepts for %s, reverting %d changes',
+            dataset[u'id'],
+            len(undo)
+        )
+        _revert_tag_changes(context, dataset, undo)
+        raise
+    finally:
+        if undo:
+            _tags_changed(dataset)
+
+    return result
+
+
+def _revert_tag_changes(context, dataset, undo):
+    for f, concept in reversed(undo):
+        try:
+            f(dataset, concept)
+        except Exception:
+            if not get_use_outbox():
+                # Nothing more we can do, but the user should know
+                logger.exception(
+                    u'Could not revert change to concept %s for %s, the '
+                    u'concepts for this dataset are only partially updated',
+                    concept,
+                    dataset[u'id']
+                )
+                continue
+
+            logger.exception(
+                u'Could not revert change to concept %s for %s, will retry in '
+                u'the background',
+                concept,
+                dataset[u'id']
+            )
+            if f is _create_tag:
+                operation = u'tag_create'
+                payload = make_tag_create_payload(dataset, concept)
+            else:
+                operation = u'tag_delete'
+                payload = make_tag_delete_payload(dataset, concept)
+            outbox.add(
+                context,
+                operation,
+                dataset[u'id'],
+                payload,
+                concept=concept
+            )
+
+
 def dataontosearch_dataset_delete(context, data_dict):
     '''
     Remove all existing association between the specified dataset and concepts.
@@ -200,8 +759,11 @@ def dataontosearch_dataset_delete(context, data_dict):
 
     :param id: Name or ID of the dataset to remove from DataOntoSearch
     :type id: string
+    :param defer: whether to remove the dataset from DataOntoSearch in the
+        background (optional, default: False)
+    :type defer: bool
     :return: True if the dataset was removed, or False if the dataset was not
-        found.
+        found. Always True if deferred.
     :rtype: bool
     '''
     toolkit.check_access(u'dataontosearch_dataset_delete', context, data_dict)
@@ -210,89 +772,614 @@ def dataontosearch_dataset_delete(context, data_dict):
     dataset_id_or_name = toolkit.get_or_bust(data_dict, u'id')
 
     # What dataset is specified?
-    dataset = toolkit.get_action(u'package_show')(None, {
-        u'id': dataset_id_or_name,
-    })
-    dataset_rdf_uri = dataset_uri(dataset)
+    dataset = memo.show_dataset(dataset_id_or_name)
+    payload = {
+        u'dataset_id': memo.get_dataset_uri(dataset),
+    }
+
+    if get_use_mirror():
+        mirror.forget(dataset[u'id'])
+
+    if toolkit.asbool(data_dict.get(u'defer', False)):
+        outbox.add(context, u'dataset_delete', dataset[u'id'], payload)
+        return True
 
     # Make the request
-    r = make_tagger_delete_request(u'/dataset', {
-        u'dataset_id': dataset_rdf_uri,
-    })
+    r = make_tagger_delete_request(u'/dataset', payload)
     r.raise_for_status()
     data = r.json()
 
+    if data[u'success']:
+        # The dataset is gone, so there are no concepts to copy
+        bump_generation(u'search')
+
     return data[u'success']
 
 
+# The fields dataontosearch_dataset_search can give without looking up datasets
+_UNENRICHED_FIELDS = frozenset([u'id', u'score', u'concepts'])
+
+
 @toolkit.side_effect_free
 def dataontosearch_dataset_search(context, data_dict):
     '''
     Perform a semantic search using DataOntoSearch.
 
     The parameters and returned JSON is designed to be compatible with the
-    regular search (package_search) as far as possible, though only the q
-    parameter is supported. Some additional information from DataOntoSearch is
-    also available.
+    regular search (package_search) as far as possible, though only the q, rows
+    and start parameters are supported. Some additional information from
+    DataOntoSearch is also available.
+
+    Only the datasets on the requested page are looked up in CKAN. The full
+    list of results from DataOntoSearch is cached for a while, so that
+    DataOntoSearch is not queried again for the next page or for the same
+    query. The cache is emptied whenever tags are changed through CKAN.
+    Which datasets the user is authorized to see is checked on every search,
+    for all results at once, using the same permission labels as
+    package_search.
 
     :param q: the query to use when searching
     :type q: string
+    :param rows: the maximum number of matching datasets to return (optional,
+        default: 10, upper limit: 1000 unless set in the site's configuration
+        ``ckan.search.rows_max``)
+    :type rows: int
+    :param start: the offset in the complete result for where the set of
+        returned datasets should begin (optional, default: 0)
+    :type start: int
+    :param fl: the fields to include for each dataset, like 'id name score'
+        (optional, default: all fields). When only id, score and concepts are
+        included, the datasets are not looked up at all.
+    :type fl: list of strings, or string with the fields separated by spaces
+        or commas
+    :param fq: a Solr filter query, like in package_search, which the datasets
+        must match (optional)
+    :type fq: string
+    :param facet.field: the fields to facet upon, like in package_search
+        (optional, default: no facets)
+    :type facet.field: list of strings
+    :param facet.limit: the maximum number of values to return for each facet
+        field (optional, default: 50)
+    :type facet.limit: int
     :rtype: dictionary with 'concepts' that matched the query, a 'count' of
         results and 'results' with a list of datasets that matched. For each
         dataset, their similarity 'score' and similar 'concepts' are available
-        in addition to the usual information given in package_show. For each
-        concept, their RDF IRI is available as 'uri', human-readable label as
-        'label' and similarity score as 'similarity'
+        in addition to the usual information given in package_show, unless
+        left out by fl. For each concept, their RDF IRI is available as 'uri',
+        human-readable label as 'label' and similarity score as 'similarity'.
+        'facets' and 'search_facets' are like those returned by
+        package_search, and count the values among all matching datasets.
     '''
     toolkit.check_access(u'dataontosearch_dataset_search', context, data_dict)
+    started = time.time()
+
+    query = toolkit.get_or_bust(data_dict, u'q')
+    rows = min(_get_int_param(data_dict, u'rows', 10), get_rows_max())
+    start = _get_int_param(data_dict, u'start', 0)
+    fields = _get_fields_param(data_dict, u'fl')
+    filter_query = data_dict.get(u'fq') or None
+    facet_fields = _get_fields_param(data_dict, u'facet.field')
+    facet_limit = _get_int_param(data_dict, u'facet.limit', 50)
+
+    data = _get_search_results(query)
+
+    with timing.phase(u'visibility'):
+        results, dataset_ids = _filter_visible(context, data[u'results'])
+    query_concepts = data[u'concepts']
+
+    facets = {}
+    search_facets = {}
+    if filter_query or facet_fields:
+        with timing.phase(u'facets'):
+            matching_ids, facets, search_facets = _filter_and_facet(
+                context,
+                dataset_ids,
+                filter_query,
+                facet_fields or [],
+                facet_limit
+            )
+        if filter_query:
+            # Only enrich the datasets that match the filter
+            matching = [
+                (result, dataset_id)
+                for result, dataset_id in zip(results, dataset_ids)
+                if dataset_id in matching_ids
+            ]
+            results = [result for result, _ in matching]
+            dataset_ids = [dataset_id for _, dataset_id in matching]
+
+    if fields is not None and set(fields) <= _UNENRICHED_FIELDS:
+        # Everything asked for is known without looking up the datasets
+        processed_results = [
+            _select_fields(
+                {u'id': dataset_id},
+                fields,
+                {u'concepts': result[u'concepts'], u'score': result[u'score']}
+            )
+            for result, dataset_id in zip(
+                results[start:start + rows],
+                dataset_ids[start:start + rows]
+            )
+        ]
+    else:
+        with timing.phase(u'enrich'):
+            processed_results = _enrich_search_results(
+                context,
+                results[start:start + rows],
+                fields
+            )
+
+    metrics.search_latency.observe(
+        time.time() - started,
+        action=u'dataontosearch_dataset_search'
+    )
+    return {
+        u'count': len(results),
+        u'results': processed_results,
+        u'concepts': query_concepts,
+        u'facets': facets,
+        u'search_facets': search_facets,
+        # Include dummy data for keys present in package_search
+        u'sort': u'',
+    }
+
+
+def _filter_and_facet(context, dataset_ids, filter_query, facet_fields,
+                      facet_limit):
+    '''
+    Find which datasets match a filter query, and count their facet values.
+
+    This is done with one Solr query restricted to the given datasets (more if
+    there are very many of them), instead of looking at each dataset.
+
+    :param dataset_ids: IDs of the datasets to consider
+    :param filter_query: Solr filter query the datasets must match, or None
+    :param facet_fields: the fields to facet upon
+    :param facet_limit: the maximum number of values to return for each field
+    :return: the IDs of the matching datasets (only when filter_query is
+        given), and facets and search_facets like in package_search
+    :rtype: tuple of a set and two dicts
+    '''
+    unique_ids = list(OrderedDict.fromkeys(dataset_ids))
+    chunks = [
+        unique_ids[offset:offset + _SOLR_CHUNK_SIZE]
+        for offset in range(0, len(unique_ids), _SOLR_CHUNK_SIZE)
+    ]
+
+    matching_ids = set()
+    counts = dict((field, dict()) for field in facet_fields)
+    display_names = dict((field, dict()) for field in facet_fields)
+    for chunk in chunks:
+        fq = u'+id:({})'.format(
+            u' OR '.join(_quote_solr_term(i) for i in chunk)
+        )
+        if filter_query:
+            fq = u'{} +({})'.format(fq, filter_query)
+
+        search_result = toolkit.get_action(u'package_search')(
+            {u'user': context.get(u'user')},
+            {
+                u'q': u'*:*',
+                u'fq': fq,
+                # The IDs are only needed when filtering
+                u'rows': len(chunk) if filter_query else 0,
+                u'fl': [u'id'],
+                u'include_private': True,
+                u'facet.field': facet_fields,
+                # Counts from different chunks must be added up, so get all of
+                # them when there is more than one chunk
+                u'facet.limit': facet_limit if len(chunks) == 1 else -1,
+            }
+        )
+
+        matching_ids.update(
+            dataset[u'id'] for dataset in search_result[u'results']
+        )
+        for field, items in search_result[u'search_facets'].items():
+            for item in items[u'items']:
+                counts[field][item[u'name']] = (
+                    counts[field].get(item[u'name'], 0) + item[u'count']
+                )
+                display_names[field][item[u'name']] = item[u'display_name']
+
+    facets = dict()
+    search_facets = dict()
+    for field in facet_fields:
+        values = sorted(
+            counts[field].items(),
+            key=lambda item: (-item[1], item[0])
+        )[:facet_limit]
+        facets[field] = dict(values)
+        search_facets[field] = {
+            u'title': field,
+            u'items': [
+                {
+                    u'name': name,
+                    u'display_name': display_names[field][name],
+                    u'count': count,
+                }
+                for name, count in values
+            ],
+        }
+
+    return matching_ids, facets, search_facets
+
+
+@toolkit.side_effect_free
+def dataontosearch_hybrid_search(context, data_dict):
+    '''
+    Search using both the regular search and DataOntoSearch, and merge them.
+
+    The two searches are run at the same time. Datasets are ranked using
+    reciprocal rank fusion, so that datasets ranked highly by either search,
+    and especially by both, come first. Each dataset is only included once.
+
+    :param q: the query to use when searching
+    :type q: string
+    :param rows: the maximum number of matching datasets to return (optional,
+        default: 10, upper limit: 1000 unless set in the site's configuration
+        ``ckan.search.rows_max``)
+    :type rows: int
+    :param start: the offset in the merged result for where the set of
+        returned datasets should begin (optional, default: 0)
+    :type start: int
+    :param fl: the fields to include for each dataset, like 'id name score'
+        (optional, default: all fields)
+    :type fl: list of strings, or string with the fields separated by spaces
+        or commas
+    :rtype: dictionary like the one returned by dataontosearch_dataset_search.
+        Each dataset has a 'fusion_score', and datasets found by
+        DataOntoSearch also have 'score' and 'concepts'. Since only the
+        datasets up to the requested page are compared, 'count' is an upper
+        limit. It is never more than the number of datasets that can be
+        ranked, which is the same as the upper limit for rows.
+    '''
+    toolkit.check_access(u'dataontosearch_hybrid_search', context, data_dict)
+    started = time.time()
 
     query = toolkit.get_or_bust(data_dict, u'q')
+    rows = min(_get_int_param(data_dict, u'rows', 10), get_rows_max())
+    start = _get_int_param(data_dict, u'start', 0)
+    fields = _get_fields_param(data_dict, u'fl')
+
+    # Both rankings are needed down to the last dataset on the requested page
+    depth = min(start + rows, get_rows_max())
+    user = context.get(u'user')
+
+    # Only the IDs are needed for ranking, so that only the datasets on the
+    # requested page are looked up
+    def semantic_search():
+        try:
+            return toolkit.get_action(u'dataontosearch_dataset_search')(
+                {u'user': user},
+                {
+                    u'q': query,
+                    u'rows': depth,
+                    u'fl': [u'id', u'score', u'concepts'],
+                }
+            )
+        finally:
+            # Give the database connection used by this thread back
+            model.Session.remove()
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        semantic_future = executor.submit(
+            _with_request_context(semantic_search)
+        )
+        with timing.phase(u'solr'):
+            regular = toolkit.get_action(u'package_search')(
+                {u'user': user},
+                {
+                    u'q': query,
+                    u'rows': depth,
+                    u'fl': [u'id'],
+                    # Like the semantic search, include the private datasets
+                    # the user can see
+                    u'include_private': True,
+                }
+            )
+        semantic = semantic_future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+    ranked = _fuse_rankings([regular[u'results'], semantic[u'results']])
+    overlap = (
+        len(regular[u'results']) + len(semantic[u'results']) - len(ranked)
+    )
+
+    page = ranked[start:start + rows]
+    with timing.phase(u'enrich'):
+        datasets = _get_datasets_by_id(
+            user,
+            [ranking[u'id'] for ranking, _ in page]
+        )
+    results = []
+    for ranking, score in page:
+        dataset = datasets.get(ranking[u'id'])
+        if dataset is None:
+            # Deleted since it was found
+            _count_skipped(not_found=1)
+            continue
+        # The score and concepts from DataOntoSearch, if it found the dataset
+        extra_info = dict(ranking)
+        del extra_info[u'id']
+        extra_info[u'fusion_score'] = score
+        results.append(_select_fields(dataset, fields, extra_info))
+
+    metrics.search_latency.observe(
+        time.time() - started,
+        action=u'dataontosearch_hybrid_search'
+    )
+    return {
+        u'count': min(
+            regular[u'count'] + semantic[u'count'] - overlap,
+            get_rows_max()
+        ),
+        u'results': results,
+        u'concepts': semantic[u'concepts'],
+        # Include dummy data for keys present in package_search
+        u'sort': u'',
+        u'facets': {},
+        u'search_facets': {}
+    }
+
+
+# Dampens the advantage of the very first ranks, as suggested by Cormack et al.
+# in "Reciprocal Rank Fusion outperforms Condorcet and individual Rank Learning
+# Methods"
+_RRF_K = 60
+
+
+def _fuse_rankings(rankings):
+    '''
+    Merge rankings of datasets using reciprocal rank fusion.
+
+    :param rankings: lists of dataset dicts, each ordered from best to worst
+    :rtype: list of (dataset dict, fusion score) ordered from best to worst,
+        with one entry per dataset ID. When a dataset is in more than one
+        ranking, the dict from the last of them is used.
+    '''
+    scores = OrderedDict()
+    datasets = dict()
+    for ranking in rankings:
+        for rank, dataset in enumerate(ranking, 1):
+            scores[dataset[u'id']] = (
+                scores.get(dataset[u'id'], 0.) + 1. / (_RRF_K + rank)
+            )
+            datasets[dataset[u'id']] = dataset
+    # sorted is stable, so ties keep the order of the first ranking
+    return sorted(
+        ((datasets[dataset_id], score) for dataset_id, score in scores.items()),
+        key=lambda item: item[1],
+        reverse=True
+    )
+
+
+def _get_search_results(query):
+    '''
+    Get the ranked results of a query from DataOntoSearch, using the cache.
+
+    :rtype: dictionary with 'results' and 'concepts', as returned by
+        DataOntoSearch
+    '''
+    use_autotag = get_use_autotag()
+
+    cache = get_cache(
+        u'search',
+        ttl=get_search_cache_ttl(),
+        max_size=get_search_cache_size(),
+        weigh=lambda data: len(data[u'results']) + 1,
+        max_weight=get_search_cache_max_results()
+    )
+    query = _normalize_query(query)
+    key = (
+        query,
+        get_configuration(),
+        use_autotag,
+        get_generation(u'search'),
+    )
+
+    data = cache.get(key)
+    if data is not None:
+        return data
 
     parameters = {
         u'q': query,
         u'd': 0,
     }
-    if get_use_autotag():
+    if use_autotag:
         parameters[u'a'] = 1
 
     r = make_search_get_request(u'/search', parameters)
     r.raise_for_status()
-    data = r.json()
+    data = response_json(r)
 
-    results = data[u'results']
-    query_concepts = data[u'concepts']
+    cache.set(key, data)
+    return data
 
-    processed_results = []
 
-    for result in results:
-        # Extract the ID of this dataset
-        dataset_id = result[u'uri'].split(u'/')[-1]
+def _normalize_query(query):
+    # How the words are separated does not matter to DataOntoSearch
+    return u' '.join(query.split())
 
-        # Fetch information about this dataset
+
+def _tags_changed(dataset):
+    # Searches done before this change may now give different results
+    bump_generation(u'search')
+
+    if get_use_mirror():
+        # Write the new concepts to the local copy
         try:
-            dataset_info = toolkit.get_action(u'package_show')(None, {
-                u'id': dataset_id,
-            })
-        except toolkit.ObjectNotFound:
-            # Perhaps not part of this CKAN? This should generally not happen,
-            # and can indicate some trouble with configurations in
-            # DataOntoSearch or changed ID or name in CKAN
+            mirror.set_tags(dataset[u'id'], _get_tags(dataset, coalesce=False))
+        except Exception:
             logger.warning(
-                u'Skipping dataset %(uri)s returned from DataOntoSearch, not '
-                u'found in CKAN',
-                {u'uri': result[u'uri']},
-                exc_info=True
-            )
-            continue
-        except toolkit.NotAuthorized:
-            # This may be a private dataset or something, so don't show it
-            # TODO: Does CKAN reveal that the dataset exists, but is private?
-            logger.debug(
-                u'Skipping dataset %(uri)s since user is not authorized to see '
-                u'it',
-                {u'uri': result[u'uri']},
+                u'Could not copy concepts for %s, will copy them later',
+                dataset[u'id'],
                 exc_info=True
             )
+            mirror.forget(dataset[u'id'])
+
+
+def _get_fields_param(data_dict, key):
+    value = data_dict.get(key)
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        value = u'{}'.format(value).replace(u',', u' ').split()
+    if not all(isinstance(field, (type(u''), str)) for field in value):
+        raise toolkit.ValidationError({key: [u'Must be a list of fields']})
+    if not value:
+        return None
+    # Keep the order, but only include each field once
+    return list(OrderedDict.fromkeys(value))
+
+
+def _get_int_param(data_dict, key, default):
+    value = data_dict.get(key, default)
+    if value is None:
+        return value
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: [u'Must be an integer']})
+    if value < 0:
+        raise toolkit.ValidationError({key: [u'Must not be negative']})
+    return value
+
+
+# How many datasets to look up in the database at a time
+_DB_CHUNK_SIZE = 500
+
+# How many datasets to ask Solr for at a time. Solr limits how many clauses a
+# query can have (1024 by default), and we use two clauses per dataset.
+_SOLR_CHUNK_SIZE = 500
+
+
+def _filter_visible(context, results):
+    '''
+    Leave out the search results the user is not authorized to see.
+
+    Like package_search, only active datasets are included, and a dataset is
+    visible when it shares a permission label with the user. Sysadmins can see
+    every active dataset. This is decided for all results at once, with a few
+    database queries, so that no datasets need to be looked up one by one.
+
+    :param results: list of results from DataOntoSearch, each with 'uri'
+    :return: the results the user can see, in the same order, and the ID of
+        the dataset of each of them
+    :rtype: tuple of two lists
+    '''
+    dataset_ids = [result[u'uri'].split(u'/')[-1] for result in results]
+    unique_ids = list(OrderedDict.fromkeys(dataset_ids))
+
+    labels = get_permission_labels()
+    user = context.get(u'user')
+    if authz.is_sysadmin(user):
+        user_labels = None
+    else:
+        user_obj = context.get(u'auth_user_obj')
+        if user_obj is None and user:
+            user_obj = model.User.get(user)
+        user_labels = set(labels.get_user_dataset_labels(user_obj))
+
+    found = set()
+    # ID or name of each visible dataset, mapped to its ID
+    visible = dict()
+    for offset in range(0, len(unique_ids), _DB_CHUNK_SIZE):
+        chunk = unique_ids[offset:offset + _DB_CHUNK_SIZE]
+        query = model.Session.query(model.Package)\
+            .filter(model.Package.state == u'active')\
+            .filter(or_(
+                model.Package.id.in_(chunk),
+                model.Package.name.in_(chunk),
+            ))
+        for package in query:
+            keys = (package.id, package.name)
+            found.update(keys)
+            if user_labels is None or user_labels.intersection(
+                labels.get_dataset_labels(package)
+            ):
+                visible.update((key, package.id) for key in keys)
+
+    visible_results = []
+    visible_ids = []
+    not_found = 0
+    not_authorized = 0
+    for dataset_id, result in zip(dataset_ids, results):
+        if dataset_id in visible:
+            visible_results.append(result)
+            visible_ids.append(visible[dataset_id])
+        elif dataset_id in found:
+            not_authorized += 1
+        else:
+            not_found += 1
+
+    _count_skipped(not_found=not_found, not_authorized=not_authorized)
+    if not_found:
+        # These are not part of this CKAN, or have been deleted. This should
+        # generally not happen, and can indicate some trouble with
+        # configurations in DataOntoSearch or changed ID or name in CKAN
+        logger.debug(
+            u'Skipped %d datasets returned from DataOntoSearch, not found in '
+            u'CKAN',
+            not_found
+        )
+    return visible_results, visible_ids
+
+
+def _count_skipped(**counts):
+    with _skip_stats_lock:
+        for reason, count in counts.items():
+            _skip_stats[reason] += count
+
+
+def get_search_skip_stats():
+    '''
+    Report how many search results were left out since this process started.
+
+    :rtype: dict with the number of results 'not_found' in CKAN, those the user
+        was 'not_authorized' to see, and those that 'timed_out' while being
+        looked up
+    '''
+    with _skip_stats_lock:
+        return dict(_skip_stats)
+
+
+def _enrich_search_results(context, results, fields=None):
+    '''
+    Combine the results from DataOntoSearch with information about datasets.
+
+    The datasets are looked up in bulk, instead of one package_show per result,
+    unless package_show is configured to be used. Datasets that are no longer
+    found, or that could not be looked up in time, are left out. The order of
+    the results from DataOntoSearch is kept.
+
+    :param results: list of results from DataOntoSearch, each with 'uri',
+        'score' and 'concepts', which the user is authorized to see
+    :param fields: the fields to include for each dataset, or None for all
+    :rtype: list of dataset dicts, with 'score' and 'concepts' added
+    '''
+    # Extract the ID of each dataset
+    dataset_ids = [result[u'uri'].split(u'/')[-1] for result in results]
+
+    use_package_show = get_search_enrichment() == u'package_show'
+    metrics.enrichment_fan_out.observe(
+        len(set(dataset_ids)),
+        method=u'package_show' if use_package_show else u'package_search'
+    )
+    if use_package_show:
+        datasets = _show_datasets(context.get(u'user'), dataset_ids)
+    else:
+        datasets = _get_datasets_by_id(context.get(u'user'), dataset_ids)
+
+    processed_results = []
+    skipped = 0
+
+    for dataset_id, result in zip(dataset_ids, results):
+        dataset_info = datasets.get(dataset_id)
+        if dataset_info is None:
+            skipped += 1
             continue
 
         # Enrich with information from DataOntoSearch's result
@@ -300,17 +1387,149 @@ def dataontosearch_dataset_search(context, data_dict):
             u'concepts': result[u'concepts'],
             u'score': result[u'score'],
         }
-        dataset_info.update(extra_info)
+
+        # Don't modify the dict used for other results of the same dataset
+        dataset_info = _select_fields(dataset_info, fields, extra_info)
 
         # Processed!
         processed_results.append(dataset_info)
 
-    return {
-        u'count': len(processed_results),
-        u'results': processed_results,
-        u'concepts': query_concepts,
-        # Include dummy data for keys present in package_search
-        u'sort': u'',
-        u'facets': {},
-        u'search_facets': {}
-    }
+    if skipped and not use_package_show:
+        # Deleted after we checked which datasets the user can see. (Datasets
+        # skipped by package_show are counted as they are looked up.)
+        _count_skipped(not_found=skipped)
+
+    return processed_results
+
+
+def _select_fields(dataset, fields, extra_info=None):
+    '''
+    Make a new dict with only the given fields of the dataset.
+
+    :param dataset: dict for the dataset
+    :param fields: the fields to include, or None for all
+    :param extra_info: dict with fields to add to or replace in the dataset
+    '''
+    extra_info = extra_info or {}
+    if fields is None:
+        selected = dict(dataset)
+        selected.update(extra_info)
+        return selected
+    return dict(
+        (field, extra_info[field] if field in extra_info else dataset[field])
+        for field in fields
+        if field in extra_info or field in dataset
+    )
+
+
+def _show_datasets(user, dataset_ids):
+    '''
+    Look up many datasets using package_show, a few at a time.
+
+    Datasets which are not looked up before the deadline are left out, so that
+    a few slow datasets do not hold up the whole search.
+
+    :param user: name of the user to look up the datasets as
+    :param dataset_ids: IDs or names of the datasets to look up
+    :rtype: dict where each ID or name which was found is mapped to the dict
+        for that dataset
+    '''
+    unique_ids = list(OrderedDict.fromkeys(dataset_ids))
+
+    def show(dataset_id):
+        metrics.package_show_calls.inc()
+        try:
+            return toolkit.get_action(u'package_show')(
+                {u'user': user},
+                {u'id': dataset_id}
+            )
+        except toolkit.ObjectNotFound:
+            # Deleted after we checked which datasets the user can see
+            _count_skipped(not_found=1)
+            return None
+        except toolkit.NotAuthorized:
+            # Perhaps an authorization plugin disagrees with the labels
+            _count_skipped(not_authorized=1)
+            return None
+        finally:
+            # Give the database connection used by this thread back
+            model.Session.remove()
+
+    executor = ThreadPoolExecutor(max_workers=get_parallel_requests())
+    try:
+        futures = dict(
+            (executor.submit(_with_request_context(show), dataset_id),
+             dataset_id)
+            for dataset_id in unique_ids
+        )
+        done, not_done = wait(futures, timeout=get_enrichment_timeout())
+        # Don't look up the datasets that missed the deadline
+        for future in not_done:
+            future.cancel()
+    finally:
+        # Don't wait for the lookups that have already started
+        executor.shutdown(wait=False)
+
+    if not_done:
+        _count_skipped(timed_out=len(not_done))
+        logger.warning(
+            u'Skipped %d datasets returned from DataOntoSearch, since they '
+            u'could not be looked up in time',
+            len(not_done)
+        )
+
+    datasets = dict()
+    for future in done:
+        dataset = future.result()
+        if dataset is not None:
+            datasets[futures[future]] = dataset
+    return datasets
+
+
+def _with_request_context(f):
+    # Let f use the request, if there is one, when run in another thread
+    f = timing.bind(f)
+    if has_request_context():
+        return copy_current_request_context(f)
+    return f
+
+
+def _get_datasets_by_id(user, dataset_ids):
+    '''
+    Look up many datasets using as few Solr queries as possible.
+
+    Only datasets the user is authorized to see are included, just like with
+    package_search.
+
+    :param user: name of the user to look up the datasets as. This is given
+        explicitly, since the current user is not known in other threads.
+    :param dataset_ids: IDs or names of the datasets to look up
+    :rtype: dict where each ID or name which was found is mapped to the dict
+        for that dataset
+    '''
+    datasets = dict()
+    unique_ids = list(OrderedDict.fromkeys(dataset_ids))
+
+    for offset in range(0, len(unique_ids), _SOLR_CHUNK_SIZE):
+        chunk = unique_ids[offset:offset + _SOLR_CHUNK_SIZE]
+        terms = u' OR '.join(_quote_solr_term(i) for i in chunk)
+
+        search_result = toolkit.get_action(u'package_search')(
+            {u'user': user},
+            {
+                u'q': u'*:*',
+                u'fq': u'id:({terms}) OR name:({terms})'.format(terms=terms),
+                u'rows': len(chunk),
+                u'include_private': True,
+            }
+        )
+
+        for dataset in search_result[u'results']:
+            datasets[dataset[u'id']] = dataset
+            datasets[dataset[u'name']] = dataset
+
+    return datasets
+
+
+def _quote_solr_term(term):
+    return u'"{}"'.format(term.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
@@ -0,0 +1,223 @@
+# encoding: utf-8
+'''
+Memory of things looked up while handling a single request.
+
+Editing the concepts of a dataset runs several actions, which would each look
+up the same dataset, generate the same RDF URI and check the same permissions.
+Instead, the results are remembered on flask.g, which is emptied for each
+request. Outside of a request, nothing is remembered.
+
+Authorization decisions can also be remembered across requests for a short
+while, per user. They are forgotten whenever memberships of organizations or
+groups, the organization or name of a dataset, or a user's sysadmin status
+change.
+'''
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from flask import g, has_app_context, has_request_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+try:
+    from ckanext.dcat.utils import dataset_uri
+except ImportError:
+    raise RuntimeError(
+        u'ckanext-dataontosearch is dependent on ckanext-dcat, but could not '
+        u'find the latter'
+    )
+
+from ckanext.dataontosearch import timing
+from ckanext.dataontosearch.cache import (
+    get_cache, get_generation, bump_generation
+)
+from ckanext.dataontosearch.utils import (
+    get_auth_cache_ttl, get_auth_cache_size
+)
+
+
+def _get_memo():
+    if not has_app_context():
+        # Remember nothing
+        return {
+            u'datasets': {},
+            u'uris': {},
+            u'auth': {},
+        }
+    if not hasattr(g, u'dataontosearch_memo'):
+        g.dataontosearch_memo = {
+            u'datasets': {},
+            u'uris': {},
+            u'auth': {},
+        }
+    return g.dataontosearch_memo
+
+
+def show_dataset(dataset_id_or_name):
+    '''
+    Look up the dataset using package_show, as the current user.
+
+    :param dataset_id_or_name: ID or name of the dataset
+    :rtype: dict for the dataset
+    :raises ObjectNotFound: if the dataset does not exist
+    :raises NotAuthorized: if the user is not allowed to see the dataset
+    '''
+    datasets = _get_memo()[u'datasets']
+    dataset = datasets.get(dataset_id_or_name)
+    if dataset is None:
+        dataset = toolkit.get_action(u'package_show')(
+            None,
+            {u'id': dataset_id_or_name}
+        )
+        # It may be looked up using either later
+        datasets[dataset[u'id']] = dataset
+        datasets[dataset[u'name']] = dataset
+    return dataset
+
+
+def get_dataset_uri(dataset):
+    '''
+    Generate the RDF URI of the dataset, like ckanext-dcat does.
+
+    :param dataset: dict for the dataset
+    :rtype: string
+    '''
+    uris = _get_memo()[u'uris']
+    uri = uris.get(dataset[u'id'])
+    if uri is None:
+        uri = dataset_uri(dataset)
+        uris[dataset[u'id']] = uri
+    return uri
+
+
+def check_access(action, dataset_id_or_name):
+    '''
+    Check whether the current user is authorized to do action on the dataset.
+
+    :param action: name of the action to check, like 'package_update'
+    :param dataset_id_or_name: ID or name of the dataset
+    :raises NotAuthorized: if the user is not authorized
+    '''
+    decisions = _get_memo()[u'auth']
+    key = (action, dataset_id_or_name)
+    if key not in decisions:
+        decisions[key] = _decide(action, dataset_id_or_name)
+    if decisions[key] is not None:
+        raise toolkit.NotAuthorized(decisions[key])
+
+
+def _decide(action, dataset_id_or_name):
+    # Find the reason the user is not authorized, or None if they are
+    ttl = get_auth_cache_ttl()
+    if ttl and has_request_context():
+        cache = get_cache(u'auth', ttl=ttl, max_size=get_auth_cache_size())
+        key = (
+            toolkit.c.user,
+            action,
+            dataset_id_or_name,
+            get_generation(u'auth'),
+        )
+        entry = cache.lookup(key, count=True)
+        if entry is not None and entry.fresh:
+            return entry.value
+    else:
+        cache = None
+
+    try:
+        with timing.phase(u'auth'):
+            toolkit.check_access(action, None, {u'id': dataset_id_or_name})
+        decision = None
+    except toolkit.NotAuthorized as e:
+        decision = u'{}'.format(e)
+
+    if cache is not None:
+        cache.set(key, decision)
+    return decision
+
+
+def forget(dataset_id_or_name):
+    '''
+    Forget what has been remembered about the dataset, after it has changed.
+    '''
+    memo = _get_memo()
+    dataset = memo[u'datasets'].get(dataset_id_or_name)
+    keys = set([dataset_id_or_name])
+    if dataset is not None:
+        keys.update((dataset[u'id'], dataset[u'name']))
+
+    for key in keys:
+        memo[u'datasets'].pop(key, None)
+        memo[u'uris'].pop(key, None)
+    for action, decided_for in list(memo[u'auth']):
+        if decided_for in keys:
+            del memo[u'auth'][(action, decided_for)]
+
+
+def watch_permissions():
+    '''
+    Forget remembered authorization decisions when permissions may change.
+
+    This is called when CKAN is configured.
+    '''
+    listeners = [
+        (model.Member, u'after_insert', _membership_changed),
+        (model.Member, u'after_update', _membership_changed),
+        (model.Member, u'after_delete', _membership_changed),
+        (model.Package, u'after_update', _dataset_changed),
+        (model.User, u'after_update', _user_changed),
+        (Session, u'after_commit', _after_commit),
+    ]
+    for target, event_name, f in listeners:
+        # CKAN may be configured more than once, like in tests
+        if not event.contains(target, event_name, f):
+            event.listen(target, event_name, f)
+
+
+def _membership_changed(mapper, connection, target):
+    _permissions_changed(target)
+
+
+def _dataset_changed(mapper, connection, target):
+    # Decisions are remembered by name too, and the old name may be given to
+    # another dataset
+    if _has_changed(target, u'owner_org', u'private', u'state', u'name'):
+        _permissions_changed(target)
+
+
+def _user_changed(mapper, connection, target):
+    if _has_changed(target, u'sysadmin', u'state'):
+        _permissions_changed(target)
+
+
+def _has_changed(target, *attributes):
+    state = inspect(target)
+    return any(
+        state.attrs[attribute].history.has_changes()
+        for attribute in attributes
+    )
+
+
+# Key in Session.info set when permissions changed in the session
+_PERMISSIONS_CHANGED = u'dataontosearch_permissions_changed'
+
+
+def _permissions_changed(target):
+    if has_app_context() and hasattr(g, u'dataontosearch_memo'):
+        g.dataontosearch_memo[u'auth'].clear()
+
+    # The change is only flushed, not committed, so others would still see
+    # the old permissions. Wait for the commit before telling them.
+    session = object_session(target)
+    if session is None:
+        _bump_auth_generation()
+    else:
+        session.info[_PERMISSIONS_CHANGED] = True
+
+
+def _after_commit(session):
+    if session.info.pop(_PERMISSIONS_CHANGED, False):
+        _bump_auth_generation()
+
+
+def _bump_auth_generation():
+    if get_auth_cache_ttl():
+        bump_generation(u'auth')
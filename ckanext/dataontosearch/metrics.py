@@ -0,0 +1,226 @@
+# encoding: utf-8
+'''
+Metrics about the work done by this extension, in the Prometheus text format.
+
+The metrics are kept in memory by each CKAN process, and are exposed to
+sysadmins at /dataontosearch/metrics.
+'''
+import threading
+
+from collections import OrderedDict
+
+
+class Counter(object):
+    '''
+    Thread-safe counter, with one value per combination of labels.
+    '''
+    kind = u'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        '''
+        :rtype: list of (name suffix, dict of labels, value)
+        '''
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            (u'_total', dict(zip(self.label_names, key)), value)
+            for key, value in values
+        ]
+
+
+class Histogram(Counter):
+    '''
+    Thread-safe histogram, with one set of buckets per combination of labels.
+    '''
+    kind = u'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=()):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key,
+                ([0] * len(self.buckets), 0., 0)
+            )
+            counts = [
+                bucket_count + (1 if value <= bound else 0)
+                for bucket_count, bound in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            labels = dict(zip(self.label_names, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                bucket_labels = dict(labels, le=_format_value(bound))
+                samples.append((u'_bucket', bucket_labels, bucket_count))
+            samples.append((u'_bucket', dict(labels, le=u'+Inf'), count))
+            samples.append((u'_sum', labels, total))
+            samples.append((u'_count', labels, count))
+        return samples
+
+
+class Gauge(object):
+    '''
+    A value which is read when the metrics are rendered.
+
+    :param collect: function returning a list of (dict of labels, value)
+    '''
+    kind = u'gauge'
+
+    def __init__(self, name, documentation, collect):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def samples(self):
+        return [(u'', labels, value) for labels, value in self.collect()]
+
+
+class CollectedCounter(Gauge):
+    '''
+    A counter kept elsewhere, which is read when the metrics are rendered.
+
+    :param collect: function returning a list of (dict of labels, value)
+    '''
+    kind = u'counter'
+
+    def samples(self):
+        return [(u'_total', labels, value) for labels, value in self.collect()]
+
+
+# All metrics, in the order they are rendered
+_registry = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def register(metric):
+    '''
+    Add the metric to those rendered, replacing any with the same name.
+    '''
+    with _registry_lock:
+        _registry[metric.name] = metric
+    return metric
+
+
+def render():
+    '''
+    Render all metrics in the Prometheus text exposition format.
+
+    :rtype: string
+    '''
+    with _registry_lock:
+        metrics = list(_registry.values())
+
+    lines = []
+    for metric in metrics:
+        lines.append(u'# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append(u'# TYPE {} {}'.format(metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            lines.append(u'{}{}{} {}'.format(
+                metric.name,
+                suffix,
+                _format_labels(labels),
+                _format_value(value)
+            ))
+    return u'\n'.join(lines) + u'\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return u''
+    return u'{' + u','.join(
+        u'{}="{}"'.format(name, _escape(labels[name]))
+        for name in sorted(labels)
+    ) + u'}'
+
+
+def _escape(value):
+    return u'{}'.format(value)\
+        .replace(u'\\', u'\\\\')\
+        .replace(u'\n', u'\\n')\
+        .replace(u'"', u'\\"')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, float):
+        return repr(value)
+    return u'{}'.format(value)
+
+
+# Seconds
+_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.
+)
+
+# Number of datasets
+_FAN_OUT_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+upstream_latency = register(Histogram(
+    u'dataontosearch_upstream_request_duration_seconds',
+    u'Time spent waiting for DataOntoSearch, by endpoint.',
+    (u'service', u'endpoint', u'method'),
+    _LATENCY_BUCKETS
+))
+
+upstream_responses = register(Counter(
+    u'dataontosearch_upstream_responses',
+    u'Responses received from DataOntoSearch, by endpoint and status code.',
+    (u'service', u'endpoint', u'method', u'status')
+))
+
+upstream_errors = register(Counter(
+    u'dataontosearch_upstream_errors',
+    u'Requests to DataOntoSearch that got no response, by endpoint and error.',
+    (u'service', u'endpoint', u'method', u'error')
+))
+
+search_latency = register(Histogram(
+    u'dataontosearch_search_duration_seconds',
+    u'Time spent on semantic searches, including enrichment.',
+    (u'action',),
+    _LATENCY_BUCKETS
+))
+
+enrichment_fan_out = register(Histogram(
+    u'dataontosearch_search_enrichment_datasets',
+    u'Number of datasets looked up in CKAN per semantic search.',
+    (u'method',),
+    _FAN_OUT_BUCKETS
+))
+
+package_show_calls = register(Counter(
+    u'dataontosearch_package_show_calls',
+    u'Calls to package_show made while enriching search results.'
+))
+
+
+def endpoint_of(url):
+    '''
+    Get the DataOntoSearch endpoint a URL is for, like '/tag'.
+    '''
+    path = url.split(u'?')[0].rstrip(u'/')
+    return u'/' + path.rsplit(u'/', 1)[-1]
@@ -0,0 +1,245 @@
+# encoding: utf-8
+'''
+Local copy of the concepts associated with datasets in DataOntoSearch.
+
+The copy lets us show concepts without asking DataOntoSearch. It is updated
+whenever concepts are changed through CKAN, and should be synchronized
+periodically with ``paster dataontosearch mirror sync`` to pick up changes made
+elsewhere.
+'''
+import logging
+import datetime
+
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta
+from ckan.model.system_info import get_system_info, set_system_info
+
+from ckanext.dataontosearch.model import (
+    mirror_dataset_table, mirror_tag_table
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Set in system_info when the whole mirror was last synchronized
+_SYNCED_KEY = u'ckanext.dataontosearch.mirror_synced'
+
+
+def get_tags(dataset_id):
+    '''
+    Get the concepts associated with the dataset.
+
+    :param dataset_id: ID of the dataset
+    :rtype: list of concepts, each a dict with 'uri' and 'label', or None if
+        the concepts of this dataset have not been copied
+    '''
+    session = meta.create_local_session()
+    try:
+        synced = session.execute(
+            mirror_dataset_table.select()
+            .where(mirror_dataset_table.c.dataset_id == dataset_id)
+        ).fetchone()
+        if synced is None:
+            return None
+
+        rows = session.execute(
+            mirror_tag_table.select()
+            .where(mirror_tag_table.c.dataset_id == dataset_id)
+            .order_by(mirror_tag_table.c.concept_label)
+        )
+        return [_concept_from_row(row) for row in rows]
+    finally:
+        session.close()
+
+
+def get_tags_for(dataset_ids):
+    '''
+    Get the concepts associated with many datasets at once.
+
+    :param dataset_ids: IDs of the datasets
+    :rtype: dict where the key is the ID of a dataset whose concepts have been
+        copied, and the value is a list of concepts, each a dict with 'uri'
+        and 'label'
+    '''
+    if not dataset_ids:
+        return dict()
+
+    session = meta.create_local_session()
+    try:
+        tags = dict(
+            (row.dataset_id, [])
+            for row in session.execute(
+                mirror_dataset_table.select()
+                .where(mirror_dataset_table.c.dataset_id.in_(dataset_ids))
+            )
+        )
+        rows = session.execute(
+            mirror_tag_table.select()
+            .where(mirror_tag_table.c.dataset_id.in_(dataset_ids))
+            .order_by(mirror_tag_table.c.concept_label)
+        )
+        for row in rows:
+            tags.setdefault(row.dataset_id, []).append(_concept_from_row(row))
+        return tags
+    finally:
+        session.close()
+
+
+def get_all_tags(limit=None, offset=0):
+    '''
+    Get the concepts associated with every dataset that has any.
+
+    :rtype: dict where the key is the ID of a dataset and the value is a list
+        of concepts, each a dict with 'uri' and 'label'
+    '''
+    session = meta.create_local_session()
+    try:
+        datasets = session.execute(
+            select([mirror_tag_table.c.dataset_id])
+            .distinct()
+            .order_by(mirror_tag_table.c.dataset_id)
+            .limit(limit)
+            .offset(offset)
+        ).fetchall()
+        dataset_ids = [row.dataset_id for row in datasets]
+
+        tags = OrderedDict((dataset_id, []) for dataset_id in dataset_ids)
+        if dataset_ids:
+            rows = session.execute(
+                mirror_tag_table.select()
+                .where(mirror_tag_table.c.dataset_id.in_(dataset_ids))
+                .order_by(mirror_tag_table.c.concept_label)
+            )
+            for row in rows:
+                tags[row.dataset_id].append(_concept_from_row(row))
+        return tags
+    finally:
+        session.close()
+
+
+def set_tags(dataset_id, concepts):
+    '''
+    Replace the copied concepts of the dataset.
+    '''
+    session = meta.create_local_session()
+    try:
+        _set_tags(session, dataset_id, concepts, datetime.datetime.utcnow())
+        session.commit()
+    except IntegrityError:
+        # Someone else copied the concepts at the same time, which is fine
+        session.rollback()
+    finally:
+        session.close()
+
+
+def forget(dataset_id):
+    '''
+    Remove the copied concepts of the dataset.
+
+    Use this when the concepts have changed in DataOntoSearch, so that they
+    are copied again the next time they are needed.
+    '''
+    session = meta.create_local_session()
+    try:
+        _forget(session, dataset_id)
+        session.commit()
+    finally:
+        session.close()
+
+
+def is_complete():
+    '''
+    Find out whether all datasets' concepts have been copied at least once.
+    '''
+    return get_system_info(_SYNCED_KEY) is not None
+
+
+def sync_all(all_tags):
+    '''
+    Update the copy so that it matches the given concepts for all datasets.
+
+    Only datasets whose concepts have changed are written to.
+
+    :param all_tags: iterable of (dataset ID, list of concepts) for every
+        dataset associated with any concepts in DataOntoSearch
+    :return: the number of datasets that were changed
+    :rtype: int
+    '''
+    now = datetime.datetime.utcnow()
+    session = meta.create_local_session()
+    changed = 0
+    try:
+        # What do we have now?
+        existing = dict()
+        for row in session.execute(mirror_tag_table.select()):
+            existing.setdefault(row.dataset_id, set()).add(
+                (row.concept_uri, row.concept_label)
+            )
+        synced = set(
+            row.dataset_id
+            for row in session.execute(mirror_dataset_table.select())
+        )
+
+        seen = set()
+        for dataset_id, concepts in all_tags:
+            seen.add(dataset_id)
+            wanted = set((c[u'uri'], c[u'label']) for c in concepts)
+            if dataset_id in synced and existing.get(dataset_id) == wanted:
+                continue
+            _set_tags(session, dataset_id, concepts, now)
+            changed += 1
+
+        # Datasets no longer associated with any concepts
+        for dataset_id in (synced | set(existing)) - seen:
+            if existing.get(dataset_id):
+                _set_tags(session, dataset_id, [], now)
+                changed += 1
+
+        session.commit()
+    finally:
+        session.close()
+
+    set_system_info(_SYNCED_KEY, now.isoformat())
+    logger.info(u'Synchronized concepts, %d datasets changed', changed)
+    return changed
+
+
+def _set_tags(session, dataset_id, concepts, now):
+    _forget(session, dataset_id)
+    session.execute(mirror_dataset_table.insert().values(
+        dataset_id=dataset_id,
+        synced=now,
+    ))
+    # The same concept may be listed more than once
+    unique_concepts = OrderedDict((c[u'uri'], c[u'label']) for c in concepts)
+    if unique_concepts:
+        session.execute(mirror_tag_table.insert(), [
+            {
+                u'dataset_id': dataset_id,
+                u'concept_uri': uri,
+                u'concept_label': label,
+            }
+            for uri, label in unique_concepts.items()
+        ])
+
+
+def _forget(session, dataset_id):
+    session.execute(
+        mirror_tag_table.delete()
+        .where(mirror_tag_table.c.dataset_id == dataset_id)
+    )
+    session.execute(
+        mirror_dataset_table.delete()
+        .where(mirror_dataset_table.c.dataset_id == dataset_id)
+    )
+
+
+def _concept_from_row(row):
+    return {
+        u'uri': row.concept_uri,
+        u'label': row.concept_label,
+    }
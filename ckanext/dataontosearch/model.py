@@ -0,0 +1,101 @@
+# encoding: utf-8
+import logging
+import datetime
+
+from sqlalchemy import (
+    Table, Column, Index, UniqueConstraint, types
+)
+
+from ckan.model import meta
+from ckan.model.types import make_uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+# Changes to DataOntoSearch that have yet to be sent. There is at most one entry
+# per operation, dataset and concept, so repeated changes are only sent once.
+outbox_table = Table(
+    u'dataontosearch_outbox',
+    meta.metadata,
+    Column(u'id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column(u'operation', types.UnicodeText, nullable=False),
+    Column(u'dataset_id', types.UnicodeText, nullable=False),
+    Column(u'concept', types.UnicodeText, nullable=False, default=u''),
+    # JSON sent to DataOntoSearch
+    Column(u'payload', types.UnicodeText, nullable=False),
+    Column(u'attempts', types.Integer, nullable=False, default=0),
+    Column(u'last_error', types.UnicodeText),
+    Column(
+        u'created',
+        types.DateTime,
+        nullable=False,
+        default=datetime.datetime.utcnow
+    ),
+    Column(
+        u'next_attempt',
+        types.DateTime,
+        nullable=False,
+        default=datetime.datetime.utcnow
+    ),
+    UniqueConstraint(u'operation', u'dataset_id', u'concept'),
+    Index(u'idx_dataontosearch_outbox_next_attempt', u'next_attempt'),
+)
+
+
+# Changes which were given up on, either because DataOntoSearch rejected them
+# or because they failed too many times. They are kept so they can be looked
+# into, but are never sent again.
+outbox_dead_table = Table(
+    u'dataontosearch_outbox_dead',
+    meta.metadata,
+    Column(u'id', types.UnicodeText, primary_key=True),
+    Column(u'operation', types.UnicodeText, nullable=False),
+    Column(u'dataset_id', types.UnicodeText, nullable=False),
+    Column(u'concept', types.UnicodeText, nullable=False, default=u''),
+    Column(u'payload', types.UnicodeText, nullable=False),
+    Column(u'attempts', types.Integer, nullable=False),
+    Column(u'last_error', types.UnicodeText),
+    Column(u'created', types.DateTime, nullable=False),
+    Column(
+        u'given_up',
+        types.DateTime,
+        nullable=False,
+        default=datetime.datetime.utcnow
+    ),
+)
+
+
+# Local copy of the concepts associated with each dataset in DataOntoSearch.
+# Datasets whose concepts have been copied are listed in mirror_dataset_table,
+# even if they have no concepts.
+mirror_dataset_table = Table(
+    u'dataontosearch_mirror_dataset',
+    meta.metadata,
+    Column(u'dataset_id', types.UnicodeText, primary_key=True),
+    Column(u'synced', types.DateTime, nullable=False),
+)
+
+mirror_tag_table = Table(
+    u'dataontosearch_mirror_tag',
+    meta.metadata,
+    Column(u'dataset_id', types.UnicodeText, primary_key=True),
+    Column(u'concept_uri', types.UnicodeText, primary_key=True),
+    Column(u'concept_label', types.UnicodeText, nullable=False),
+)
+
+
+def setup():
+    '''
+    Create the tables used by this extension, if they do not exist already.
+    '''
+    tables = (
+        outbox_table,
+        outbox_dead_table,
+        mirror_dataset_table,
+        mirror_tag_table,
+    )
+    for table in tables:
+        if not table.exists(meta.engine):
+            logger.debug(u'Creating table %s', table.name)
+            table.create(meta.engine)
@@ -0,0 +1,336 @@
+# encoding: utf-8
+'''
+Outbox for changes which are sent to DataOntoSearch in the background.
+
+Changes are stored in the database as part of the same transaction as the
+change in CKAN that caused them, and are then sent by a CKAN background job.
+Changes that fail are retried later, with an increasing delay between each
+attempt. Run ``paster dataontosearch outbox drain`` periodically (for example
+using cron) to retry them. Changes rejected by DataOntoSearch, and changes that
+fail too many times, are given up on and moved to a separate table.
+'''
+import json
+import logging
+import datetime
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import scoped_session
+
+from ckanext.dataontosearch import mirror
+from ckanext.dataontosearch.cache import bump_generation
+from ckanext.dataontosearch.model import outbox_table, outbox_dead_table
+from ckanext.dataontosearch.utils import (
+    make_tagger_get_request, make_tagger_delete_request,
+    make_tagger_post_request, get_outbox_retry_delay, get_outbox_max_attempts,
+    get_use_mirror, diff_concepts
+)
+
+
+logger = logging.getLogger(__name__)
+
+# How each operation is sent to DataOntoSearch. tag_update is sent as the
+# tag_create and tag_delete operations needed at the time it is sent.
+_OPERATIONS = {
+    u'dataset_delete': (make_tagger_delete_request, u'/dataset'),
+    u'tag_create': (make_tagger_post_request, u'/tag'),
+    u'tag_delete': (make_tagger_delete_request, u'/tag'),
+    u'tag_update': (None, None),
+}
+
+# Operations which cancel out a pending operation of the other kind
+_OPPOSITES = {
+    u'tag_create': u'tag_delete',
+    u'tag_delete': u'tag_create',
+}
+
+# Operations which change the concepts of a dataset
+_TAG_OPERATIONS = (u'tag_create', u'tag_delete', u'tag_update')
+
+# Never wait longer than this between attempts
+_MAX_RETRY_DELAY = 3600
+
+# How many changes to send in one transaction
+_BATCH_SIZE = 100
+
+
+def add(context, operation, dataset_id, payload, concept=u''):
+    '''
+    Queue a change to be sent to DataOntoSearch.
+
+    Any pending change made obsolete by this one is removed. The session is
+    committed right away, unless defer_commit is set in the context, in which
+    case the change is sent once the caller commits the session.
+
+    :param operation: one of 'dataset_delete', 'tag_create', 'tag_delete' and
+        'tag_update'
+    :param dataset_id: ID of the dataset the change is for
+    :param payload: dict to send to DataOntoSearch as JSON. For tag_update,
+        the 'dataset_id' to send, the 'concepts' the dataset should have, and
+        the payload to 'create' tags with, without 'concept'.
+    :param concept: the concept affected by the change, if any
+    '''
+    if operation not in _OPERATIONS:
+        raise ValueError(u'Unknown operation {}'.format(operation))
+
+    session = context.get(u'session', model.Session)
+    table = outbox_table
+
+    obsolete = table.delete().where(table.c.dataset_id == dataset_id)
+    if operation == u'tag_update':
+        # Setting all the concepts makes other changes to them obsolete
+        obsolete = obsolete.where(table.c.operation.in_(_TAG_OPERATIONS))
+    elif operation != u'dataset_delete':
+        # Deleting the dataset makes every other change to it obsolete, but
+        # the other changes only replace changes to the same concept
+        obsolete = obsolete.where(table.c.concept == concept).where(
+            table.c.operation.in_([operation, _OPPOSITES[operation]])
+        )
+    session.execute(obsolete)
+
+    session.execute(table.insert().values(
+        operation=operation,
+        dataset_id=dataset_id,
+        concept=concept,
+        payload=json.dumps(payload),
+    ))
+
+    # Don't let the job look for the change before it has been committed.
+    # (A scoped session must be called to get the session being used.)
+    if isinstance(session, scoped_session):
+        session = session()
+    event.listen(session, u'after_commit', _after_commit, once=True)
+
+    if not context.get(u'defer_commit'):
+        session.commit()
+
+
+def _after_commit(session):
+    enqueue_drain()
+
+
+def enqueue_drain():
+    '''
+    Start a background job sending the changes that are due.
+    '''
+    try:
+        toolkit.enqueue_job(drain, title=u'Send changes to DataOntoSearch')
+    except Exception:
+        # The changes will be sent the next time the outbox is drained
+        logger.warning(
+            u'Could not enqueue job for sending changes to DataOntoSearch',
+            exc_info=True
+        )
+
+
+def drain():
+    '''
+    Send the changes that are due to DataOntoSearch.
+
+    Changes that fail are rescheduled, unless DataOntoSearch rejected them or
+    they have failed too many times, in which case they are given up on.
+    Changes being sent by someone else at the same time are skipped.
+
+    :return: the number of changes that were sent, and the number that failed
+    :rtype: tuple of two ints
+    '''
+    session = model.Session
+    table = outbox_table
+    sent = 0
+    failed = 0
+    started = datetime.datetime.utcnow()
+    max_attempts = get_outbox_max_attempts()
+
+    while True:
+        due = session.execute(_select_due(started)).fetchall()
+        if not due:
+            break
+
+        for change in due:
+            try:
+                _send(change)
+            except Exception as e:
+                failed += 1
+                attempts = change.attempts + 1
+                permanent = isinstance(e, _Rejected)
+                if permanent or attempts >= max_attempts:
+                    logger.error(
+                        u'Giving up on sending %s for %s to DataOntoSearch '
+                        u'after %d attempts',
+                        change.operation,
+                        change.dataset_id,
+                        attempts,
+                        exc_info=True
+                    )
+                    _give_up(session, change, attempts, e)
+                    continue
+
+                logger.warning(
+                    u'Failed to send %s for %s to DataOntoSearch',
+                    change.operation,
+                    change.dataset_id,
+                    exc_info=True
+                )
+                delay = min(
+                    get_outbox_retry_delay() * 2 ** (attempts - 1),
+                    _MAX_RETRY_DELAY
+                )
+                session.execute(
+                    table.update()
+                    .where(table.c.id == change.id)
+                    .values(
+                        attempts=attempts,
+                        last_error=u'{}'.format(e),
+                        next_attempt=(
+                            datetime.datetime.utcnow() +
+                            datetime.timedelta(seconds=delay)
+                        ),
+                    )
+                )
+            else:
+                sent += 1
+                session.execute(
+                    table.delete().where(table.c.id == change.id)
+                )
+                if get_use_mirror():
+                    # Copy the concepts again the next time they are needed
+                    mirror.forget(change.dataset_id)
+        session.commit()
+
+    if sent:
+        # Searches done before these changes may now give different results
+        bump_generation(u'search')
+
+    logger.info(
+        u'Sent %d changes to DataOntoSearch, %d failed',
+        sent,
+        failed
+    )
+    return sent, failed
+
+
+def _select_due(started):
+    # Lock the changes being sent, so that they are only sent once
+    table = outbox_table
+    return select([table])\
+        .where(table.c.next_attempt <= started)\
+        .order_by(table.c.created)\
+        .limit(_BATCH_SIZE)\
+        .with_for_update(skip_locked=True)
+
+
+class _Rejected(Exception):
+    '''
+    DataOntoSearch refused the change, so sending it again will not help.
+    '''
+    pass
+
+
+def _give_up(session, change, attempts, error):
+    session.execute(outbox_dead_table.insert().values(
+        id=change.id,
+        operation=change.operation,
+        dataset_id=change.dataset_id,
+        concept=change.concept,
+        payload=change.payload,
+        attempts=attempts,
+        last_error=u'{}'.format(error),
+        created=change.created,
+    ))
+    session.execute(
+        outbox_table.delete().where(outbox_table.c.id == change.id)
+    )
+
+
+def _send(change):
+    payload = json.loads(change.payload)
+    if change.operation == u'tag_update':
+        _send_tag_update(payload)
+        return
+    make_request, endpoint = _OPERATIONS[change.operation]
+    _send_request(change.operation, make_request, endpoint, payload)
+
+
+def _send_request(operation, make_request, endpoint, payload):
+    r = make_request(endpoint, payload)
+    if r.status_code == 404 and operation != u'tag_create':
+        # There is nothing to delete
+        return
+    if 400 <= r.status_code < 500:
+        raise _Rejected(u'DataOntoSearch answered {}: {}'.format(
+            r.status_code,
+            r.text
+        ))
+    r.raise_for_status()
+    data = r.json()
+
+    # There is nothing to delete if the dataset or tag was not found, so only
+    # failing to create a tag is an error
+    if operation == u'tag_create' and not data[u'success']:
+        raise _Rejected(data[u'message'])
+
+
+def _send_tag_update(payload):
+    # Find out what must be changed now, since what DataOntoSearch has may
+    # have changed since the change was made
+    r = make_tagger_get_request(
+        u'/tag',
+        {u'dataset_id': payload[u'dataset_id']},
+        coalesce=False
+    )
+    r.raise_for_status()
+    data = r.json()
+    existing_concepts = data[u'concepts'] if data is not None else []
+
+    added, removed = diff_concepts(existing_concepts, payload[u'concepts'])
+
+    # Sending the whole change again is safe, so there is nothing to undo if
+    # one of these fails
+    for concept in added:
+        _send_request(
+            u'tag_create',
+            make_tagger_post_request,
+            u'/tag',
+            dict(payload[u'create'], concept=concept)
+        )
+    for concept in removed:
+        _send_request(
+            u'tag_delete',
+            make_tagger_delete_request,
+            u'/tag',
+            {u'dataset_id': payload[u'dataset_id'], u'concept': concept}
+        )
+
+
+def get_status():
+    '''
+    Describe the changes waiting to be sent to DataOntoSearch.
+
+    :rtype: dict with the number of 'pending' changes, how many of them are
+        'due' to be sent now, how many have 'failed' at least once, when the
+        'oldest' change was made (or None), and the number of changes that
+        were 'given_up' on
+    '''
+    table = outbox_table
+    now = datetime.datetime.utcnow()
+
+    pending, due, failed, oldest = model.Session.execute(select([
+        func.count(),
+        func.count().filter(table.c.next_attempt <= now),
+        func.count().filter(table.c.attempts > 0),
+        func.min(table.c.created),
+    ]).select_from(table)).fetchone()
+
+    given_up = model.Session.execute(
+        select([func.count()]).select_from(outbox_dead_table)
+    ).scalar()
+
+    return {
+        u'pending': pending,
+        u'due': due,
+        u'failed': failed,
+        u'oldest': oldest.isoformat() if oldest is not None else None,
+        u'given_up': given_up,
+    }
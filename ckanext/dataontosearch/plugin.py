@@ -4,8 +4,12 @@ import ckan.plugins.toolkit as toolkit
 
 import ckanext.dataontosearch.logic as logic
 import ckanext.dataontosearch.auth as auth
+import ckanext.dataontosearch.model as model
+from ckanext.dataontosearch import memo
+from ckanext.dataontosearch.utils import get_use_outbox
 from ckanext.dataontosearch.views.tagger import tagger as tagger_blueprint
 from ckanext.dataontosearch.views.search import search as search_blueprint
+from ckanext.dataontosearch.views.metrics import metrics as metrics_blueprint
 
 
 class DataOntoSearch_TaggingPlugin(
@@ -15,6 +19,7 @@ class DataOntoSearch_TaggingPlugin(
     Plugin for tagging datasets with relevant concepts.
     """
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IPackageController, inherit=True)
@@ -24,18 +29,32 @@ class DataOntoSearch_TaggingPlugin(
 
     def update_config(self, config_):
         toolkit.add_template_directory(config_, u'templates-tagger')
+        toolkit.add_template_directory(config_, u'templates')
         toolkit.add_public_directory(config_, u'public')
         toolkit.add_resource(u'fanstatic', u'dataontosearch')
 
+    # IConfigurable
+
+    def configure(self, config_):
+        model.setup()
+        memo.watch_permissions()
+
     # IActions
 
     def get_actions(self):
         return {
             u'dataontosearch_concept_list': logic.dataontosearch_concept_list,
+            u'dataontosearch_concept_autocomplete':
+                logic.dataontosearch_concept_autocomplete,
+            u'dataontosearch_cache_clear': logic.dataontosearch_cache_clear,
+            u'dataontosearch_outbox_status':
+                logic.dataontosearch_outbox_status,
             u'dataontosearch_tag_list_all': logic.dataontosearch_tag_list_all,
+            u'dataontosearch_mirror_sync': logic.dataontosearch_mirror_sync,
             u'dataontosearch_tag_list': logic.dataontosearch_tag_list,
             u'dataontosearch_tag_create': logic.dataontosearch_tag_create,
             u'dataontosearch_tag_delete': logic.dataontosearch_tag_delete,
+            u'dataontosearch_tag_update': logic.dataontosearch_tag_update,
             u'dataontosearch_dataset_delete':
                 logic.dataontosearch_dataset_delete,
         }
@@ -45,26 +64,48 @@ class DataOntoSearch_TaggingPlugin(
     def get_auth_functions(self):
         return {
             u'dataontosearch_concept_list': auth.dataontosearch_concept_list,
+            u'dataontosearch_concept_autocomplete':
+                auth.dataontosearch_concept_autocomplete,
+            u'dataontosearch_cache_clear': auth.dataontosearch_cache_clear,
+            u'dataontosearch_outbox_status':
+                auth.dataontosearch_outbox_status,
             u'dataontosearch_tag_list_all': auth.dataontosearch_tag_list_all,
+            u'dataontosearch_mirror_sync': auth.dataontosearch_mirror_sync,
+            u'dataontosearch_metrics': auth.dataontosearch_metrics,
             u'dataontosearch_tag_list': auth.dataontosearch_tag_list,
             u'dataontosearch_tag_create': auth.dataontosearch_tag_create,
             u'dataontosearch_tag_delete': auth.dataontosearch_tag_delete,
+            u'dataontosearch_tag_update': auth.dataontosearch_tag_update,
             u'dataontosearch_dataset_delete':
                 auth.dataontosearch_dataset_delete,
         }
 
     # IPackageController
 
+    def edit(self, entity):
+        # What we remember about the dataset may now be outdated
+        memo.forget(entity.id)
+
     def delete(self, entity):
+        memo.forget(entity.id)
+
         # Delete dataset from DataOntoSearch when it is deleted from CKAN
-        toolkit.get_action(u'dataontosearch_dataset_delete')(None, {
-            u'id': entity.id
-        })
+        if get_use_outbox():
+            # Let CKAN commit the change along with the deletion, and have it
+            # sent to DataOntoSearch in the background
+            toolkit.get_action(u'dataontosearch_dataset_delete')(
+                {u'defer_commit': True},
+                {u'id': entity.id, u'defer': True}
+            )
+        else:
+            toolkit.get_action(u'dataontosearch_dataset_delete')(None, {
+                u'id': entity.id
+            })
 
     # IBlueprint
 
     def get_blueprint(self):
-        return tagger_blueprint
+        return [tagger_blueprint, metrics_blueprint]
 
 
 class DataOntoSearch_SearchingPlugin(plugins.SingletonPlugin):
@@ -80,6 +121,7 @@ class DataOntoSearch_SearchingPlugin(plugins.SingletonPlugin):
 
     def update_config(self, config_):
         toolkit.add_template_directory(config_, u'templates-search')
+        toolkit.add_template_directory(config_, u'templates')
         toolkit.add_public_directory(config_, u'public')
         toolkit.add_resource(u'fanstatic', u'dataontosearch')
 
@@ -89,6 +131,8 @@ class DataOntoSearch_SearchingPlugin(plugins.SingletonPlugin):
         return {
             u'dataontosearch_dataset_search':
                 logic.dataontosearch_dataset_search,
+            u'dataontosearch_hybrid_search':
+                logic.dataontosearch_hybrid_search,
         }
 
     # IAuthFunctions
@@ -97,6 +141,8 @@ class DataOntoSearch_SearchingPlugin(plugins.SingletonPlugin):
         return {
             u'dataontosearch_dataset_search':
                 auth.dataontosearch_dataset_search,
+            u'dataontosearch_hybrid_search':
+                auth.dataontosearch_hybrid_search,
         }
 
     # IBlueprint
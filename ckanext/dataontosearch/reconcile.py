@@ -0,0 +1,305 @@
+# encoding: utf-8
+'''
+Find and fix differences between the datasets in CKAN and in DataOntoSearch.
+
+Reconciling happens in two phases:
+
+1. Orphans: datasets in DataOntoSearch which no longer exist in CKAN (or have
+   been deleted) are removed from DataOntoSearch. Draft and private datasets
+   are not orphans. Only URIs this CKAN would
+   generate for a dataset are considered, so datasets from other catalogs
+   sharing the configuration, and datasets with a URI of their own (like
+   harvested ones), are left alone.
+2. Missing: when the local copy of concepts is enabled, concepts it has for a
+   dataset but which DataOntoSearch does not have, are added to DataOntoSearch.
+
+The work is done in chunks, and progress is saved to a checkpoint file after
+each chunk, so that an interrupted run can be resumed. Changes that fail are
+saved in the checkpoint too, and are tried again when the run is resumed.
+'''
+import os
+import json
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckanext.dcat.utils import catalog_uri
+
+from ckanext.dataontosearch import mirror
+from ckanext.dataontosearch.cache import bump_generation
+from ckanext.dataontosearch.logic import make_tag_create_payload
+from ckanext.dataontosearch.utils import (
+    make_tagger_get_request, make_tagger_delete_request,
+    make_tagger_post_request, response_json, get_use_mirror
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    '''
+    Let at most rate calls to wait() return per second, across all threads.
+    '''
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            wait_until = max(self._next, now)
+            self._next = wait_until + self.interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+class Reconciler(object):
+    '''
+    Reconcile CKAN with DataOntoSearch, see the module documentation.
+
+    :param checkpoint_path: file to save progress to
+    :param workers: number of requests to send to DataOntoSearch at a time
+    :param rate: maximum number of requests to send per second, 0 for no limit
+    :param chunk_size: number of datasets to handle at a time
+    :param dry_run: only report what would be changed
+    :param out: function called with each line of progress report
+    '''
+    def __init__(self, checkpoint_path, workers=4, rate=10., chunk_size=500,
+                 dry_run=False, out=None):
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.out = out or logger.info
+
+        self.checkpoint = {
+            u'phase': u'orphans',
+            u'last_key': None,
+            u'checked': 0,
+            u'changed': 0,
+            u'failed': 0,
+            # Changes that failed in each phase, to try again when resuming
+            u'retry': {u'orphans': [], u'missing': []},
+        }
+        self._started = None
+        self._checked_before = 0
+
+    def run(self, resume=False):
+        if resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.checkpoint = json.load(f)
+            # Checkpoints saved before failed changes were remembered
+            self.checkpoint.setdefault(
+                u'retry',
+                {u'orphans': [], u'missing': []}
+            )
+            self.out(u'Resuming from {}'.format(self.checkpoint))
+
+        self._started = time.time()
+        self._checked_before = self.checkpoint[u'checked']
+
+        r = make_tagger_get_request(u'/tag')
+        r.raise_for_status()
+        tagger_data = response_json(r)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self._retry_failed(executor)
+
+            if self.checkpoint[u'phase'] == u'orphans':
+                self._remove_orphans(executor, tagger_data)
+                self._next_phase(u'missing')
+
+            if self.checkpoint[u'phase'] == u'missing':
+                if get_use_mirror() and mirror.is_complete():
+                    self._push_missing(executor, tagger_data)
+                else:
+                    self.out(
+                        u'Skipping missing datasets, since the local copy of '
+                        u'concepts is not enabled or not synchronized'
+                    )
+                self._next_phase(u'done')
+
+        if self.checkpoint[u'changed'] and not self.dry_run:
+            bump_generation(u'search')
+
+        self.out(u'Done: checked {checked}, changed {changed}, failed '
+                 u'{failed}'.format(**self.checkpoint))
+        return self.checkpoint
+
+    def _remove_orphans(self, executor, tagger_data):
+        uris = sorted(tagger_data.keys())
+        last_key = self.checkpoint[u'last_key']
+        if last_key is not None:
+            uris = [uri for uri in uris if uri > last_key]
+
+        # The URI ckanext-dcat generates for a dataset without a URI of its own
+        prefix = u'{}/dataset/'.format(catalog_uri().rstrip(u'/'))
+
+        for offset in range(0, len(uris), self.chunk_size):
+            chunk = uris[offset:offset + self.chunk_size]
+            generated = [
+                uri for uri in chunk
+                if uri.startswith(prefix) and u'/' not in uri[len(prefix):]
+            ]
+            dataset_ids = [uri[len(prefix):] for uri in generated]
+
+            found = set()
+            if dataset_ids:
+                query = model.Session.query(
+                    model.Package.id,
+                    model.Package.name
+                ).filter(model.Package.state != u'deleted').filter(
+                    model.Package.id.in_(dataset_ids) |
+                    model.Package.name.in_(dataset_ids)
+                )
+                for package_id, package_name in query:
+                    found.add(package_id)
+                    found.add(package_name)
+
+            orphans = [
+                uri for uri, dataset_id in zip(generated, dataset_ids)
+                if dataset_id not in found
+            ]
+            self._apply(executor, u'orphans', orphans)
+            self._chunk_done(len(chunk), chunk[-1])
+
+    def _remove_orphan(self, uri):
+        r = make_tagger_delete_request(u'/dataset', {u'dataset_id': uri})
+        r.raise_for_status()
+
+    def _push_missing(self, executor, tagger_data):
+        # What does DataOntoSearch have for each dataset?
+        tagger_concepts = dict()
+        for uri, details in tagger_data.items():
+            tagger_concepts[uri.split(u'/')[-1]] = set(
+                c[u'uri'] for c in details[u'concepts']
+            )
+
+        last_key = self.checkpoint[u'last_key']
+        while True:
+            # Stream the packages in chunks, ordered by ID
+            query = model.Session.query(model.Package.id, model.Package.name)\
+                .filter(model.Package.state != u'deleted')\
+                .order_by(model.Package.id)
+            if last_key is not None:
+                query = query.filter(model.Package.id > last_key)
+            chunk = query.limit(self.chunk_size).all()
+            if not chunk:
+                break
+
+            mirrored = mirror.get_tags_for([row[0] for row in chunk])
+
+            changes = []
+            for package_id, package_name in chunk:
+                concepts = mirrored.get(package_id) or []
+                existing = tagger_concepts.get(package_id) or \
+                    tagger_concepts.get(package_name) or set()
+                missing = [
+                    c[u'uri'] for c in concepts if c[u'uri'] not in existing
+                ]
+                if missing:
+                    dataset = toolkit.get_action(u'package_show')(
+                        {u'ignore_auth': True},
+                        {u'id': package_id}
+                    )
+                    changes.extend(
+                        make_tag_create_payload(dataset, concept)
+                        for concept in missing
+                    )
+
+            self._apply(executor, u'missing', changes)
+            last_key = chunk[-1][0]
+            self._chunk_done(len(chunk), last_key)
+
+    def _push_tag(self, payload):
+        r = make_tagger_post_request(u'/tag', payload)
+        r.raise_for_status()
+        data = r.json()
+        if not data[u'success']:
+            raise RuntimeError(data[u'message'])
+
+    def _retry_failed(self, executor):
+        for phase in (u'orphans', u'missing'):
+            items = self.checkpoint[u'retry'][phase]
+            if items:
+                self.out(u'Retrying {} failed changes from {}'.format(
+                    len(items),
+                    phase
+                ))
+                self.checkpoint[u'retry'][phase] = []
+                self._apply(executor, phase, items)
+        self._save_checkpoint()
+
+    def _apply(self, executor, phase, items):
+        '''
+        Apply the changes of the phase to the items, remembering the items
+        that failed so they can be tried again.
+        '''
+        f = {
+            u'orphans': self._remove_orphan,
+            u'missing': self._push_tag,
+        }[phase]
+
+        if self.dry_run:
+            for item in items:
+                self.out(u'Would apply {} to {}'.format(f.__name__, item))
+            self.checkpoint[u'changed'] += len(items)
+            return
+
+        def rate_limited(item):
+            self.rate_limiter.wait()
+            return f(item)
+
+        futures = [executor.submit(rate_limited, item) for item in items]
+        for item, future in zip(items, futures):
+            try:
+                future.result()
+                self.checkpoint[u'changed'] += 1
+            except Exception:
+                logger.warning(
+                    u'Failed to apply %s to %s',
+                    f.__name__,
+                    item,
+                    exc_info=True
+                )
+                self.checkpoint[u'retry'][phase].append(item)
+
+        self.checkpoint[u'failed'] = sum(
+            len(failed) for failed in self.checkpoint[u'retry'].values()
+        )
+
+    def _chunk_done(self, count, last_key):
+        self.checkpoint[u'checked'] += count
+        self.checkpoint[u'last_key'] = last_key
+        self._save_checkpoint()
+
+        elapsed = time.time() - self._started
+        checked = self.checkpoint[u'checked'] - self._checked_before
+        self.out(
+            u'{phase}: checked {checked}, changed {changed}, failed {failed} '
+            u'({rate:.1f} datasets/s)'.format(
+                rate=checked / elapsed if elapsed else 0.,
+                **self.checkpoint
+            )
+        )
+
+    def _next_phase(self, phase):
+        self.checkpoint[u'phase'] = phase
+        self.checkpoint[u'last_key'] = None
+        self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        if self.dry_run:
+            return
+        # Write to a temporary file first, so the checkpoint is never corrupt
+        temporary_path = self.checkpoint_path + u'.tmp'
+        with open(temporary_path, u'w') as f:
+            json.dump(self.checkpoint, f)
+        os.rename(temporary_path, self.checkpoint_path)
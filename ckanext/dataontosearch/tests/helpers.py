@@ -0,0 +1,66 @@
+"""Helpers shared by the tests."""
+from sqlalchemy import Column, MetaData, Table, create_engine, types
+from sqlalchemy.orm import mapper, scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+
+class Clock(object):
+    '''
+    A clock which only moves when told to, by adding to now.
+
+    It can be called like time.time, or stand in for the time module.
+    '''
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def make_engine(*tables):
+    '''
+    Create an in-memory database with the given tables, which every session
+    bound to it shares.
+    '''
+    engine = create_engine(u'sqlite://', poolclass=StaticPool)
+    for table in tables:
+        table.create(engine)
+    return engine
+
+
+package_table = Table(
+    u'package',
+    MetaData(),
+    Column(u'id', types.UnicodeText, primary_key=True),
+    Column(u'name', types.UnicodeText),
+    Column(u'state', types.UnicodeText),
+    Column(u'private', types.Boolean, default=False),
+    Column(u'owner_org', types.UnicodeText),
+)
+
+
+class Package(object):
+    pass
+
+
+mapper(Package, package_table)
+
+
+class FakeModel(object):
+    '''
+    Stands in for the CKAN model, with just the packages.
+
+    :param packages: dicts with the columns of each package
+    '''
+    def __init__(self, packages):
+        self.Package = Package
+        self.Session = scoped_session(sessionmaker(
+            bind=make_engine(package_table)
+        ))
+        # One at a time, since the packages may not all give every column
+        for package in packages:
+            self.Session.execute(package_table.insert().values(**package))
+        self.Session.commit()
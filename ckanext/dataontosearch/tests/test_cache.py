@@ -0,0 +1,76 @@
+"""Tests for cache.py."""
+import mock
+
+import ckanext.dataontosearch.cache as cache
+from ckanext.dataontosearch.tests.helpers import Clock
+
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    with mock.patch.object(cache, u'time', clock):
+        c = cache.TTLCache(ttl=60, max_size=3)
+        c.set(u'a', 1)
+        clock.now += 59
+        assert c.get(u'a') == 1
+        clock.now += 1
+        assert c.get(u'a') is None
+        # The stale entry is still there for revalidation
+        assert c.lookup(u'a').value == 1
+        assert c.hits == 1
+        assert c.misses == 1
+
+
+def test_least_recently_used_is_evicted():
+    clock = Clock()
+    with mock.patch.object(cache, u'time', clock):
+        c = cache.TTLCache(ttl=60, max_size=3)
+        c.set(u'a', 1)
+        c.set(u'b', 2)
+        c.set(u'c', 3)
+        # Using a makes b the least recently used
+        c.get(u'a')
+        c.set(u'd', 4)
+        assert c.get(u'b') is None
+        assert [c.get(k) for k in (u'a', u'c', u'd')] == [1, 3, 4]
+        assert len(c) == 3
+
+
+def test_entries_evicted_by_weight():
+    clock = Clock()
+    with mock.patch.object(cache, u'time', clock):
+        c = cache.TTLCache(ttl=60, max_size=10, weigh=len, max_weight=5)
+        c.set(u'a', u'xx')
+        c.set(u'b', u'xx')
+        c.set(u'c', u'xx')
+        assert c.get(u'a') is None
+        assert c.get(u'b') == u'xx'
+        assert c.get(u'c') == u'xx'
+
+        # Replacing an entry does not count its old weight
+        c.set(u'c', u'x')
+        assert c.get(u'b') == u'xx'
+
+        # Too heavy to be cached at all, so nothing is evicted for it
+        c.set(u'd', u'xxxxxx')
+        assert c.get(u'd') is None
+        assert c.get(u'b') == u'xx'
+
+
+def test_touch_extends_expiry():
+    clock = Clock()
+    with mock.patch.object(cache, u'time', clock):
+        c = cache.TTLCache(ttl=60, max_size=3)
+        c.set(u'a', 1, etag=u'"v1"')
+        clock.now += 61
+        assert c.get(u'a') is None
+        c.touch(u'a')
+        clock.now += 59
+        assert c.get(u'a') == 1
+        assert c.lookup(u'a').etag == u'"v1"'
+
+
+def test_nothing_cached_when_disabled():
+    c = cache.TTLCache(ttl=0, max_size=3)
+    c.set(u'a', 1)
+    assert c.get(u'a') is None
+    assert len(c) == 0
@@ -0,0 +1,87 @@
+"""Tests for concept_index.py."""
+from ckanext.dataontosearch import concept_index
+from ckanext.dataontosearch.concept_index import ConceptIndex
+
+concepts = {
+    u'http://example.com/onto#WaterQuality': u'Water quality',
+    u'http://example.com/onto#AirQuality': u'Air quality',
+    u'http://example.com/onto#Waterways': u'Waterways',
+    u'http://example.com/onto#Groundwater': u'Groundwater',
+    u'http://example.com/onto#QualityOfLife': u'Quality of life',
+    u'http://example.com/onto#BusStops': u'Bus stops',
+}
+
+
+def _labels(found):
+    return [label for _, label in found]
+
+
+def test_prefix_then_word_then_substring():
+    index = ConceptIndex(concepts)
+    assert _labels(index.search(u'wat')) == [
+        # Labels starting with the text, sorted by label
+        u'Water quality',
+        u'Waterways',
+        # Labels containing the text elsewhere
+        u'Groundwater',
+    ]
+    assert _labels(index.search(u'qual')) == [
+        u'Quality of life',
+        # Labels with a later word starting with the text
+        u'Air quality',
+        u'Water quality',
+    ]
+
+
+def test_case_and_whitespace_ignored():
+    index = ConceptIndex(concepts)
+    assert _labels(index.search(u'  STOP ')) == [u'Bus stops']
+
+
+def test_returns_uri_and_label():
+    index = ConceptIndex(concepts)
+    assert index.search(u'bus') == [
+        (u'http://example.com/onto#BusStops', u'Bus stops')
+    ]
+
+
+def test_limit():
+    index = ConceptIndex(concepts)
+    assert _labels(index.search(u'qual', limit=2)) == [
+        u'Quality of life',
+        u'Air quality',
+    ]
+    assert index.search(u'qual', limit=0) == []
+
+
+def test_empty_text_gives_first_concepts():
+    index = ConceptIndex(concepts)
+    assert _labels(index.search(u'', limit=2)) == [
+        u'Air quality',
+        u'Bus stops',
+    ]
+
+
+def test_no_match():
+    assert ConceptIndex(concepts).search(u'xyz') == []
+
+
+def test_index_rebuilt_only_for_new_concepts():
+    index = concept_index.get_index(concepts)
+    assert concept_index.get_index(concepts) is index
+    assert concept_index.get_index(dict(concepts)) is not index
+
+
+def test_find_by_label_only_matches_whole_label():
+    index = ConceptIndex(dict(
+        concepts,
+        **{u'http://example.com/other#Waterways': u'waterways'}
+    ))
+    assert index.find_by_label(u' WATERWAYS ') == [
+        (u'http://example.com/onto#Waterways', u'Waterways'),
+        (u'http://example.com/other#Waterways', u'waterways'),
+    ]
+    assert index.find_by_label(u'Bus stops') == [
+        (u'http://example.com/onto#BusStops', u'Bus stops'),
+    ]
+    assert index.find_by_label(u'Bus') == []
@@ -0,0 +1,611 @@
+"""Tests for logic.py."""
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.dataontosearch.logic as logic
+from ckanext.dataontosearch.logic import _fuse_rankings, _RRF_K
+from ckanext.dataontosearch.tests.helpers import FakeModel
+
+dataset = {
+    u'id': u'6f1c3c2e-0d0a-4b5e-9a7e-3b0cdbf5d6a1',
+    u'name': u'example-dataset',
+}
+
+water = {u'uri': u'http://example.com/onto#Water', u'label': u'Water'}
+air = {u'uri': u'http://example.com/onto#Air', u'label': u'Air'}
+soil = {u'uri': u'http://example.com/onto#Soil', u'label': u'Soil'}
+
+
+def _ids(ranked):
+    return [dataset[u'id'] for dataset, _ in ranked]
+
+
+def test_datasets_in_both_rankings_come_first():
+    regular = [{u'id': u'a'}, {u'id': u'b'}, {u'id': u'c'}]
+    semantic = [{u'id': u'd'}, {u'id': u'c'}]
+
+    ranked = _fuse_rankings([regular, semantic])
+
+    assert _ids(ranked) == [u'c', u'a', u'd', u'b']
+    scores = dict((dataset[u'id'], score) for dataset, score in ranked)
+    assert scores[u'c'] == 1. / (_RRF_K + 3) + 1. / (_RRF_K + 2)
+    assert scores[u'a'] == 1. / (_RRF_K + 1)
+
+
+def test_each_dataset_included_once_using_last_dict():
+    regular = [{u'id': u'a'}]
+    semantic = [{u'id': u'a', u'score': 0.9}]
+
+    ranked = _fuse_rankings([regular, semantic])
+
+    assert ranked == [({u'id': u'a', u'score': 0.9}, 2. / (_RRF_K + 1))]
+
+
+def test_ties_keep_order_of_first_ranking():
+    regular = [{u'id': u'a'}, {u'id': u'b'}]
+    semantic = [{u'id': u'c'}, {u'id': u'd'}]
+
+    ranked = _fuse_rankings([regular, semantic])
+
+    assert _ids(ranked) == [u'a', u'c', u'b', u'd']
+
+
+def test_empty_rankings():
+    assert _fuse_rankings([[], []]) == []
+
+
+class _FakeTagger(object):
+    '''
+    Stands in for the requests made by dataontosearch_tag_update.
+    '''
+    def __init__(self, existing, fail_on=None):
+        self.existing = existing
+        self.fail_on = fail_on
+        self.calls = []
+
+    def get_tags(self, dataset, coalesce=True):
+        return list(self.existing)
+
+    def create_tag(self, dataset, concept):
+        self.calls.append((u'create', concept))
+        if concept == self.fail_on:
+            raise RuntimeError(u'Could not create')
+        return u'tag-id'
+
+    def delete_tag(self, dataset, concept):
+        self.calls.append((u'delete', concept))
+        return concept != self.fail_on
+
+    def patch(self):
+        return [
+            mock.patch.object(toolkit, u'check_access'),
+            mock.patch.object(
+                logic.memo,
+                u'show_dataset',
+                lambda id_or_name: dataset
+            ),
+            mock.patch.object(logic, u'_get_tags', self.get_tags),
+            mock.patch.object(logic, u'_create_tag', self.create_tag),
+            mock.patch.object(logic, u'_delete_tag', self.delete_tag),
+            mock.patch.object(logic, u'_tags_changed'),
+            mock.patch.object(logic, u'get_use_outbox', lambda: False),
+        ]
+
+
+def _tag_update(tagger, concepts):
+    patches = tagger.patch()
+    for patch in patches:
+        patch.start()
+    try:
+        return logic.dataontosearch_tag_update({}, {
+            u'dataset': dataset[u'name'],
+            u'concepts': concepts,
+        })
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+
+def test_tag_update_only_sends_differences():
+    tagger = _FakeTagger([water, air])
+
+    # Concepts can be given by URI or label, and more than once
+    result = _tag_update(
+        tagger,
+        [water[u'label'], soil[u'uri'], soil[u'uri'], soil[u'uri']]
+    )
+
+    assert result == {
+        u'dataset': dataset[u'id'],
+        u'added': [soil[u'uri']],
+        u'removed': [air[u'uri']],
+    }
+    # Added before removed, since that is less destructive
+    assert tagger.calls == [
+        (u'create', soil[u'uri']),
+        (u'delete', air[u'uri']),
+    ]
+
+
+def test_tag_update_without_changes_sends_nothing():
+    tagger = _FakeTagger([water])
+    result = _tag_update(tagger, [water[u'uri']])
+    assert result[u'added'] == [] and result[u'removed'] == []
+    assert tagger.calls == []
+
+
+def test_tag_update_reverts_changes_when_one_fails():
+    tagger = _FakeTagger([water, air], fail_on=air[u'uri'])
+
+    try:
+        _tag_update(tagger, [soil[u'uri'], water[u'uri']])
+        assert False, u'The failure was not raised'
+    except RuntimeError:
+        pass
+
+    assert tagger.calls == [
+        (u'create', soil[u'uri']),
+        # Fails
+        (u'delete', air[u'uri']),
+        # Undo what was done, once
+        (u'delete', soil[u'uri']),
+    ]
+
+
+def test_tag_update_reverts_in_reverse_order():
+    tagger = _FakeTagger([], fail_on=soil[u'uri'])
+
+    try:
+        _tag_update(tagger, [water[u'uri'], air[u'uri'], soil[u'uri']])
+        assert False, u'The failure was not raised'
+    except RuntimeError:
+        pass
+
+    assert tagger.calls == [
+        (u'create', water[u'uri']),
+        (u'create', air[u'uri']),
+        (u'create', soil[u'uri']),
+        (u'delete', air[u'uri']),
+        (u'delete', water[u'uri']),
+    ]
+
+
+def test_deferred_tag_update_queues_concepts_without_asking():
+    tagger = _FakeTagger([water])
+    patches = tagger.patch() + [
+        mock.patch.object(logic, u'_get_tags', side_effect=AssertionError),
+        mock.patch.object(logic.outbox, u'add'),
+        mock.patch.object(
+            logic,
+            u'make_tag_create_payload',
+            lambda dataset, concept: {u'dataset_url': u'x', u'concept': None}
+        ),
+        mock.patch.object(logic.memo, u'get_dataset_uri', lambda d: u'uri'),
+    ]
+    for patch in patches:
+        patch.start()
+    try:
+        result = logic.dataontosearch_tag_update({}, {
+            u'dataset': dataset[u'name'],
+            u'concepts': [air[u'uri'], water[u'uri'], air[u'uri']],
+            u'defer': True,
+        })
+        logic.outbox.add.assert_called_once_with(
+            {},
+            u'tag_update',
+            dataset[u'id'],
+            {
+                u'dataset_id': u'uri',
+                u'concepts': [air[u'uri'], water[u'uri']],
+                u'create': {u'dataset_url': u'x'},
+            }
+        )
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+    assert result == {
+        u'dataset': dataset[u'id'],
+        u'added': None,
+        u'removed': None,
+    }
+    assert tagger.calls == []
+
+
+def _make_tag_create_payload(send_rdf, serializer, dataset):
+    url_for = mock.Mock(return_value=u'http://ckan.example.com/dataset/a')
+    with mock.patch.object(logic, u'get_send_rdf', lambda: send_rdf), \
+            mock.patch.object(logic, u'RDFSerializer', serializer), \
+            mock.patch.object(toolkit, u'url_for', url_for, create=True):
+        return logic.make_tag_create_payload(dataset, water[u'uri'])
+
+
+def test_tag_create_payload_with_rdf_url():
+    serializer = mock.Mock()
+    payload = _make_tag_create_payload(False, serializer, dataset)
+    assert payload == {
+        u'dataset_url': u'http://ckan.example.com/dataset/a.rdf',
+        u'concept': water[u'uri'],
+    }
+    assert not serializer.called
+
+
+def test_tag_create_payload_with_rdf_serialized_once():
+    serializer = mock.Mock()
+    serializer.return_value.serialize_dataset.return_value = u'<rdf:RDF/>'
+    logic.invalidate_caches(u'rdf')
+    modified = dict(dataset, metadata_modified=u'2020-01-02T03:04:05')
+
+    payload = _make_tag_create_payload(True, serializer, modified)
+    assert payload == {
+        u'dataset_rdf': u'<rdf:RDF/>',
+        u'concept': water[u'uri'],
+    }
+    _make_tag_create_payload(True, serializer, modified)
+    assert serializer.return_value.serialize_dataset.call_count == 1
+
+    # Serialized again once the dataset is modified
+    modified[u'metadata_modified'] = u'2020-01-02T03:04:06'
+    _make_tag_create_payload(True, serializer, modified)
+    assert serializer.return_value.serialize_dataset.call_count == 2
+
+
+def _fake_model(packages):
+    '''
+    Stands in for the CKAN model, with packages as (id, name) pairs.
+    '''
+    fake_model = mock.Mock()
+    fake_model.Session.query.return_value.filter.return_value = packages
+    return fake_model
+
+
+def test_tag_list_all_keyed_and_ordered_like_mirror():
+    base = u'http://ckan.example.com/dataset/'
+    data = {
+        # Known by name, but keyed by ID
+        base + u'zebra': {u'concepts': [water]},
+        base + u'b-id': {u'concepts': [soil, air]},
+        # Known by both name and ID
+        base + u'a-id': {u'concepts': [water]},
+        base + u'apple': {u'concepts': [water, soil]},
+        base + u'c-id': {u'concepts': []},
+        base + u'unknown': {u'concepts': [air]},
+    }
+    fake_model = _fake_model([
+        (u'a-id', u'apple'),
+        (u'b-id', u'banana'),
+        (u'c-id', u'cherry'),
+        (u'z-id', u'zebra'),
+    ])
+    response = mock.Mock()
+
+    with mock.patch.object(toolkit, u'check_access'), \
+            mock.patch.object(logic, u'get_use_mirror', lambda: False), \
+            mock.patch.object(logic, u'or_'), \
+            mock.patch.object(logic, u'make_tagger_get_request',
+                              return_value=response), \
+            mock.patch.object(logic, u'response_json', return_value=data):
+        context = {u'model': fake_model}
+        all_tags = logic.dataontosearch_tag_list_all(context, {})
+        page = logic.dataontosearch_tag_list_all(context, {
+            u'limit': 1,
+            u'offset': 1,
+        })
+
+    assert list(all_tags.items()) == [
+        (u'a-id', [soil, water]),
+        (u'b-id', [air, soil]),
+        (u'z-id', [water]),
+    ]
+    assert list(page.items()) == [(u'b-id', [air, soil])]
+
+
+other = {
+    u'id': u'0c6c3bb3-3f5e-4b1a-8a55-1d5b6f0cba0f',
+    u'name': u'other-dataset',
+}
+
+
+def _tag_list_many(ids, tags, fail_for=()):
+    '''
+    List the concepts of many datasets, with tags mapping dataset IDs to their
+    concepts in DataOntoSearch.
+    '''
+    def package_search(context, data_dict):
+        # Find the datasets whose ID or name is searched for
+        results = [
+            d for d in (dataset, other)
+            if u'"{}"'.format(d[u'id']) in data_dict[u'fq'] or
+            u'"{}"'.format(d[u'name']) in data_dict[u'fq']
+        ]
+        return {u'count': len(results), u'results': results}
+
+    def get_tags(d, coalesce=True):
+        if d[u'id'] in fail_for:
+            raise RuntimeError(u'Could not fetch')
+        return tags[d[u'id']]
+
+    with mock.patch.object(toolkit, u'check_access'), \
+            mock.patch.object(toolkit, u'get_action', create=True,
+                              return_value=package_search), \
+            mock.patch.object(logic, u'get_use_mirror', lambda: False), \
+            mock.patch.object(logic, u'get_parallel_requests', lambda: 2), \
+            mock.patch.object(logic, u'_get_tags', get_tags):
+        return logic.dataontosearch_tag_list({u'user': u'someone'}, {
+            u'ids': ids,
+        })
+
+
+def test_tag_list_many_keyed_as_given():
+    tags = {dataset[u'id']: [water], other[u'id']: [air, soil]}
+
+    assert _tag_list_many(dataset[u'name'], tags) == {
+        dataset[u'name']: [water],
+    }
+    assert _tag_list_many([dataset[u'id'], other[u'name']], tags) == {
+        dataset[u'id']: [water],
+        other[u'name']: [air, soil],
+    }
+
+
+def test_tag_list_many_leaves_out_unknown_ids():
+    tags = {dataset[u'id']: [water]}
+    assert _tag_list_many([u'unknown', dataset[u'id']], tags) == {
+        dataset[u'id']: [water],
+    }
+    assert _tag_list_many([u'unknown'], tags) == {}
+
+
+def test_tag_list_many_leaves_out_failed_lookups():
+    tags = {dataset[u'id']: [water], other[u'id']: [air]}
+
+    assert _tag_list_many(
+        [dataset[u'id'], other[u'id']],
+        tags,
+        fail_for=[other[u'id']]
+    ) == {dataset[u'id']: [water]}
+
+    # Unless all of them failed
+    try:
+        _tag_list_many([other[u'id']], tags, fail_for=[other[u'id']])
+        assert False, u'The failure was not raised'
+    except RuntimeError:
+        pass
+
+
+class _FakeLabels(object):
+    '''
+    Gives out permission labels like CKAN does by default, with memberships
+    mapping user names to the organizations they are members of.
+    '''
+    def __init__(self, memberships):
+        self.memberships = memberships
+
+    def get_dataset_labels(self, package):
+        if package.private:
+            return [u'member-{}'.format(package.owner_org)]
+        return [u'public']
+
+    def get_user_dataset_labels(self, user_obj):
+        if user_obj is None:
+            return [u'public']
+        return [u'public'] + [
+            u'member-{}'.format(org)
+            for org in self.memberships.get(user_obj.name, [])
+        ]
+
+
+visibility_packages = [
+    {u'id': u'public-id', u'name': u'public', u'state': u'active'},
+    {u'id': u'private-id', u'name': u'private', u'state': u'active',
+     u'private': True, u'owner_org': u'org'},
+    {u'id': u'draft-id', u'name': u'draft', u'state': u'draft'},
+    {u'id': u'deleted-id', u'name': u'deleted', u'state': u'deleted'},
+]
+
+
+def _fake_user(name):
+    user_obj = mock.Mock()
+    # The name argument of Mock names the mock itself
+    user_obj.name = name
+    return user_obj
+
+
+def _filter_visible(user, uris, sysadmin=False):
+    fake_model = FakeModel(visibility_packages)
+    fake_model.User = mock.Mock()
+    fake_model.User.get = _fake_user
+
+    results = [{u'uri': uri} for uri in uris]
+    with mock.patch.object(logic, u'model', fake_model), \
+            mock.patch.object(logic, u'get_permission_labels',
+                              lambda: _FakeLabels({u'member': [u'org']})), \
+            mock.patch.object(logic.authz, u'is_sysadmin',
+                              lambda name: sysadmin):
+        visible_results, visible_ids = logic._filter_visible(
+            {u'user': user},
+            results
+        )
+    # The results are kept as they are, in the same order
+    assert visible_results == [
+        result for result in results
+        if any(result is visible for visible in visible_results)
+    ]
+    return visible_ids
+
+
+uris = [
+    u'http://ckan.example.com/dataset/{}'.format(key)
+    for key in (
+        u'private', u'public-id', u'draft-id', u'deleted', u'unknown',
+        u'public',
+    )
+]
+
+
+def test_anonymous_only_sees_public_datasets():
+    assert _filter_visible(u'', uris) == [u'public-id', u'public-id']
+
+
+def test_org_member_sees_private_datasets_of_org():
+    assert _filter_visible(u'member', uris) == [
+        u'private-id', u'public-id', u'public-id'
+    ]
+    assert _filter_visible(u'outsider', uris) == [u'public-id', u'public-id']
+
+
+def test_sysadmin_sees_every_active_dataset():
+    assert _filter_visible(u'admin', uris, sysadmin=True) == [
+        u'private-id', u'public-id', u'public-id'
+    ]
+
+
+def test_skipped_results_are_counted():
+    before = logic.get_search_skip_stats()
+    _filter_visible(u'', uris)
+    skipped = logic.get_search_skip_stats()
+    assert skipped[u'not_authorized'] - before[u'not_authorized'] == 1
+    # Drafts and deleted datasets are not found, like in package_search
+    assert skipped[u'not_found'] - before[u'not_found'] == 3
+
+
+class _FakeSolr(object):
+    '''
+    Stands in for package_search, for fq restricting the datasets by ID and
+    optionally by one field:value pair.
+    '''
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.searches = []
+
+    def __call__(self, context, data_dict):
+        self.searches.append(data_dict)
+        ids_part, _, filter_part = data_dict[u'fq'].partition(u' +(')
+        ids = set(
+            term.strip(u'"')
+            for term in ids_part[len(u'+id:('):-1].split(u' OR ')
+        )
+        matching = [d for d in self.datasets if d[u'id'] in ids]
+        if filter_part:
+            field, value = filter_part.rstrip(u')').split(u':')
+            matching = [d for d in matching if d[field] == value]
+
+        limit = data_dict[u'facet.limit']
+        search_facets = dict()
+        for field in data_dict[u'facet.field']:
+            counts = dict()
+            for d in matching:
+                counts[d[field]] = counts.get(d[field], 0) + 1
+            values = sorted(counts.items(), key=lambda i: (-i[1], i[0]))
+            if limit >= 0:
+                values = values[:limit]
+            search_facets[field] = {u'items': [
+                {u'name': name, u'display_name': name.upper(), u'count': n}
+                for name, n in values
+            ]}
+
+        return {
+            u'results': [
+                {u'id': d[u'id']} for d in matching[:data_dict[u'rows']]
+            ],
+            u'search_facets': search_facets,
+        }
+
+
+def _make_datasets(count):
+    return [
+        {
+            u'id': u'id-{}'.format(i),
+            u'organization': u'org-{}'.format(i % 3),
+            u'res_format': u'CSV' if i % 2 else u'JSON',
+        }
+        for i in range(count)
+    ]
+
+
+def _filter_and_facet(solr, dataset_ids, filter_query, facet_limit=50):
+    with mock.patch.object(toolkit, u'get_action', create=True,
+                           return_value=solr):
+        return logic._filter_and_facet(
+            {u'user': u'someone'},
+            dataset_ids,
+            filter_query,
+            [u'organization', u'res_format'],
+            facet_limit
+        )
+
+
+def test_facets_counted_in_one_search():
+    solr = _FakeSolr(_make_datasets(10))
+    ids = [u'id-{}'.format(i) for i in (1, 2, 3, 3, 4)]
+
+    matching_ids, facets, search_facets = _filter_and_facet(solr, ids, None)
+
+    search, = solr.searches
+    assert search[u'rows'] == 0
+    assert search[u'include_private'] is True
+    assert matching_ids == set()
+    assert facets == {
+        u'organization': {u'org-1': 2, u'org-0': 1, u'org-2': 1},
+        u'res_format': {u'CSV': 2, u'JSON': 2},
+    }
+    assert search_facets[u'organization'][u'items'] == [
+        {u'name': u'org-1', u'display_name': u'ORG-1', u'count': 2},
+        {u'name': u'org-0', u'display_name': u'ORG-0', u'count': 1},
+        {u'name': u'org-2', u'display_name': u'ORG-2', u'count': 1},
+    ]
+
+
+def test_filter_query_and_facets_across_chunks():
+    solr = _FakeSolr(_make_datasets(1200))
+    ids = [u'id-{}'.format(i) for i in range(1200)]
+
+    matching_ids, facets, search_facets = _filter_and_facet(
+        solr,
+        ids,
+        u'organization:org-1',
+        facet_limit=1
+    )
+
+    assert len(solr.searches) == 3
+    assert [len(s[u'fq'].split(u' OR ')) for s in solr.searches] == [
+        500, 500, 200
+    ]
+    # All values are needed to add up counts from several chunks
+    assert all(s[u'facet.limit'] == -1 for s in solr.searches)
+    assert matching_ids == set(
+        u'id-{}'.format(i) for i in range(1200) if i % 3 == 1
+    )
+    # Counts added up across the chunks, then limited
+    assert facets == {
+        u'organization': {u'org-1': 400},
+        u'res_format': {u'CSV': 200},
+    }
+    assert search_facets[u'res_format'][u'items'] == [
+        {u'name': u'CSV', u'display_name': u'CSV', u'count': 200},
+    ]
+
+
+def test_resolve_concepts_by_uri_or_unique_label():
+    concepts = {
+        water[u'uri']: water[u'label'],
+        air[u'uri']: air[u'label'],
+        soil[u'uri']: soil[u'label'],
+        u'http://example.com/other#Soil': u'soil',
+    }
+    with mock.patch.object(logic, u'_get_concepts', lambda: concepts):
+        assert logic.resolve_concepts([
+            u'water', air[u'uri'], u'Air', u'Fire', u'Soil',
+        ]) == (
+            [water[u'uri'], air[u'uri']],
+            [u'Fire'],
+            [u'Soil'],
+        )
+
+        # Unless the dataset has one of them already
+        assert logic.resolve_concepts([u'Soil'], [soil]) == (
+            [soil[u'uri']],
+            [],
+            [],
+        )
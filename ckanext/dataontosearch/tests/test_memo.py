@@ -0,0 +1,97 @@
+"""Tests for memo.py."""
+import mock
+from flask import Flask
+from sqlalchemy import event
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.dataontosearch.memo as memo
+from ckanext.dataontosearch.tests.helpers import FakeModel, Package
+
+app = Flask(__name__)
+
+dataset = {
+    u'id': u'6f1c3c2e-0d0a-4b5e-9a7e-3b0cdbf5d6a1',
+    u'name': u'example-dataset',
+}
+
+
+def _fake_get_action(calls):
+    def package_show(context, data_dict):
+        calls.append(data_dict[u'id'])
+        return dict(dataset)
+
+    def get_action(name):
+        assert name == u'package_show'
+        return package_show
+    return get_action
+
+
+def test_dataset_resolved_once_per_request():
+    calls = []
+    with mock.patch.object(toolkit, u'get_action', _fake_get_action(calls)):
+        with app.test_request_context():
+            memo.show_dataset(dataset[u'name'])
+            memo.show_dataset(dataset[u'name'])
+            memo.show_dataset(dataset[u'id'])
+        assert calls == [dataset[u'name']]
+
+        # A new request looks it up again
+        with app.test_request_context():
+            memo.show_dataset(dataset[u'id'])
+        assert calls == [dataset[u'name'], dataset[u'id']]
+
+
+def test_dataset_forgotten_after_change():
+    calls = []
+    with mock.patch.object(toolkit, u'get_action', _fake_get_action(calls)):
+        with app.test_request_context():
+            memo.show_dataset(dataset[u'name'])
+            memo.forget(dataset[u'id'])
+            memo.show_dataset(dataset[u'name'])
+        assert len(calls) == 2
+
+
+def test_dataset_uri_generated_once_per_request():
+    with mock.patch.object(memo, u'dataset_uri') as dataset_uri:
+        dataset_uri.return_value = u'http://example.com/dataset/1'
+        with app.test_request_context():
+            memo.get_dataset_uri(dataset)
+            uri = memo.get_dataset_uri(dataset)
+        assert uri == u'http://example.com/dataset/1'
+        assert dataset_uri.call_count == 1
+
+
+def test_auth_decided_once_per_request():
+    with mock.patch.object(toolkit, u'check_access') as check_access:
+        check_access.side_effect = toolkit.NotAuthorized(u'No')
+        with app.test_request_context():
+            for _ in range(3):
+                try:
+                    memo.check_access(u'package_update', dataset[u'id'])
+                    assert False, u'NotAuthorized was not raised'
+                except toolkit.NotAuthorized:
+                    pass
+        assert check_access.call_count == 1
+
+
+def test_auth_generation_bumped_once_dataset_renamed():
+    fake_model = FakeModel([{
+        u'id': dataset[u'id'],
+        u'name': dataset[u'name'],
+        u'state': u'active',
+    }])
+    session = fake_model.Session()
+    event.listen(Package, u'after_update', memo._dataset_changed)
+    event.listen(session, u'after_commit', memo._after_commit)
+    try:
+        with mock.patch.object(memo, u'_bump_auth_generation') as bump:
+            package = session.query(Package).get(dataset[u'id'])
+            package.name = u'renamed-dataset'
+            session.flush()
+            # Not until the new name is committed
+            assert not bump.called
+            session.commit()
+            assert bump.call_count == 1
+    finally:
+        event.remove(Package, u'after_update', memo._dataset_changed)
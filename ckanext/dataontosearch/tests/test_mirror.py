@@ -0,0 +1,124 @@
+"""Tests for mirror.py."""
+import mock
+from sqlalchemy.orm import sessionmaker
+
+import ckanext.dataontosearch.mirror as mirror
+from ckanext.dataontosearch.model import (
+    mirror_dataset_table, mirror_tag_table
+)
+from ckanext.dataontosearch.tests.helpers import make_engine
+
+water = {u'uri': u'http://example.com/onto#Water', u'label': u'Water'}
+air = {u'uri': u'http://example.com/onto#Air', u'label': u'Air'}
+soil = {u'uri': u'http://example.com/onto#Soil', u'label': u'Soil'}
+
+
+def setup_function(function):
+    engine = make_engine(mirror_dataset_table, mirror_tag_table)
+    system_info = dict()
+
+    global patches
+    patches = [
+        mock.patch.object(
+            mirror.meta,
+            u'create_local_session',
+            sessionmaker(bind=engine),
+            create=True
+        ),
+        mock.patch.object(mirror, u'get_system_info', system_info.get),
+        mock.patch.object(
+            mirror,
+            u'set_system_info',
+            system_info.__setitem__
+        ),
+    ]
+    for patch in patches:
+        patch.start()
+
+
+def teardown_function(function):
+    for patch in reversed(patches):
+        patch.stop()
+
+
+def test_set_tags_replaces_concepts():
+    assert mirror.get_tags(u'a') is None
+
+    mirror.set_tags(u'a', [water, air, water])
+    # Ordered by label, each concept once
+    assert mirror.get_tags(u'a') == [air, water]
+
+    mirror.set_tags(u'a', [soil])
+    assert mirror.get_tags(u'a') == [soil]
+
+    # Copied, even without concepts
+    mirror.set_tags(u'a', [])
+    assert mirror.get_tags(u'a') == []
+
+    mirror.forget(u'a')
+    assert mirror.get_tags(u'a') is None
+
+
+def test_get_tags_for_only_includes_copied_datasets():
+    mirror.set_tags(u'a', [water])
+    mirror.set_tags(u'b', [])
+    assert mirror.get_tags_for([u'a', u'b', u'c']) == {
+        u'a': [water],
+        u'b': [],
+    }
+    assert mirror.get_tags_for([]) == {}
+
+
+def test_get_all_tags_pages_through_datasets_with_concepts():
+    mirror.set_tags(u'c', [water])
+    mirror.set_tags(u'a', [soil, air])
+    mirror.set_tags(u'b', [])
+    mirror.set_tags(u'd', [air])
+
+    all_tags = mirror.get_all_tags()
+    assert list(all_tags.items()) == [
+        (u'a', [air, soil]),
+        (u'c', [water]),
+        (u'd', [air]),
+    ]
+    assert list(mirror.get_all_tags(limit=2)) == [u'a', u'c']
+    assert list(mirror.get_all_tags(limit=2, offset=2)) == [u'd']
+    assert mirror.get_all_tags(offset=3) == {}
+
+
+def test_complete_once_synced():
+    mirror.set_tags(u'a', [water])
+    assert not mirror.is_complete()
+    mirror.sync_all([])
+    assert mirror.is_complete()
+
+
+def test_sync_all_only_changes_what_differs():
+    mirror.set_tags(u'a', [water])
+    mirror.set_tags(u'b', [air])
+    mirror.set_tags(u'c', [soil])
+
+    with mock.patch.object(mirror, u'_set_tags', wraps=mirror._set_tags) \
+            as set_tags:
+        changed = mirror.sync_all([
+            (u'a', [water]),
+            (u'b', [air, soil]),
+            (u'd', [water]),
+        ])
+
+    assert changed == 3
+    assert sorted(call[0][1] for call in set_tags.call_args_list) == [
+        u'b', u'c', u'd'
+    ]
+    assert mirror.get_tags(u'a') == [water]
+    assert mirror.get_tags(u'b') == [air, soil]
+    # No longer associated with any concepts
+    assert mirror.get_tags(u'c') == []
+    assert mirror.get_tags(u'd') == [water]
+
+    # Nothing has changed since
+    assert mirror.sync_all([
+        (u'a', [water]),
+        (u'b', [soil, air]),
+        (u'd', [water]),
+    ]) == 0
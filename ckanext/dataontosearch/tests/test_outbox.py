@@ -0,0 +1,285 @@
+"""Tests for outbox.py."""
+import json
+import datetime
+
+import mock
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.dataontosearch.outbox as outbox
+import ckanext.dataontosearch.utils as utils
+from ckanext.dataontosearch.model import outbox_table, outbox_dead_table
+from ckanext.dataontosearch.tests.helpers import make_engine
+
+dataset_id = u'6f1c3c2e-0d0a-4b5e-9a7e-3b0cdbf5d6a1'
+dataset_uri = u'http://ckan.example.com/dataset/{}'.format(dataset_id)
+water = u'http://example.com/onto#Water'
+air = u'http://example.com/onto#Air'
+
+config = {
+    u'ckan.dataontosearch.tagger_url': u'http://dataontosearch.example.com',
+    u'ckan.dataontosearch.outbox_retry_delay': u'30',
+    u'ckan.dataontosearch.outbox_max_attempts': u'3',
+}
+
+
+class _Response(object):
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(u'HTTP {}'.format(self.status_code))
+
+
+class _FakeTagger(object):
+    '''
+    Stands in for DataOntoSearch, answering each request with the next
+    response given for its method.
+    '''
+    def __init__(self, **responses):
+        self.responses = responses
+        self.calls = []
+
+    def __call__(self, url, service, method=u'get', **kwargs):
+        self.calls.append((method, kwargs.get(u'params') or kwargs[u'json']))
+        response = self.responses[method].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def _ok():
+    return _Response(data={u'success': True})
+
+
+def setup_function(function):
+    global session
+    engine = make_engine(outbox_table, outbox_dead_table)
+    session = scoped_session(sessionmaker(bind=engine))
+
+    global patches
+    patches = [
+        mock.patch.object(outbox.model, u'Session', session, create=True),
+        mock.patch.object(toolkit, u'enqueue_job', create=True),
+        mock.patch.object(outbox, u'bump_generation'),
+        mock.patch.object(outbox, u'get_use_mirror', lambda: False),
+        mock.patch.dict(toolkit.config, config),
+    ]
+    for patch in patches:
+        patch.start()
+
+
+def teardown_function(function):
+    for patch in reversed(patches):
+        patch.stop()
+    session.remove()
+
+
+def _rows(table=outbox_table):
+    return session.execute(
+        select([table]).order_by(table.c.created)
+    ).fetchall()
+
+
+def _add(operation, payload=None, concept=u''):
+    outbox.add({}, operation, dataset_id, payload or {}, concept=concept)
+
+
+def _drain(tagger):
+    with mock.patch.object(utils, u'_make_generic_request', tagger):
+        return outbox.drain()
+
+
+def _make_due():
+    session.execute(outbox_table.update().values(
+        next_attempt=datetime.datetime.utcnow()
+    ))
+    session.commit()
+
+
+def test_same_change_is_only_queued_once():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_create', {u'concept': air}, concept=air)
+    assert [row.concept for row in _rows()] == [water, air]
+
+
+def test_opposite_change_replaces_pending_change():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_delete', {u'concept': water}, concept=water)
+    assert [(r.operation, r.concept) for r in _rows()] == [
+        (u'tag_delete', water),
+    ]
+
+
+def test_dataset_delete_replaces_all_changes_to_dataset():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_update', {u'concepts': [air]})
+    _add(u'dataset_delete', {u'dataset_id': dataset_uri})
+    assert [row.operation for row in _rows()] == [u'dataset_delete']
+
+
+def test_tag_update_replaces_pending_tag_changes():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_delete', {u'concept': air}, concept=air)
+    _add(u'tag_update', {u'concepts': [air]})
+    _add(u'tag_update', {u'concepts': [water]})
+    rows = _rows()
+    assert [row.operation for row in rows] == [u'tag_update']
+    assert json.loads(rows[0].payload) == {u'concepts': [water]}
+
+
+def test_job_enqueued_once_committed():
+    outbox.add({u'defer_commit': True}, u'tag_create', dataset_id, {})
+    assert not toolkit.enqueue_job.called
+    session.commit()
+    assert toolkit.enqueue_job.call_count == 1
+
+
+def test_sent_changes_are_removed():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    outbox.add({}, u'dataset_delete', u'other', {u'dataset_id': u'other'})
+    tagger = _FakeTagger(post=[_ok()], delete=[_ok()])
+
+    assert _drain(tagger) == (2, 0)
+
+    assert tagger.calls == [
+        (u'post', {u'concept': water}),
+        (u'delete', {u'dataset_id': u'other'}),
+    ]
+    assert _rows() == []
+    outbox.bump_generation.assert_called_once_with(u'search')
+
+
+def test_failed_change_is_retried_later():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+
+    assert _drain(_FakeTagger(post=[_Response(503)])) == (0, 1)
+    row, = _rows()
+    assert row.attempts == 1
+    assert row.last_error == u'HTTP 503'
+    first_delay = row.next_attempt - datetime.datetime.utcnow()
+    assert 25 < first_delay.total_seconds() <= 30
+
+    # Not retried before it is due
+    assert _drain(_FakeTagger()) == (0, 0)
+
+    # The delay is doubled for each failure
+    _make_due()
+    assert _drain(_FakeTagger(post=[RuntimeError(u'Timeout')])) == (0, 1)
+    row, = _rows()
+    assert row.attempts == 2
+    second_delay = row.next_attempt - datetime.datetime.utcnow()
+    assert 55 < second_delay.total_seconds() <= 60
+
+    _make_due()
+    assert _drain(_FakeTagger(post=[_ok()])) == (1, 0)
+    assert _rows() == []
+
+
+def test_change_given_up_after_max_attempts():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    for _ in range(3):
+        _make_due()
+        _drain(_FakeTagger(post=[_Response(503)]))
+
+    assert _rows() == []
+    dead, = _rows(outbox_dead_table)
+    assert (dead.operation, dead.concept, dead.attempts) == (
+        u'tag_create', water, 3
+    )
+    assert outbox.get_status()[u'given_up'] == 1
+
+
+def test_rejected_change_given_up_at_once():
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_create', {u'concept': air}, concept=air)
+    tagger = _FakeTagger(post=[
+        _Response(400, {u'message': u'Bad concept'}),
+        _Response(data={u'success': False, u'message': u'Unknown concept'}),
+    ])
+
+    assert _drain(tagger) == (0, 2)
+
+    assert _rows() == []
+    assert [row.last_error for row in _rows(outbox_dead_table)] == [
+        u'DataOntoSearch answered 400: {"message": "Bad concept"}',
+        u'Unknown concept',
+    ]
+
+
+def test_nothing_to_delete_counts_as_sent():
+    _add(u'tag_delete', {u'concept': water}, concept=water)
+    assert _drain(_FakeTagger(delete=[_Response(404)])) == (1, 0)
+    assert _rows(outbox_dead_table) == []
+
+
+def test_tag_update_sends_differences_when_sent():
+    _add(u'tag_update', {
+        u'dataset_id': dataset_uri,
+        u'concepts': [water],
+        u'create': {u'dataset_url': dataset_uri + u'.rdf'},
+    })
+    tagger = _FakeTagger(
+        get=[_Response(data={u'concepts': [
+            {u'uri': air, u'label': u'Air'},
+        ]})],
+        post=[_ok()],
+        delete=[_ok()],
+    )
+
+    assert _drain(tagger) == (1, 0)
+
+    assert tagger.calls == [
+        (u'get', {u'dataset_id': dataset_uri}),
+        (u'post', {u'dataset_url': dataset_uri + u'.rdf', u'concept': water}),
+        (u'delete', {u'dataset_id': dataset_uri, u'concept': air}),
+    ]
+
+
+def test_due_changes_locked_and_sent_in_batches():
+    query = outbox._select_due(datetime.datetime.utcnow())
+    compiled = str(query.compile(dialect=postgresql.dialect()))
+    assert u'FOR UPDATE SKIP LOCKED' in compiled
+
+    for i in range(outbox._BATCH_SIZE + 1):
+        _add(u'tag_create', {u'concept': i}, concept=u'{}'.format(i))
+    tagger = _FakeTagger(post=[_ok()] * (outbox._BATCH_SIZE + 1))
+    with mock.patch.object(session, u'commit', wraps=session.commit) as commit:
+        assert _drain(tagger) == (outbox._BATCH_SIZE + 1, 0)
+    # Committed after each batch
+    assert commit.call_count == 2
+
+
+def test_status():
+    assert outbox.get_status() == {
+        u'pending': 0,
+        u'due': 0,
+        u'failed': 0,
+        u'oldest': None,
+        u'given_up': 0,
+    }
+
+    _add(u'tag_create', {u'concept': water}, concept=water)
+    _add(u'tag_create', {u'concept': air}, concept=air)
+    _drain(_FakeTagger(post=[_Response(503), _ok()]))
+    _add(u'tag_delete', {u'concept': air}, concept=air)
+
+    status = outbox.get_status()
+    oldest, = _rows()[:1]
+    assert status == {
+        u'pending': 2,
+        u'due': 1,
+        u'failed': 1,
+        u'oldest': oldest.created.isoformat(),
+        u'given_up': 0,
+    }
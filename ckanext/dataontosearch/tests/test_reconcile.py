@@ -0,0 +1,229 @@
+"""Tests for reconcile.py."""
+import json
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.dataontosearch.reconcile as reconcile
+from ckanext.dataontosearch.reconcile import Reconciler
+from ckanext.dataontosearch.tests.helpers import FakeModel
+
+base = u'http://ckan.example.com/dataset/'
+water = {u'uri': u'http://example.com/onto#Water', u'label': u'Water'}
+air = {u'uri': u'http://example.com/onto#Air', u'label': u'Air'}
+
+
+class _FakeTagger(object):
+    '''
+    Stands in for DataOntoSearch, failing for the given datasets or concepts.
+    '''
+    def __init__(self, tags, fail_for=()):
+        self.tags = tags
+        self.fail_for = set(fail_for)
+        self.deleted = []
+        self.created = []
+
+    def get(self, endpoint):
+        return mock.Mock()
+
+    def delete(self, endpoint, payload):
+        if payload[u'dataset_id'] in self.fail_for:
+            raise RuntimeError(u'Could not delete')
+        self.deleted.append(payload[u'dataset_id'])
+        return mock.Mock()
+
+    def post(self, endpoint, payload):
+        if payload[u'concept'] in self.fail_for:
+            raise RuntimeError(u'Could not create')
+        self.created.append((payload[u'dataset'], payload[u'concept']))
+        response = mock.Mock()
+        response.json.return_value = {u'success': True}
+        return response
+
+
+def _reconcile(tmpdir, fake_model, tagger, mirrored=None, resume=False,
+               dry_run=False, chunk_size=2):
+    def show_dataset(context, data_dict):
+        return {u'id': data_dict[u'id']}
+
+    def make_payload(dataset, concept):
+        return {u'dataset': dataset[u'id'], u'concept': concept}
+
+    def get_tags_for(dataset_ids):
+        return dict(
+            (dataset_id, mirrored[dataset_id])
+            for dataset_id in dataset_ids if dataset_id in mirrored
+        )
+
+    lines = []
+    reconciler = Reconciler(
+        str(tmpdir.join(u'checkpoint.json')),
+        workers=2,
+        rate=0,
+        chunk_size=chunk_size,
+        dry_run=dry_run,
+        out=lines.append
+    )
+    with mock.patch.object(reconcile, u'model', fake_model), \
+            mock.patch.object(reconcile, u'make_tagger_get_request',
+                              tagger.get), \
+            mock.patch.object(reconcile, u'response_json',
+                              lambda r: tagger.tags), \
+            mock.patch.object(reconcile, u'make_tagger_delete_request',
+                              tagger.delete), \
+            mock.patch.object(reconcile, u'make_tagger_post_request',
+                              tagger.post), \
+            mock.patch.object(reconcile, u'make_tag_create_payload',
+                              make_payload), \
+            mock.patch.object(reconcile, u'get_use_mirror',
+                              lambda: mirrored is not None), \
+            mock.patch.object(reconcile.mirror, u'is_complete',
+                              lambda: True), \
+            mock.patch.object(reconcile.mirror, u'get_tags_for',
+                              get_tags_for), \
+            mock.patch.object(toolkit, u'get_action', create=True,
+                              return_value=show_dataset), \
+            mock.patch.object(reconcile, u'bump_generation'):
+        checkpoint = reconciler.run(resume=resume)
+    return checkpoint, lines
+
+
+packages = [
+    {u'id': u'a-id', u'name': u'apple', u'state': u'active'},
+    {u'id': u'b-id', u'name': u'banana', u'state': u'deleted'},
+    {u'id': u'c-id', u'name': u'cherry', u'state': u'draft'},
+]
+
+
+def test_only_deleted_and_unknown_datasets_are_orphans(tmpdir):
+    tagger = _FakeTagger({
+        base + u'a-id': {u'concepts': [water]},
+        base + u'apple': {u'concepts': [water]},
+        base + u'b-id': {u'concepts': [water]},
+        base + u'cherry': {u'concepts': [water]},
+        base + u'unknown': {u'concepts': [water]},
+        # Not URIs this CKAN would generate
+        u'http://other.example.com/dataset/x': {u'concepts': [water]},
+        base + u'a-id/resource': {u'concepts': [water]},
+    })
+
+    checkpoint, _ = _reconcile(tmpdir, FakeModel(packages), tagger)
+
+    assert sorted(tagger.deleted) == [base + u'b-id', base + u'unknown']
+    assert checkpoint[u'phase'] == u'done'
+    assert checkpoint[u'checked'] == 7
+    assert checkpoint[u'changed'] == 2
+    assert checkpoint[u'failed'] == 0
+
+
+def test_missing_concepts_are_added_from_mirror(tmpdir):
+    tagger = _FakeTagger({
+        base + u'apple': {u'concepts': [water]},
+    })
+    mirrored = {
+        u'a-id': [water, air],
+        # Deleted datasets are not reconciled
+        u'b-id': [air],
+        u'c-id': [water],
+    }
+
+    checkpoint, _ = _reconcile(
+        tmpdir,
+        FakeModel(packages),
+        tagger,
+        mirrored=mirrored
+    )
+
+    assert tagger.deleted == []
+    assert sorted(tagger.created) == [
+        (u'a-id', air[u'uri']),
+        (u'c-id', water[u'uri']),
+    ]
+    assert checkpoint[u'changed'] == 2
+
+
+def test_dry_run_changes_nothing(tmpdir):
+    tagger = _FakeTagger({base + u'unknown': {u'concepts': [water]}})
+
+    checkpoint, lines = _reconcile(
+        tmpdir,
+        FakeModel(packages),
+        tagger,
+        mirrored={u'a-id': [air]},
+        dry_run=True
+    )
+
+    assert tagger.deleted == [] and tagger.created == []
+    assert checkpoint[u'changed'] == 2
+    assert len([line for line in lines if line.startswith(u'Would')]) == 2
+    assert not tmpdir.join(u'checkpoint.json').check()
+
+
+def test_resume_continues_after_checkpoint(tmpdir):
+    tagger = _FakeTagger({
+        base + u'unknown-1': {u'concepts': [water]},
+        base + u'unknown-2': {u'concepts': [water]},
+        base + u'unknown-3': {u'concepts': [water]},
+    })
+    tmpdir.join(u'checkpoint.json').write(json.dumps({
+        u'phase': u'orphans',
+        u'last_key': base + u'unknown-1',
+        u'checked': 1,
+        u'changed': 1,
+        u'failed': 0,
+    }))
+
+    checkpoint, _ = _reconcile(
+        tmpdir,
+        FakeModel(packages),
+        tagger,
+        resume=True
+    )
+
+    assert sorted(tagger.deleted) == [base + u'unknown-2', base + u'unknown-3']
+    assert checkpoint[u'checked'] == 3
+    assert checkpoint[u'changed'] == 3
+
+
+def test_failed_changes_retried_on_resume(tmpdir):
+    tags = {
+        base + u'unknown-1': {u'concepts': [water]},
+        base + u'unknown-2': {u'concepts': [water]},
+        base + u'unknown-3': {u'concepts': [water]},
+    }
+    mirrored = {u'a-id': [water, air]}
+    tagger = _FakeTagger(
+        tags,
+        fail_for=[base + u'unknown-1', air[u'uri']]
+    )
+
+    checkpoint, _ = _reconcile(
+        tmpdir,
+        FakeModel(packages),
+        tagger,
+        mirrored=mirrored
+    )
+
+    assert checkpoint[u'phase'] == u'done'
+    assert checkpoint[u'failed'] == 2
+    assert sorted(tagger.deleted) == [base + u'unknown-2', base + u'unknown-3']
+    assert tagger.created == [(u'a-id', water[u'uri'])]
+
+    # Only the failed changes are tried again
+    tagger = _FakeTagger(dict(
+        (uri, details) for uri, details in tags.items()
+        if uri == base + u'unknown-1'
+    ))
+    checkpoint, _ = _reconcile(
+        tmpdir,
+        FakeModel(packages),
+        tagger,
+        mirrored=mirrored,
+        resume=True
+    )
+
+    assert tagger.deleted == [base + u'unknown-1']
+    assert tagger.created == [(u'a-id', air[u'uri'])]
+    assert checkpoint[u'failed'] == 0
+    assert checkpoint[u'retry'] == {u'orphans': [], u'missing': []}
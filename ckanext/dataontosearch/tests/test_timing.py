@@ -0,0 +1,43 @@
+"""Tests for timing.py."""
+import threading
+
+from flask import Flask, copy_current_request_context
+
+import ckanext.dataontosearch.timing as timing
+
+app = Flask(__name__)
+
+
+def _run_in_thread(f):
+    thread = threading.Thread(target=f)
+    thread.start()
+    thread.join()
+
+
+def test_phases_are_added_up():
+    with app.test_request_context():
+        timing.start()
+        timing.record(u'dataontosearch', 1.)
+        timing.record(u'dataontosearch', 2.)
+        timing.record(u'render', .5)
+        timings = timing.get_timings()
+    assert list(timings) == [u'dataontosearch', u'render', u'total']
+    assert timings[u'dataontosearch'] == 3.
+
+
+def test_threads_record_for_the_request_they_work_for():
+    def work():
+        timing.record(u'dataontosearch', 1.)
+
+    with app.test_request_context():
+        timing.start()
+        _run_in_thread(copy_current_request_context(timing.bind(work)))
+        _run_in_thread(timing.bind(work))
+        # Without bind, the time is not recorded
+        _run_in_thread(copy_current_request_context(work))
+        assert timing.get_timings()[u'dataontosearch'] == 2.
+
+
+def test_nothing_recorded_outside_of_request():
+    timing.record(u'dataontosearch', 1.)
+    assert timing.bind(len) is len
@@ -0,0 +1,229 @@
+"""Tests for utils.py."""
+import time
+import threading
+
+import mock
+
+import ckanext.dataontosearch.utils as utils
+from ckanext.dataontosearch.utils import (
+    CircuitBreaker, DataOntoSearchUnavailable
+)
+from ckanext.dataontosearch.tests.helpers import Clock
+
+
+def _make_breaker(clock):
+    return CircuitBreaker(
+        u'tagger',
+        failure_threshold=3,
+        reset_timeout=30,
+        slow_threshold=10.,
+        clock=clock
+    )
+
+
+def _is_rejected(breaker):
+    try:
+        breaker.before_request()
+        return False
+    except DataOntoSearchUnavailable:
+        return True
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = _make_breaker(Clock())
+    breaker.record(False, 1.)
+    breaker.record(False, 1.)
+    # A success starts the count over
+    breaker.record(True, 1.)
+    breaker.record(False, 1.)
+    breaker.record(False, 1.)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not _is_rejected(breaker)
+
+    breaker.record(False, 1.)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert _is_rejected(breaker)
+
+
+def test_slow_requests_count_as_failures():
+    breaker = _make_breaker(Clock())
+    for _ in range(3):
+        breaker.record(True, 11.)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_lets_one_probe_through_after_reset_timeout():
+    clock = Clock()
+    breaker = _make_breaker(clock)
+    for _ in range(3):
+        breaker.record(False, 1.)
+
+    clock.now += 29
+    assert _is_rejected(breaker)
+
+    clock.now += 1
+    assert not _is_rejected(breaker)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the probe is let through
+    assert _is_rejected(breaker)
+
+    breaker.record(True, 1.)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert not _is_rejected(breaker)
+
+
+def test_reopens_when_probe_fails():
+    clock = Clock()
+    breaker = _make_breaker(clock)
+    for _ in range(3):
+        breaker.record(False, 1.)
+
+    clock.now += 30
+    assert not _is_rejected(breaker)
+    breaker.record(False, 1.)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # The reset timeout starts over from the failed probe
+    clock.now += 29
+    assert _is_rejected(breaker)
+    clock.now += 1
+    assert not _is_rejected(breaker)
+
+
+def test_probe_failing_with_any_error_reopens():
+    clock = Clock()
+    breaker = _make_breaker(clock)
+    for _ in range(3):
+        breaker.record(False, 1.)
+    clock.now += 30
+
+    session = mock.Mock()
+    session.get.side_effect = ValueError(u'Not a valid response')
+    with mock.patch.object(utils, u'get_breaker', lambda service: breaker), \
+            mock.patch.object(utils, u'get_session', lambda: session):
+        try:
+            utils._make_generic_request(
+                u'http://dataontosearch.example.com/api/v1/tag',
+                u'tagger'
+            )
+            assert False, u'The error was not raised'
+        except ValueError:
+            pass
+
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 30
+    assert not _is_rejected(breaker)
+
+
+class _SlowUpstream(object):
+    '''
+    Stands in for _make_generic_request, answering once told to.
+    '''
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+        self.answer = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, url, service, params=None, headers=None):
+        with self._lock:
+            self.calls.append((url, params, headers))
+        self.answer.wait(5)
+        if self.error is not None:
+            raise self.error
+        return object()
+
+
+def _get_concurrently(requests):
+    '''
+    Send each of the (params, headers) requests in its own thread, once the
+    first is being sent.
+
+    :rtype: list of the response or exception for each request
+    '''
+    outcomes = [None] * len(requests)
+
+    def send(i):
+        params, headers = requests[i]
+        try:
+            outcomes[i] = utils._make_coalesced_get_request(
+                u'http://dataontosearch.example.com/api/v1/tag',
+                u'tagger',
+                params=params,
+                headers=headers
+            )
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=send, args=(i,))
+               for i in range(len(requests))]
+    threads[0].start()
+    # Let the first become the leader before the others start
+    while not utils._in_flight:
+        time.sleep(.001)
+    for thread in threads[1:]:
+        thread.start()
+    return threads, outcomes
+
+
+def _wait_for_coalesced(before, count):
+    deadline = time.time() + 5
+    while utils.get_coalescing_stats()[u'coalesced'] - before < count:
+        assert time.time() < deadline, u'Requests were not coalesced'
+        time.sleep(.001)
+
+
+def test_identical_concurrent_gets_share_one_request():
+    upstream = _SlowUpstream()
+    before = utils.get_coalescing_stats()[u'coalesced']
+    with mock.patch.object(utils, u'_make_generic_request', upstream):
+        threads, outcomes = _get_concurrently(
+            [({u'dataset_id': u'a'}, None)] * 4
+        )
+        _wait_for_coalesced(before, 3)
+        upstream.answer.set()
+        for thread in threads:
+            thread.join()
+
+    assert len(upstream.calls) == 1
+    assert all(outcome is outcomes[0] for outcome in outcomes)
+
+
+def test_different_params_or_headers_are_not_shared():
+    upstream = _SlowUpstream()
+    with mock.patch.object(utils, u'_make_generic_request', upstream):
+        threads, outcomes = _get_concurrently([
+            ({u'dataset_id': u'a'}, None),
+            ({u'dataset_id': u'b'}, None),
+            ({u'dataset_id': u'a'}, {u'If-None-Match': u'"v1"'}),
+        ])
+        deadline = time.time() + 5
+        while len(upstream.calls) < 3:
+            assert time.time() < deadline, u'Requests were not all sent'
+            time.sleep(.001)
+        upstream.answer.set()
+        for thread in threads:
+            thread.join()
+
+    assert len(upstream.calls) == 3
+    assert len(set(id(outcome) for outcome in outcomes)) == 3
+
+
+def test_error_of_shared_request_reaches_everyone():
+    error = DataOntoSearchUnavailable(u'Down')
+    upstream = _SlowUpstream(error)
+    before = utils.get_coalescing_stats()[u'coalesced']
+    with mock.patch.object(utils, u'_make_generic_request', upstream):
+        threads, outcomes = _get_concurrently(
+            [({u'dataset_id': u'a'}, None)] * 3
+        )
+        _wait_for_coalesced(before, 2)
+        upstream.answer.set()
+        for thread in threads:
+            thread.join()
+
+    assert len(upstream.calls) == 1
+    assert outcomes == [error] * 3
+    # Nothing is left behind for later requests to wait for
+    assert not utils._in_flight
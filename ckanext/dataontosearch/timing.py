@@ -0,0 +1,106 @@
+# encoding: utf-8
+'''
+Time spent in each phase of handling a request, for the Server-Timing header.
+
+The timings are kept on flask.g, so they only cover the current request.
+Outside of a request, nothing is recorded. Threads working for the request
+have their own flask.g, so use bind() to let them record timings too.
+'''
+import time
+import functools
+import threading
+import contextlib
+
+from collections import OrderedDict
+
+from flask import g, has_app_context
+
+# Phases may be timed by threads working for the same request
+_lock = threading.Lock()
+
+# The timings bound to the current thread by bind()
+_local = threading.local()
+
+
+def start():
+    '''
+    Start timing the current request.
+    '''
+    g.dataontosearch_timings = OrderedDict()
+    g.dataontosearch_started = time.time()
+
+
+def record(phase, duration):
+    '''
+    Add duration seconds to the time spent in phase by the current request.
+    '''
+    timings = _get_current_timings()
+    if timings is None:
+        return
+    with _lock:
+        timings[phase] = timings.get(phase, 0.) + duration
+
+
+def bind(f):
+    '''
+    Let f record timings for the current request, when run in another thread.
+
+    The time spent by all threads in the same phase is added up.
+    '''
+    timings = _get_current_timings()
+    if timings is None:
+        return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, u'timings', None)
+        _local.timings = timings
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return wrapper
+
+
+def _get_current_timings():
+    timings = getattr(_local, u'timings', None)
+    if timings is not None:
+        return timings
+    if not has_app_context():
+        return None
+    return getattr(g, u'dataontosearch_timings', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Time the code run inside the with block as part of the named phase.
+    '''
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - started)
+
+
+def get_timings():
+    '''
+    Get the time spent in each phase by the current request so far.
+
+    :rtype: OrderedDict where each phase is mapped to the seconds spent, with
+        the time spent in total last as 'total'
+    '''
+    with _lock:
+        timings = OrderedDict(g.dataontosearch_timings)
+    timings[u'total'] = time.time() - g.dataontosearch_started
+    return timings
+
+
+def format_header(timings):
+    '''
+    Format the timings as the value of a Server-Timing header.
+    '''
+    return u', '.join(
+        u'{};dur={:.1f}'.format(name, duration * 1000.)
+        for name, duration in timings.items()
+    )
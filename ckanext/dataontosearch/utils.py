@@ -1,27 +1,173 @@
 # encoding: utf-8
+import time
 import logging
+import threading
 import requests
 import ckan.plugins.toolkit as toolkit
 
+from collections import OrderedDict
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests.packages.urllib3.util.retry import Retry
+
+from ckanext.dataontosearch import metrics, timing
+
 
 logger = logging.getLogger(__name__)
 
+# One session (and thus one connection pool) is shared by all requests made by
+# this process. It is created lazily, so that each worker gets its own session
+# even when the application is loaded before the worker processes are forked.
+_session = None
+_session_lock = threading.Lock()
+_session_stats = {
+    u'requests': 0,
+}
+
+# GET requests currently being sent, so that identical requests can wait for
+# the same response instead of sending their own request
+_in_flight = dict()
+_in_flight_lock = threading.Lock()
+_coalescing_stats = {
+    u'calls': 0,
+    u'coalesced': 0,
+}
+
+
+class _InFlightRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class DataOntoSearchUnavailable(RequestException):
+    '''
+    Raised instead of sending a request, when DataOntoSearch is unhealthy.
+    '''
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Stop sending requests to a service which keeps failing or being slow.
+
+    After failure_threshold failed or slow requests in a row, the breaker
+    opens, and requests fail right away with DataOntoSearchUnavailable. After
+    reset_timeout seconds, one request is let through to probe the service.
+    The breaker closes again if the probe succeeds, and stays open for another
+    reset_timeout seconds if not.
+
+    The clock is called to get the current time in seconds.
+    '''
+    CLOSED = u'closed'
+    OPEN = u'open'
+    HALF_OPEN = u'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout, slow_threshold,
+                 clock=time.time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_threshold = slow_threshold
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and \
+                    self._clock() - self._opened_at >= self.reset_timeout:
+                # Let this request probe whether the service is back
+                logger.info(u'Probing whether %s is healthy again', self.name)
+                self.state = self.HALF_OPEN
+                return
+        raise DataOntoSearchUnavailable(
+            u'DataOntoSearch ({}) is unavailable'.format(self.name)
+        )
+
+    def record(self, succeeded, duration):
+        with self._lock:
+            if succeeded and duration <= self.slow_threshold:
+                if self.state != self.CLOSED:
+                    logger.info(u'%s is healthy again', self.name)
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and
+                self.failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    u'%s failed or was slow %d times in a row, failing fast '
+                    u'for %d seconds',
+                    self.name,
+                    self.failures,
+                    self.reset_timeout
+                )
+                self.state = self.OPEN
+                self._opened_at = self._clock()
 
-def make_tagger_get_request(endpoint, params=None):
+
+# One breaker for each service, created as needed
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(service):
+    '''
+    Get the circuit breaker for the service, either 'tagger' or 'search'.
+    '''
+    with _breakers_lock:
+        breaker = _breakers.get(service)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                service,
+                failure_threshold=get_breaker_failures(),
+                reset_timeout=get_breaker_reset_timeout(),
+                slow_threshold=get_slow_request_threshold()
+            )
+            _breakers[service] = breaker
+        return breaker
+
+
+def make_tagger_get_request(endpoint, params=None, headers=None,
+                            coalesce=True):
     url = make_tagger_url(endpoint)
-    return _make_generic_request(url, params=params)
+    if not coalesce:
+        # An identical request may have been sent before a change we just
+        # made, so its response could be out of date
+        return _make_generic_request(
+            url,
+            u'tagger',
+            params=params,
+            headers=headers
+        )
+    return _make_coalesced_get_request(
+        url,
+        u'tagger',
+        params=params,
+        headers=headers
+    )
 
 
 def make_tagger_post_request(endpoint, json=None):
     url = make_tagger_url(endpoint)
     logger.debug(u'About to send the following JSON: ' + repr(json))
-    return _make_generic_request(url, u'post', json=json)
+    return _make_generic_request(url, u'tagger', u'post', json=json)
 
 
 def make_tagger_delete_request(endpoint, json=None):
     url = make_tagger_url(endpoint)
     logger.debug(u'About to send the following JSON: ' + repr(json))
-    return _make_generic_request(url, u'delete', json=json)
+    return _make_generic_request(url, u'tagger', u'delete', json=json)
 
 
 def make_search_get_request(endpoint, params=None):
@@ -33,23 +179,223 @@ def make_search_get_request(endpoint, params=None):
     else:
         params[u'c'] = get_configuration()
 
-    return _make_generic_request(url, params=params)
+    return _make_coalesced_get_request(url, u'search', params=params)
+
+
+def _make_coalesced_get_request(url, service, params=None, headers=None):
+    '''
+    Send a GET request, unless an identical request is already being sent.
+
+    When many users request the same thing at once, only one request is sent
+    to DataOntoSearch and everyone shares its response. Use response_json() to
+    share the parsed JSON as well.
+    '''
+    key = (
+        url,
+        tuple(sorted((params or {}).items())),
+        tuple(sorted((headers or {}).items())),
+    )
+
+    with _in_flight_lock:
+        _coalescing_stats[u'calls'] += 1
+        in_flight = _in_flight.get(key)
+        is_leader = in_flight is None
+        if is_leader:
+            in_flight = _InFlightRequest()
+            _in_flight[key] = in_flight
+        else:
+            _coalescing_stats[u'coalesced'] += 1
+
+    if not is_leader:
+        logger.debug(u'Waiting for identical request to %s', url)
+        in_flight.done.wait()
+        if in_flight.error is not None:
+            raise in_flight.error
+        return in_flight.response
+
+    try:
+        in_flight.response = _make_generic_request(
+            url,
+            service,
+            params=params,
+            headers=headers
+        )
+        return in_flight.response
+    except Exception as e:
+        in_flight.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        in_flight.done.set()
+
 
+def response_json(response):
+    '''
+    Parse the JSON in the response, only parsing it once per response.
 
-def _make_generic_request(url, method=u'get', **kwargs):
+    The parsed JSON may be shared with others, so it must not be modified.
+    '''
+    # Setting the lock this way is atomic, so everyone gets the same lock
+    lock = response.__dict__.setdefault(
+        u'_dataontosearch_lock',
+        threading.Lock()
+    )
+    with lock:
+        if not hasattr(response, u'_dataontosearch_json'):
+            response._dataontosearch_json = response.json()
+        return response._dataontosearch_json
+
+
+def diff_concepts(existing_concepts, concepts):
+    '''
+    Work out what must change to make concepts the only ones associated with
+    a dataset.
+
+    :param existing_concepts: the concepts associated with the dataset now,
+        each a dict with 'uri' and 'label'
+    :param concepts: RDF URIs or human-readable labels for all the concepts
+        that should be associated with the dataset
+    :return: the concepts to add, as given in concepts, and the URIs of the
+        concepts to remove. Each concept is only included once.
+    :rtype: tuple of two lists
+    '''
+    existing_uris = set(c[u'uri'] for c in existing_concepts)
+    existing_labels = set(c[u'label'] for c in existing_concepts)
+    # Each concept is only changed once, even if given more than once
+    wanted = OrderedDict.fromkeys(concepts)
+
+    added = [
+        concept for concept in wanted
+        if concept not in existing_uris and concept not in existing_labels
+    ]
+    removed = [
+        c[u'uri'] for c in existing_concepts
+        if c[u'uri'] not in wanted and c[u'label'] not in wanted
+    ]
+    return added, removed
+
+
+def _make_generic_request(url, service, method=u'get', **kwargs):
     username, password = get_credentials()
     if username is not None and password is not None:
         auth = (username, password)
     else:
         auth = None
 
+    labels = {
+        u'service': service,
+        u'endpoint': metrics.endpoint_of(url),
+        u'method': method.upper(),
+    }
+
+    breaker = get_breaker(service)
+    try:
+        breaker.before_request()
+    except DataOntoSearchUnavailable as e:
+        metrics.upstream_errors.inc(error=type(e).__name__, **labels)
+        raise
+
     logger.debug(u'Sending {} request to {}'.format(method, url))
-    return getattr(requests, method)(
-        url,
-        timeout=29.,
-        auth=auth,
-        **kwargs
+    started = time.time()
+    try:
+        response = getattr(get_session(), method)(
+            url,
+            timeout=get_timeouts(service),
+            auth=auth,
+            **kwargs
+        )
+    except Exception as e:
+        # Any error counts, so that a failed probe does not leave the breaker
+        # half open, rejecting every request
+        duration = time.time() - started
+        timing.record(u'dataontosearch', duration)
+        breaker.record(False, duration)
+        metrics.upstream_latency.observe(duration, **labels)
+        metrics.upstream_errors.inc(error=type(e).__name__, **labels)
+        raise
+    duration = time.time() - started
+    timing.record(u'dataontosearch', duration)
+    breaker.record(response.status_code < 500, duration)
+    metrics.upstream_latency.observe(duration, **labels)
+    metrics.upstream_responses.inc(status=response.status_code, **labels)
+
+    with _session_lock:
+        _session_stats[u'requests'] += 1
+    return response
+
+
+def get_session():
+    '''
+    Get the requests session shared by all requests to DataOntoSearch.
+
+    The session keeps connections alive between requests, so that we do not
+    need to set up a new TCP and TLS connection for every request we make.
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _create_session():
+    session = requests.Session()
+
+    # Only idempotent requests are retried, since we cannot know whether a
+    # failed POST or DELETE was applied by DataOntoSearch or not
+    retry_options = dict(
+        total=get_max_retries(),
+        backoff_factor=get_retry_backoff(),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(allowed_methods=frozenset([u'GET']), **retry_options)
+    except TypeError:
+        # Older versions of urllib3 use another name for the same option
+        retry = Retry(method_whitelist=frozenset([u'GET']), **retry_options)
+
+    pool_size = get_pool_size()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
     )
+    session.mount(u'http://', adapter)
+    session.mount(u'https://', adapter)
+
+    session.headers[u'Accept-Encoding'] = u'gzip, deflate'
+    if not get_keep_alive():
+        session.headers[u'Connection'] = u'close'
+
+    return session
+
+
+def get_connection_stats():
+    '''
+    Report how well connections to DataOntoSearch are being reused.
+
+    :rtype: dict with the number of 'requests' sent, the number of
+        'connections' opened for them and how many requests 'reused' an
+        already open connection.
+    '''
+    connections = 0
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+
+    requests_sent = _session_stats[u'requests']
+    return {
+        u'requests': requests_sent,
+        u'connections': connections,
+        u'reused': max(requests_sent - connections, 0),
+    }
 
 
 def make_tagger_url(endpoint):
@@ -93,3 +439,195 @@ def get_configuration():
 def get_use_autotag():
     use_autotag = toolkit.config.get(u'ckan.dataontosearch.use_autotag', False)
     return toolkit.asbool(use_autotag)
+
+
+def get_coalescing_stats():
+    '''
+    Report how many GET requests were coalesced with an identical request.
+
+    :rtype: dict with the number of GET requests made by this extension as
+        'calls', and how many of them shared the response of another request
+        as 'coalesced'.
+    '''
+    with _in_flight_lock:
+        return dict(_coalescing_stats)
+
+
+def get_pool_size():
+    pool_size = toolkit.config.get(u'ckan.dataontosearch.pool_size', 10)
+    return toolkit.asint(pool_size)
+
+
+def get_keep_alive():
+    keep_alive = toolkit.config.get(u'ckan.dataontosearch.keep_alive', True)
+    return toolkit.asbool(keep_alive)
+
+
+def get_max_retries():
+    max_retries = toolkit.config.get(u'ckan.dataontosearch.max_retries', 2)
+    return toolkit.asint(max_retries)
+
+
+def get_retry_backoff():
+    backoff = toolkit.config.get(u'ckan.dataontosearch.retry_backoff', 0.5)
+    return float(backoff)
+
+
+def get_concept_cache_ttl():
+    ttl = toolkit.config.get(u'ckan.dataontosearch.concept_cache_ttl', 3600)
+    return toolkit.asint(ttl)
+
+
+def get_concept_cache_size():
+    size = toolkit.config.get(u'ckan.dataontosearch.concept_cache_size', 16)
+    return toolkit.asint(size)
+
+
+def get_search_cache_ttl():
+    ttl = toolkit.config.get(u'ckan.dataontosearch.search_cache_ttl', 300)
+    return toolkit.asint(ttl)
+
+
+def get_search_cache_size():
+    size = toolkit.config.get(u'ckan.dataontosearch.search_cache_size', 100)
+    return toolkit.asint(size)
+
+
+def get_search_cache_max_results():
+    max_results = toolkit.config.get(
+        u'ckan.dataontosearch.search_cache_max_results',
+        100000
+    )
+    return toolkit.asint(max_results)
+
+
+def get_rows_max():
+    # Use the same limit as package_search
+    rows_max = toolkit.config.get(u'ckan.search.rows_max', 1000)
+    return toolkit.asint(rows_max)
+
+
+def get_use_outbox():
+    use_outbox = toolkit.config.get(u'ckan.dataontosearch.outbox', False)
+    return toolkit.asbool(use_outbox)
+
+
+def get_outbox_retry_delay():
+    delay = toolkit.config.get(u'ckan.dataontosearch.outbox_retry_delay', 30)
+    return toolkit.asint(delay)
+
+
+def get_outbox_max_attempts():
+    max_attempts = toolkit.config.get(
+        u'ckan.dataontosearch.outbox_max_attempts',
+        10
+    )
+    return toolkit.asint(max_attempts)
+
+
+def get_send_rdf():
+    send_rdf = toolkit.config.get(u'ckan.dataontosearch.send_rdf', False)
+    return toolkit.asbool(send_rdf)
+
+
+def get_rdf_cache_ttl():
+    ttl = toolkit.config.get(u'ckan.dataontosearch.rdf_cache_ttl', 3600)
+    return toolkit.asint(ttl)
+
+
+def get_rdf_cache_size():
+    size = toolkit.config.get(u'ckan.dataontosearch.rdf_cache_size', 256)
+    return toolkit.asint(size)
+
+
+def get_use_mirror():
+    use_mirror = toolkit.config.get(u'ckan.dataontosearch.mirror', False)
+    return toolkit.asbool(use_mirror)
+
+
+def get_parallel_requests():
+    parallel_requests = toolkit.config.get(
+        u'ckan.dataontosearch.parallel_requests',
+        8
+    )
+    return toolkit.asint(parallel_requests)
+
+
+def get_timeouts(service):
+    '''
+    Get the connect and read timeouts for requests to the service, either
+    'tagger' or 'search'.
+    '''
+    config = toolkit.config
+    connect_timeout = config.get(
+        u'ckan.dataontosearch.{}_connect_timeout'.format(service),
+        3.05
+    )
+    read_timeout = config.get(
+        u'ckan.dataontosearch.{}_read_timeout'.format(service),
+        29.
+    )
+    return float(connect_timeout), float(read_timeout)
+
+
+def get_breaker_failures():
+    failures = toolkit.config.get(u'ckan.dataontosearch.breaker_failures', 5)
+    return toolkit.asint(failures)
+
+
+def get_breaker_reset_timeout():
+    reset_timeout = toolkit.config.get(
+        u'ckan.dataontosearch.breaker_reset_timeout',
+        30
+    )
+    return toolkit.asint(reset_timeout)
+
+
+def get_slow_request_threshold():
+    threshold = toolkit.config.get(
+        u'ckan.dataontosearch.slow_request_threshold',
+        10.
+    )
+    return float(threshold)
+
+
+def get_search_enrichment():
+    enrichment = toolkit.config.get(
+        u'ckan.dataontosearch.search_enrichment',
+        u'package_search'
+    )
+    return enrichment
+
+
+def get_enrichment_timeout():
+    timeout = toolkit.config.get(
+        u'ckan.dataontosearch.enrichment_timeout',
+        10.
+    )
+    return float(timeout)
+
+
+def get_auth_cache_ttl():
+    ttl = toolkit.config.get(u'ckan.dataontosearch.auth_cache_ttl', 0)
+    return toolkit.asint(ttl)
+
+
+def get_auth_cache_size():
+    size = toolkit.config.get(u'ckan.dataontosearch.auth_cache_size', 10000)
+    return toolkit.asint(size)
+
+
+def get_timing_log_threshold():
+    threshold = toolkit.config.get(
+        u'ckan.dataontosearch.timing_log_threshold',
+        0
+    )
+    return float(threshold)
+
+
+def get_timing_log_sample_rate():
+    sample_rate = toolkit.config.get(
+        u'ckan.dataontosearch.timing_log_sample_rate',
+        1.
+    )
+    return float(sample_rate)
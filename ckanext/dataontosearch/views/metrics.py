@@ -0,0 +1,109 @@
+# encoding: utf-8
+import ckan.plugins.toolkit as toolkit
+
+from flask import Blueprint, Response
+
+from ckanext.dataontosearch import metrics as metrics_module
+from ckanext.dataontosearch.cache import get_cache_stats
+from ckanext.dataontosearch.logic import get_search_skip_stats
+from ckanext.dataontosearch.utils import (
+    CircuitBreaker, get_connection_stats, get_coalescing_stats, get_breaker
+)
+from ckanext.dataontosearch.views.utils import _log_exceptions
+
+metrics = Blueprint(
+    u'dataontosearch_metrics',
+    __name__,
+    url_prefix=u'/dataontosearch/metrics'
+)
+
+
+def _collect_cache(key):
+    def collect():
+        return [
+            ({u'cache': name}, stats[key])
+            for name, stats in sorted(get_cache_stats().items())
+        ]
+    return collect
+
+
+def _collect_breakers():
+    states = (
+        CircuitBreaker.CLOSED,
+        CircuitBreaker.HALF_OPEN,
+        CircuitBreaker.OPEN,
+    )
+    samples = []
+    for service in (u'tagger', u'search'):
+        breaker = get_breaker(service)
+        for state in states:
+            samples.append((
+                {u'service': service, u'state': state},
+                int(breaker.state == state)
+            ))
+    return samples
+
+
+metrics_module.register(metrics_module.CollectedCounter(
+    u'dataontosearch_cache_hits',
+    u'Lookups in each cache that found a fresh entry.',
+    _collect_cache(u'hits')
+))
+metrics_module.register(metrics_module.CollectedCounter(
+    u'dataontosearch_cache_misses',
+    u'Lookups in each cache that found no fresh entry.',
+    _collect_cache(u'misses')
+))
+metrics_module.register(metrics_module.Gauge(
+    u'dataontosearch_cache_entries',
+    u'Entries currently in each cache.',
+    _collect_cache(u'entries')
+))
+metrics_module.register(metrics_module.CollectedCounter(
+    u'dataontosearch_search_skipped',
+    u'Search results left out, by reason.',
+    lambda: [
+        ({u'reason': reason}, count)
+        for reason, count in sorted(get_search_skip_stats().items())
+    ]
+))
+metrics_module.register(metrics_module.CollectedCounter(
+    u'dataontosearch_get_requests',
+    u'GET requests made to DataOntoSearch, and how many shared the response '
+    u'of an identical request.',
+    lambda: [
+        ({u'kind': kind}, count)
+        for kind, count in sorted(get_coalescing_stats().items())
+    ]
+))
+metrics_module.register(metrics_module.CollectedCounter(
+    u'dataontosearch_connections',
+    u'Requests sent to DataOntoSearch, connections opened for them and '
+    u'requests that reused a connection.',
+    lambda: [
+        ({u'kind': kind}, count)
+        for kind, count in sorted(get_connection_stats().items())
+    ]
+))
+metrics_module.register(metrics_module.Gauge(
+    u'dataontosearch_circuit_breaker_state',
+    u'Current state of the circuit breaker for each service.',
+    _collect_breakers
+))
+
+
+@metrics.route(u'')
+@_log_exceptions
+def show():
+    try:
+        toolkit.check_access(u'dataontosearch_metrics', {}, {})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(
+            403,
+            toolkit._(u'Only sysadmins can see the metrics')
+        )
+
+    return Response(
+        metrics_module.render(),
+        content_type=u'text/plain; version=0.0.4; charset=utf-8'
+    )
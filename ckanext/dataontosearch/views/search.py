@@ -4,7 +4,9 @@ import ckan.plugins.toolkit as toolkit
 
 from flask import Blueprint, request
 
-from ckanext.dataontosearch.views.utils import _log_exceptions
+from ckanext.dataontosearch.views.utils import (
+    _log_exceptions, _handle_unavailable, _server_timing, _render
+)
 
 logger = logging.getLogger(__name__)
 
@@ -15,25 +17,165 @@ search = Blueprint(
 )
 
 
+# The fields used by snippets/package_list.html, so that the rest of each
+# dataset is not sent to the template
+_RESULT_FIELDS = [
+    u'id',
+    u'name',
+    u'title',
+    u'notes',
+    u'type',
+    u'state',
+    u'private',
+    u'resources',
+    u'score',
+    u'concepts',
+    u'fusion_score',
+]
+
+
+# The action used for each search mode
+_SEARCH_ACTIONS = {
+    u'semantic': u'dataontosearch_dataset_search',
+    u'hybrid': u'dataontosearch_hybrid_search',
+}
+
+
+def _pager_url(q=None, mode=None, page=None, **filters):
+    return toolkit.url_for(
+        u'dataontosearch_search.do_search',
+        q=q,
+        mode=mode,
+        page=page,
+        **filters
+    )
+
+
+def _get_facet_fields():
+    # Use the same facets as the normal search
+    facets = toolkit.config.get(
+        u'search.facets',
+        u'organization groups tags res_format license_id'
+    )
+    return facets.split()
+
+
+def _make_filter_query(filters):
+    return u' '.join(
+        u'+{}:"{}"'.format(
+            field,
+            value.replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+        )
+        for field, values in sorted(filters.items())
+        for value in values
+    )
+
+
+def _get_facet_title(field):
+    # Same titles as used by the normal search
+    titles = {
+        u'organization': toolkit._(u'Organizations'),
+        u'groups': toolkit._(u'Groups'),
+        u'tags': toolkit._(u'Tags'),
+        u'res_format': toolkit._(u'Formats'),
+        u'license_id': toolkit._(u'Licenses'),
+    }
+    return titles.get(field, field)
+
+
+def _make_facet_items(search_facets, query, mode, filters):
+    '''
+    Describe each facet value, with a link that adds or removes its filter.
+    '''
+    facet_items = []
+    for field in _get_facet_fields():
+        items = []
+        for item in search_facets.get(field, {}).get(u'items', []):
+            values = filters.get(field, [])
+            active = item[u'name'] in values
+            if active:
+                new_values = [v for v in values if v != item[u'name']]
+            else:
+                new_values = values + [item[u'name']]
+            new_filters = dict(filters)
+            new_filters[field] = new_values
+            items.append({
+                u'display_name': item[u'display_name'],
+                u'count': item[u'count'],
+                u'active': active,
+                u'url': _pager_url(q=query, mode=mode, **new_filters),
+            })
+        if items:
+            facet_items.append({
+                u'title': _get_facet_title(field),
+                u'items': items,
+            })
+    return facet_items
+
+
 @search.route(u'')
+@_server_timing
 @_log_exceptions
+@_handle_unavailable
 def do_search():
     context = {}
 
     query = request.args.get(u'q', u'').strip()
+    mode = request.args.get(u'mode', u'semantic')
+    if mode not in _SEARCH_ACTIONS:
+        mode = u'semantic'
+    page_number = toolkit.h.get_page_number(request.args)
+    limit = toolkit.asint(toolkit.config.get(u'ckan.datasets_per_page', 20))
+
+    # Filters chosen among the facets, only available for semantic search
+    filters = {}
+    if mode == u'semantic':
+        for field in _get_facet_fields():
+            values = request.args.getlist(field)
+            if values:
+                filters[field] = values
 
+    facet_items = []
     if query:
-        result = toolkit.get_action(u'dataontosearch_dataset_search')(
-            context,
-            {u'q': query}
+        data_dict = {
+            u'q': query,
+            u'rows': limit,
+            u'start': (page_number - 1) * limit,
+            u'fl': _RESULT_FIELDS,
+        }
+        if mode == u'semantic':
+            data_dict[u'fq'] = _make_filter_query(filters)
+            data_dict[u'facet.field'] = _get_facet_fields()
+            data_dict[u'facet.limit'] = toolkit.asint(
+                toolkit.config.get(u'search.facets.default', 10)
+            )
+        result = toolkit.get_action(_SEARCH_ACTIONS[mode])(context, data_dict)
+        facet_items = _make_facet_items(
+            result[u'search_facets'],
+            query,
+            mode,
+            filters
+        )
+        page = toolkit.h.Page(
+            collection=result[u'results'],
+            page=page_number,
+            url=_pager_url,
+            item_count=result[u'count'],
+            items_per_page=limit
         )
+        page.items = result[u'results']
     else:
         result = None
+        page = None
 
-    return toolkit.render(
+    return _render(
         u'dataontosearch_search.html',
         {
             u'search': result,
             u'query': query,
+            u'mode': mode,
+            u'filters': filters,
+            u'facet_items': facet_items,
+            u'page': page,
         }
     )
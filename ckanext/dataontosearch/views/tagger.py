@@ -1,12 +1,18 @@
 # encoding: utf-8
 import logging
 import functools
+from collections import OrderedDict
 import ckan.plugins.toolkit as toolkit
 
 from flask import Blueprint, request
 from requests.exceptions import RequestException
 
-from ckanext.dataontosearch.views.utils import _log_exceptions
+from ckanext.dataontosearch import memo
+from ckanext.dataontosearch.logic import resolve_concepts
+from ckanext.dataontosearch.utils import get_use_outbox
+from ckanext.dataontosearch.views.utils import (
+    _log_exceptions, _handle_unavailable, _server_timing, _render
+)
 
 logger = logging.getLogger(__name__)
 
@@ -32,9 +38,8 @@ def _with_dataset(f):
         context = {}
 
         # Fetch info about the dataset
-        data_dict = {u'id': dataset_id}
         try:
-            dataset_dict = toolkit.get_action(u'package_show')(context, data_dict)
+            dataset_dict = memo.show_dataset(dataset_id)
         except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
             return toolkit.abort(404, toolkit._(u'Dataset not found'))
 
@@ -97,7 +102,9 @@ def _get_existing_tags(context, dataset_dict):
 
 
 @tagger.route(u'/')
+@_server_timing
 @_log_exceptions
+@_handle_unavailable
 @_with_dataset
 @_with_can_edit
 def show(context, dataset_dict, can_edit):
@@ -105,7 +112,7 @@ def show(context, dataset_dict, can_edit):
     concepts = _get_existing_tags(context, dataset_dict)
 
     # Render the page
-    return toolkit.render(
+    return _render(
         u'dataontosearch_tagger_show.html',
         {
             u'dataset': dataset_dict,
@@ -116,46 +123,66 @@ def show(context, dataset_dict, can_edit):
 
 
 @tagger.route(u'/edit', methods=[u'GET', u'POST'])
+@_server_timing
 @_log_exceptions
+@_handle_unavailable
 @_with_dataset
 def edit(dataset_dict, context):
     is_submitted = request.method == u'POST'
-    empty_value = u'NONE'
-    error = None
+
+    if not _get_can_edit(context, dataset_dict):
+        return toolkit.abort(
+            401,
+            toolkit._(u'You are not allowed to edit concepts associated with '
+                      u'this dataset')
+        )
 
     if is_submitted:
+        # Concepts are given by their label, as picked by the user
         new_tag_list = request.form.getlist(u'new_concept[]')
-        existing_tag_list = request.form.getlist(u'existing_concept[]')
-
-        new_tag_set = set(new_tag_list)
-        new_tag_set.discard(empty_value)
-        existing_tag_set = set(existing_tag_list)
-
 
-        added_tags = new_tag_set - existing_tag_set
-        removed_tags = existing_tag_set - new_tag_set
+        new_tags = OrderedDict.fromkeys(tag.strip() for tag in new_tag_list)
+        new_tags.pop(u'', None)
 
-        # TODO: Make this operation more atomic, not partially applied if error
-        # We add concepts first, since that's less destructive in case of error
+        # Find the concepts with those labels, so that DataOntoSearch is only
+        # given concepts it knows, and no label is taken to mean the wrong one
+        uris, unknown, ambiguous = resolve_concepts(
+            list(new_tags),
+            _get_existing_tags(context, dataset_dict)
+        )
+        errors = OrderedDict()
+        for label in unknown:
+            errors[label] = toolkit._(u'No concept has this label')
+        for label in ambiguous:
+            errors[label] = toolkit._(
+                u'More than one concept has this label'
+            )
+        if errors:
+            # Let the user correct the concepts they picked
+            return _render(
+                u'dataontosearch_tagger_edit.html',
+                {
+                    u'dataset': dataset_dict,
+                    u'chosen_concepts': [
+                        {u'label': label} for label in new_tags
+                    ],
+                    u'error_summary': errors,
+                }
+            ), 400
+
+        error = None
         try:
-            add_action = toolkit.get_action(u'dataontosearch_tag_create')
-            for new_concept in added_tags:
-                add_action(context, {
-                    u'dataset': dataset_dict[u'id'],
-                    u'concept': new_concept,
-                })
-
-            remove_action = toolkit.get_action(u'dataontosearch_tag_delete')
-            for removed_concept in removed_tags:
-                remove_action(context, {
-                    u'dataset': dataset_dict[u'id'],
-                    u'concept': removed_concept,
-                })
+            toolkit.get_action(u'dataontosearch_tag_update')(context, {
+                u'dataset': dataset_dict[u'id'],
+                u'concepts': uris,
+                u'defer': get_use_outbox(),
+            })
         except (
                 toolkit.NotAuthorized,
                 toolkit.ObjectNotFound,
                 toolkit.ValidationError,
-                RequestException
+                RequestException,
+                RuntimeError
         ) as e:
             logger.exception(
                 u'Failed to process edit of concepts for %s',
@@ -163,51 +190,26 @@ def edit(dataset_dict, context):
             )
             error = str(e)
 
+        if error is None:
+            toolkit.h.flash_success(toolkit._(u'The concepts were saved'))
+        else:
+            toolkit.h.flash_error(
+                toolkit._(u'The concepts could not be saved: {}').format(error)
+            )
+
         # Redirect back (as GET request)
-        # TODO: Show user flash message about the changes being saved or error
         return toolkit.redirect_to(
             u'dataontosearch_tagger.edit',
             dataset_id=dataset_dict[u'id']
         )
 
-    # Okay, create the form
-    if not _get_can_edit(context, dataset_dict):
-        return toolkit.abort(
-            401,
-            toolkit._(u'You are not allowed to edit concepts associated with '
-                      u'this dataset')
-        )
-
-    # Fetch tags for the dataset
+    # Okay, create the form, with the tags of the dataset
     existing_concepts = _get_existing_tags(context, dataset_dict)
 
-    # Fetch available tags
-    available_concepts = toolkit.get_action(u'dataontosearch_concept_list')(
-        context,
-        {}
-    )
-
-    # Fetch concepts that can be chosen
-    available_concept_options = []
-    for concept_iri, concept_info in available_concepts.iteritems():
-        available_concept_options.append({
-            u'value': concept_iri,
-            u'text': concept_info[u'label'],
-        })
-    # Sort concepts by label
-    available_concept_options.sort(key=lambda d: d[u'text'])
-    # Add the default "empty" option
-    available_concept_options.insert(0, {
-        u'value': empty_value,
-        u'text': toolkit._(u'-- No concept chosen --'),
-    })
-
-    return toolkit.render(
+    return _render(
         u'dataontosearch_tagger_edit.html',
         {
             u'dataset': dataset_dict,
-            u'concept_options': available_concept_options,
-            u'default_option_value': empty_value,
             u'chosen_concepts': existing_concepts,
         }
     )
@@ -1,5 +1,16 @@
+import random
 import logging
 import functools
+import ckan.plugins.toolkit as toolkit
+
+from flask import make_response, request
+from requests.exceptions import ConnectionError, Timeout
+
+from ckanext.dataontosearch import timing
+from ckanext.dataontosearch.utils import (
+    DataOntoSearchUnavailable, get_timing_log_threshold,
+    get_timing_log_sample_rate
+)
 
 
 logger = logging.getLogger(__name__)
@@ -17,3 +28,53 @@ def _log_exceptions(f):
             logger.exception(u'Exception occurred while processing route')
             raise
     return wrapper
+
+
+def _handle_unavailable(f):
+    '''
+    Show a friendly page when DataOntoSearch is unavailable or too slow.
+    '''
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except (DataOntoSearchUnavailable, ConnectionError, Timeout):
+            logger.warning(
+                u'DataOntoSearch is unavailable, showing degraded page',
+                exc_info=True
+            )
+            return toolkit.render(u'dataontosearch_unavailable.html'), 503
+    return wrapper
+
+
+def _server_timing(f):
+    '''
+    Tell the browser where the time was spent, using a Server-Timing header.
+
+    Slow requests can also be logged, see the timing_log_* settings.
+    '''
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        timing.start()
+        response = make_response(f(*args, **kwargs))
+        timings = timing.get_timings()
+        header = timing.format_header(timings)
+        response.headers[u'Server-Timing'] = header
+
+        threshold = get_timing_log_threshold()
+        if threshold and timings[u'total'] >= threshold and \
+                random.random() < get_timing_log_sample_rate():
+            logger.info(
+                u'Slow request %s %s: %s',
+                request.method,
+                request.path,
+                header
+            )
+        return response
+    return wrapper
+
+
+def _render(template_name, extra_vars):
+    # Render the template, timing it as part of the request
+    with timing.phase(u'render'):
+        return toolkit.render(template_name, extra_vars)
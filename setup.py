@@ -83,6 +83,9 @@ setup(
         dataontosearch_tagging=ckanext.dataontosearch.plugin:DataOntoSearch_TaggingPlugin
         dataontosearch_searching=ckanext.dataontosearch.plugin:DataOntoSearch_SearchingPlugin
 
+        [paste.paster_command]
+        dataontosearch=ckanext.dataontosearch.commands:DataOntoSearchCommand
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',